@@ -21,6 +21,9 @@ class LrNativeConnectionDisconnected {
 	async send(_method, _params) {
 		throw new Error("LrNativeConnection has been disconnected");
 	};
+	sendBatch(calls) {
+		return calls.map(() => this.send());
+	};
 	disconnect() {
 		// nothing to do
 	};
@@ -58,12 +61,33 @@ class LrNativeConnectionActive {
 	 * Go "net/rpc/jsonrpc" package.
 	 */
 	async send(method, params) {
-		const response = await this.doSend({
+		const response = await this.doSend(this._makeRequest(method, params));
+		return this._getResult(response);
+	};
+
+	/** Send `[[method, params], ...]` as single JSON-RPC 2.0 batch message.
+	 *
+	 * Backend should declare "jsonrpcBatch" in `capabilities`
+	 * of response to "hello". Returns array of promises in the same order
+	 * as `calls`.
+	 */
+	sendBatch(calls) {
+		const requests = calls.map(([method, params]) => this._makeRequest(method, params));
+		this.port.postMessage(requests);
+		return requests.map(request => this._addPending(request.id)
+			.then(response => this._getResult(response)));
+	};
+
+	_makeRequest(method, params) {
+		return {
 			jsonrpc: "2.0",
 			id: LrNativeConnectionActive.getId(),
 			method: method,
 			params: [ params ],
-		});
+		};
+	};
+
+	_getResult(response) {
 		const error = response && response.error;
 		if (error) {
 			if (typeof error === "string") {
@@ -129,9 +153,12 @@ class LrNativeConnectionActive {
 	};
 
 	async doSend(message) {
-		const id = message.id;
-		console.assert(!this.promiseMap.has(id), "request id should not be in the map");
 		this.port.postMessage(message);
+		return this._addPending(message.id);
+	};
+
+	_addPending(id) {
+		console.assert(!this.promiseMap.has(id), "request id should not be in the map");
 		const entry = { error: Error() };
 		const promise = new Promise((resolve, reject) => {
 			entry.resolve = resolve;
@@ -142,6 +169,17 @@ class LrNativeConnectionActive {
 	};
 
 	doOnMessage(message, port) {
+		if (Array.isArray(message)) {
+			// Response to batch request
+			for (const response of message) {
+				this.doOnMessage(response, port);
+			}
+			return;
+		}
+		if (message && message.chunk != null) {
+			this._onChunk(message, port);
+			return;
+		}
 		const id = message && message.id;
 		if (id == null) {
 			if (message.error) {
@@ -163,6 +201,39 @@ class LrNativeConnectionActive {
 		this.promiseMap.delete(id);
 	};
 
+	/** Large response split by backend having "chunkedResponse" capability.
+	 *
+	 * `text` fields of messages with the same `id` are concatenated
+	 * till `chunk.last` and parsed as a regular response.
+	 */
+	_onChunk(message, port) {
+		const { id, chunk, text } = message;
+		const entry = this.promiseMap.get(id);
+		if (entry == null) {
+			console.error("Chunk with unknown id received", port, message);
+			throw new Error("Native message chunk with invalid id");
+		}
+		const chunks = entry.chunks || (entry.chunks = []);
+		if (chunk.index !== chunks.length || typeof text !== "string") {
+			this.promiseMap.delete(id);
+			entry.reject(new Error("Native message: invalid response chunk"));
+			return;
+		}
+		chunks.push(text);
+		if (!chunk.last) {
+			return;
+		}
+		let response;
+		try {
+			response = JSON.parse(chunks.join(""));
+		} catch (ex) {
+			this.promiseMap.delete(id);
+			entry.reject(ex);
+			return;
+		}
+		this.doOnMessage(response, port);
+	};
+
 	doOnDisconnect() {
 		this.disconnect((this.port && this.port.error) ||
 			(bapi.runtime.lastError && bapi.runtime.lastError.message));
@@ -183,6 +254,9 @@ class LrNativeConnection {
 	async send(method, params) {
 		return this._state.send(method, params);
 	};
+	sendBatch(calls) {
+		return this._state.sendBatch(calls);
+	};
 	disconnect(error) {
 		error = error ?? new Error("Closing native connection");
 		return this._state.disconnect(error);
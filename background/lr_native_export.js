@@ -196,11 +196,33 @@ var lr_native_export = lr_util.namespace(lr_native_export, function lr_native_ex
 					return { response: "UNSUPPORTED", hello };
 				}
 				const response = new Map();
+				if (hello.capabilities.indexOf("urlMentionsBatch") >= 0) {
+					// Backend looks up every URL once for all queries.
+					const results = await connection.send(
+						"linkremark.urlMentionsBatch",
+						{ queries: queryArray.map(({ id, variants }) => ({ id, variants })) });
+					for (const { id } of queryArray) {
+						const mentions = results?.[id];
+						if (mentions && mentions.total > 0) {
+							response.set(id, mentions);
+						}
+					}
+					return response.size > 0 ?
+						{ response, hello } : { response: "NO_MENTIONS", hello };
+				}
 				let error;
-				for (const query of queryArray) {
+				// Single round trip if backend supports JSON-RPC batch requests.
+				const batch = hello.capabilities.indexOf("jsonrpcBatch") >= 0 ?
+					connection.sendBatch(queryArray.map(
+						({ variants }) => [ "linkremark.urlMentions", { variants } ]))
+					: null;
+				// Avoid unhandled rejection reports while earlier responses are awaited.
+				batch?.forEach(promise => promise.catch(() => undefined));
+				for (const [ index, query ] of queryArray.entries()) {
+					const { variants, id } = query;
 					try {
-						const { variants, id } = query;
-						const mentions = await connection.send("linkremark.urlMentions", { variants })
+						const mentions = await (batch != null ? batch[index] :
+							connection.send("linkremark.urlMentions", { variants }));
 						if (mentions && mentions.total > 0) {
 							response.set(id, mentions);
 						}
@@ -219,7 +241,7 @@ var lr_native_export = lr_util.namespace(lr_native_export, function lr_native_ex
 					}
 					return { response: "NO_MENTIONS", hello };
 				} else if (error) {
-					console.error("lr_native_export._queryMentions: error: %o", ex);
+					console.error("lr_native_export._queryMentions: error: %o", error);
 				}
 				return { response, hello };
 			},
@@ -0,0 +1,468 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmarks for ``lr_webextensions`` native messaging helpers
+
+Run ``lr_bench.py --help`` for the list of benchmarks. Results are printed
+as plain text, one line per case, to compare changes in the host code.
+"""
+
+import argparse
+import io
+import json
+import gc
+import logging
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from lr_webextensions import (
+    jsonrpc, mentions, mentions_compact, mentions_sqlite, native_messaging,
+    orgfile)
+import lr_example
+from lr_replay import make_object_capture
+
+FRAMING_SIZES = [1024, 16*1024, 256*1024, 1000*1000]
+
+
+def measure(func, repeat):
+    """Return time per call in seconds and peak traced memory in bytes"""
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start)/repeat
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def make_message(size):
+    """JSON-RPC capture request with encoded size close to ``size``"""
+    message = {
+        "jsonrpc": "2.0", "id": 1, "method": "capture",
+        "params": [{"format": "object", "version": "0.2", "data": {
+            "body": {"elements": [{"title": [
+                {"value": "", "keys": ["document.title"]}]}]}}}]}
+    overhead = len(json.dumps(message, ensure_ascii=False).encode('utf-8'))
+    element = message["params"][0]["data"]["body"]["elements"][0]
+    element["title"][0]["value"] = "Заголовок " * max(0, (size - overhead)//19)
+    return message
+
+
+def legacy_message_source(input_file):
+    """Reader before ``FrameReader``, kept as the baseline"""
+    while True:
+        raw_length = input_file.read(4)
+        if len(raw_length) == 0:
+            return
+        message_length = struct.unpack('@I', raw_length)[0]
+        message = input_file.read(message_length).decode('utf-8')
+        yield json.loads(message)
+
+
+def bench_framing(args):
+    for size in FRAMING_SIZES:
+        frame = b"".join(native_messaging.encode_message(make_message(size)))
+        stream = frame*args.count
+        for name, source in (
+                ("legacy", legacy_message_source),
+                ("frame_reader", native_messaging.message_source)):
+            def run():
+                for _ in source(io.BytesIO(stream)):
+                    pass
+            elapsed, peak = measure(run, args.repeat)
+            total = len(stream)
+            print(
+                f"framing {name:12} size {len(frame):8} "
+                f"{total/elapsed/1e6:9.1f} MB/s "
+                f"{args.count/elapsed:9.0f} msg/s "
+                f"peak {peak/1024:9.1f} KiB")
+
+
+def legacy_process(handler, message):
+    """``jsonrpc.process`` before ``jsonrpc.Dispatcher``, kept as the baseline"""
+    if not isinstance(message, dict):
+        return jsonrpc.make_invalid_request_response(None, {})
+    request_id = message.get("id")
+    log_id = [message[key] for key in ["id", "method"] if key in message]
+    missed = [
+            key for key in ["jsonrpc", "id", "method"]
+            if key not in message]
+    if len(missed) > 0:
+        return jsonrpc.make_invalid_request_response(request_id, {})
+    if message["jsonrpc"] != "2.0":
+        return jsonrpc.make_invalid_request_response(request_id, {})
+    method = message["method"]
+    method_handler = handler
+    for attr in method.split('.'):
+        if not attr:
+            return jsonrpc.make_invalid_request_response(request_id, {})
+        if attr.startswith('_') or not hasattr(method_handler, attr):
+            jsonrpc.logger.warning('request %r: method not found', log_id)
+            return jsonrpc.make_method_not_found(request_id, method)
+        method_handler = getattr(method_handler, attr)
+    if not callable(method_handler):
+        return jsonrpc.make_method_not_found(request_id, method)
+    params = message.get("params")
+    if isinstance(params, list) and len(params) == 1:
+        params = params[0]
+    try:
+        if params is None:
+            result = method_handler()
+        elif isinstance(params, dict):
+            result = method_handler(**params)
+        elif isinstance(params, list):
+            result = method_handler(*params)
+        else:
+            return jsonrpc.make_invalid_request_response(request_id, {})
+    except Exception as ex:
+        return jsonrpc.make_exception_response(request_id, log_id, method, ex)
+    return jsonrpc.make_result_response(request_id, result)
+
+
+DISPATCH_REQUESTS = {
+    "hello": {"jsonrpc": "2.0", "id": 1, "method": "hello", "params": [{
+        "formats": [{"format": "object", "version": "0.2"}],
+        "version": "0.2"}]},
+    # "error" makes the handler skip xdg-open.
+    "capture": {"jsonrpc": "2.0", "id": 2, "method": "capture", "params": [{
+        "format": "object", "version": "0.2", "error": "benchmark",
+        "data": {"body": {"elements": [{
+            "url": [{"value": "https://orgmode.org/", "keys": ["window.location"]}],
+            "title": [{"value": "Org Mode", "keys": ["document.title"]}],
+        }]}}}]},
+    "unknown": {"jsonrpc": "2.0", "id": 3, "method": "linkremark.unknown"},
+}
+
+
+def bench_dispatch(args):
+    # Formatting of warnings for unknown method is not the subject.
+    logging.getLogger("lr_webextensions").setLevel(logging.ERROR)
+    handler = lr_example.Handler()
+    dispatcher = jsonrpc.Dispatcher(handler)
+    count = 1000*args.count
+    for name, message in DISPATCH_REQUESTS.items():
+        for variant, func in (
+                ("legacy", lambda: legacy_process(handler, message)),
+                ("dispatcher", lambda: jsonrpc.process(dispatcher, message))):
+            def run():
+                for _ in range(count):
+                    func()
+            elapsed, _ = measure(run, args.repeat)
+            print(
+                f"dispatch {name:8} {variant:10} "
+                f"{elapsed/count*1e6:7.2f} us/call")
+
+
+def bench_codec(args):
+    codecs = [native_messaging.JsonCodec()]
+    if native_messaging.orjson is not None:
+        codecs.append(native_messaging.OrjsonCodec())
+    for elements in (1, 10, 100, 1000):
+        message = {
+            "jsonrpc": "2.0", "id": 1, "method": "capture", "params": [{
+                "format": "object", "version": "0.2",
+                "data": make_object_capture(elements, 6)}]}
+        encoded = codecs[0].encode(message)
+        for codec in codecs:
+            if codec.encode(message) != encoded:
+                print(f"codec {codec.name}: encoded bytes differ")
+            for operation, func in (
+                    ("encode", lambda: codec.encode(message)),
+                    ("decode", lambda: codec.decode(encoded))):
+                elapsed, peak = measure(func, args.repeat*args.count)
+                print(
+                    f"codec {codec.name:6} {operation} size {len(encoded):8} "
+                    f"{len(encoded)/elapsed/1e6:8.1f} MB/s "
+                    f"peak {peak/1024:9.1f} KiB")
+
+
+NOTES_SECTION = """\
+** Section {section} of file {file}
+:PROPERTIES:
+:DATE_ADDED: [2021-09-28 Tue 12:15]
+:END:
+
+- URL :: [[https://example.org/notes/{file}/{section}][Page {section}]]
+- referrer :: [[https://orgmode.org/manual/][The Org Manual]]
+
+Org mode is for keeping notes, maintaining to-do lists, planning projects,
+authoring documents, computational notebooks, literate programming and more
+— in a fast and effective plain text system. https://orgmode.org/{section}
+{filler}
+"""
+
+
+def make_notes_tree(root, files, total_size):
+    """Create ``files`` Org files of ``total_size`` bytes unless exist"""
+    marker = os.path.join(root, ".complete")
+    if os.path.exists(marker):
+        return
+    file_size = total_size//files
+    filler = "Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n"*20
+    for i in range(files):
+        directory = os.path.join(root, f"d{i % 50:02}")
+        os.makedirs(directory, exist_ok=True)
+        parts = [f"* File {i}\n"]
+        size = len(parts[0])
+        section = 0
+        while size < file_size:
+            text = NOTES_SECTION.format(file=i, section=section, filler=filler)
+            parts.append(text)
+            size += len(text)
+            section += 1
+        with open(os.path.join(directory, f"notes{i}.org"), "w") as f:
+            f.write("".join(parts))
+    open(marker, "w").close()
+
+
+def notes_root(args):
+    root = os.path.join(
+        args.notes_dir, f"lr-bench-notes-{args.notes_files}-{args.notes_mb}")
+    make_notes_tree(root, args.notes_files, args.notes_mb*1000*1000)
+    return root
+
+
+def bench_mentions(args):
+    root = notes_root(args)
+    serial = None
+    for workers in dict.fromkeys((1, args.workers)):
+        index = mentions.UrlIndex([root], workers=workers)
+        start = time.perf_counter()
+        count = index.refresh()
+        elapsed = time.perf_counter() - start
+        size = sum(os.path.getsize(path) for path in index.files)
+        print(
+            f"mentions build {workers:2} processes {count} files "
+            f"{size/1e6:.0f} MB {elapsed:.2f} s {count/elapsed:.0f} files/s "
+            f"{size/elapsed/1e6:.1f} MB/s {len(index.postings)} keys")
+        dump = [
+            (path, org_file.headings, org_file.links)
+            for path, org_file in index.files.items()]
+        if serial is None:
+            serial = dump
+        elif dump != serial:
+            print("mentions build: parallel and serial indexes differ")
+    del serial, dump
+    popular = ["https://orgmode.org/manual/"]
+    for name, variants, order in (
+            ("rare", ["https://example.org/notes/7/3"], "path"),
+            ("popular", popular, "path"),
+            ("popular", popular, "mtime"),
+            ("popular", popular, "depth")):
+        def query():
+            index.refresh()
+            return index.mentions(variants, order=order)
+
+        elapsed, _ = measure(query, args.repeat*args.count)
+        print(
+            f"mentions query unchanged {name:8} {order:5} {elapsed*1e3:8.3f} ms "
+            f"({query()['total']} links)")
+    for prefix in ("https://example.org/notes/7", "https://example.org/notes"):
+        elapsed, _ = measure(lambda: index.prefix_mentions(prefix), args.repeat)
+        result = index.prefix_mentions(prefix)
+        print(
+            f"mentions prefix {elapsed*1e3:8.3f} ms {result['total']} links "
+            f"{len(result['children'])} sub-prefixes {prefix}")
+    edited = os.path.join(root, "d07", "notes7.org")
+    with open(edited, "rb") as f:
+        original = f.read()
+    try:
+        for variant, full in (("inotify", False), ("poll", True)):
+            times = []
+            for i in range(args.repeat):
+                url = f"https://example.org/edited/{os.getpid()}/{variant}/{i}"
+                with open(edited, "a") as f:
+                    f.write(f"- [[{url}]]\n")
+                start = time.perf_counter()
+                count = index.refresh(full)
+                found = index.mentions([url])["total"]
+                times.append(time.perf_counter() - start)
+                if count != 1 or found != 1:
+                    print(f"mentions {variant}: reparsed {count} found {found}")
+            if variant == "inotify" and not index.watching:
+                variant = "poll*"
+            print(
+                f"mentions query after edit {variant:8} "
+                f"{min(times)*1e3:8.3f} ms (file {len(original)} B)")
+    finally:
+        with open(edited, "wb") as f:
+            f.write(original)
+    if mentions_sqlite.sqlite3 is not None:
+        bench_mentions_sqlite(root, args.repeat)
+
+
+def bench_mentions_sqlite(root, repeat):
+    """First query of a process started with existing database"""
+    db_path = root + ".sqlite"
+    index = mentions_sqlite.SqliteUrlIndex([root], db_path, watch=False)
+    start = time.perf_counter()
+    count = index.refresh()
+    elapsed = time.perf_counter() - start
+    index.close()
+    if count:
+        print(f"mentions sqlite update {count} files {elapsed:.2f} s")
+    variants = ["https://example.org/notes/7/3"]
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        index = mentions_sqlite.SqliteUrlIndex([root], db_path, watch=False)
+        count = index.refresh()
+        found = index.mentions(variants)["total"]
+        times.append(time.perf_counter() - start)
+        index.close()
+    print(
+        f"mentions sqlite first query {min(times)*1e3:8.3f} ms "
+        f"(reparsed {count} found {found})")
+
+
+def resident_size():
+    """Resident set size of the process in bytes, Linux only"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+
+
+MEMORY_STORES = {
+    "dict": mentions.UrlIndex,
+    "compact": mentions_compact.CompactUrlIndex,
+}
+
+
+def measure_store(store, root):
+    """Build index in a fresh process, so freed memory does not affect RSS"""
+    gc.collect()
+    before = resident_size()
+    start = time.perf_counter()
+    index = MEMORY_STORES[store]([root], watch=False)
+    index.refresh()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size = resident_size() - before
+    links = sum(count for _, count in index.prefix_counts(""))
+    variants = ["https://orgmode.org/manual/"]
+    query, _ = measure(lambda: index.mentions(variants), 5)
+    return size, links, elapsed, query
+
+
+def bench_memory(args):
+    root = notes_root(args)
+    if not os.path.exists("/proc/self/statm"):
+        print("memory: /proc/self/statm is not available")
+        return
+    context = multiprocessing.get_context("spawn")
+    for store in MEMORY_STORES:
+        with context.Pool(1) as pool:
+            size, links, elapsed, query = pool.apply(
+                measure_store, (store, root))
+        print(
+            f"memory {store:8} {size/1e6:6.1f} MB {links} links "
+            f"{size/links:5.0f} B/link build {elapsed:.2f} s "
+            f"popular query {query*1e3:.3f} ms")
+
+
+ORG_ENTRY = """\
+* Org Mode {index}
+:PROPERTIES:
+:CREATED: [2021-03-01 Mon 12:00]
+:END:
+- URL :: [[https://orgmode.org/{index}][Org Mode]]
+- title :: Org mode for Emacs
+"""
+
+
+def bench_orgfile(args):
+    """Captures appended to an Org file per second"""
+    total = args.count*50
+    threads = 8
+    with tempfile.TemporaryDirectory() as directory:
+        for fsync in (False, True):
+            for name, callers, batch in (
+                    ("sequential", 1, 1),
+                    (f"{threads} threads", threads, 1),
+                    ("tab group", 1, 100)):
+                path = os.path.join(directory, f"{name}-{fsync}.org")
+                appender = orgfile.OrgFileAppender(path, fsync=fsync)
+                calls = total//(callers*batch)
+
+                def run():
+                    for i in range(calls):
+                        appender.append(
+                            [ORG_ENTRY.format(index=i*batch + j) for j in range(batch)])
+
+                workers = [threading.Thread(target=run) for _ in range(callers)]
+                start = time.perf_counter()
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                elapsed = time.perf_counter() - start
+                count = calls*callers*batch
+                print(
+                    f"orgfile {'fsync' if fsync else 'no fsync':8} {name:10} "
+                    f"{count/elapsed:9.0f} captures/s "
+                    f"{count/appender.batch_count:6.1f} captures/batch")
+
+
+BENCHMARKS = {
+    "framing": (bench_framing, "read framed messages of 1 KB - 1 MB"),
+    "dispatch": (bench_dispatch, "JSON-RPC method lookup and call"),
+    "codec": (bench_codec, "JSON encoder and decoder for object format"),
+    "mentions": (bench_mentions, "URL index build and refresh after edit"),
+    "memory": (bench_memory, "resident memory of in-memory URL indexes"),
+    "orgfile": (bench_orgfile, "direct append of captures to Org file"),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="runs per case")
+    parser.add_argument(
+        "--count", type=int, default=20, help="messages per run")
+    parser.add_argument(
+        "--notes-dir", default="/tmp",
+        help="where to create notes tree for mentions, it is reused")
+    parser.add_argument("--notes-files", type=int, default=5000)
+    parser.add_argument("--notes-mb", type=int, default=500)
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1,
+        help="processes for parallel build of mentions index")
+    parser.add_argument(
+        "benchmark", nargs="*",
+        help="; ".join(f"{k}: {v[1]}" for k, v in BENCHMARKS.items()))
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmark if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(unknown)}")
+    for name in args.benchmark or BENCHMARKS:
+        BENCHMARKS[name][0](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
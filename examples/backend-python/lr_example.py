@@ -18,12 +18,11 @@
 """Example of native messaging backend for LinkRemark browser extension
 
 Demonstrate how to create custom formatters by requesting data
-in "object" format. This application extracts URL from the captured frame
-and launches org-protocol store-link handler.
-
-Use ``emacs-client`` instead of ``xdg-open`` have a bit more secure
-configuration and to avoid hassle with setting up of protocol handler
-in desktop environment.
+in "object" format. This application extracts URLs of captured tabs
+and passes them to org-protocol store-link handler. All links
+of a tab group are sent to Emacs server by a single request,
+so a window with a hundred of tabs is captured as fast as a single tab.
+``xdg-open`` is launched for every link if Emacs server is not running.
 
 See also ``lr_emacsclient.py`` minimal useful backend that requests
 formatted capture as org-protocol URI and passes it to emacsclient.
@@ -38,8 +37,18 @@ from http import HTTPStatus
 import logging
 from subprocess import run, SubprocessError
 from urllib.parse import urlencode
+from lr_webextensions import emacs_server
 from lr_webextensions.jsonrpc import JsonRpcError, loop
 
+# Links are stored in Emacs by a single request. Result is a number
+# to distinguish it from an error reported as a message.
+STORE_LINKS = """\
+(progn
+  (dolist (uri (list
+    {uris}))
+    (org-protocol-check-filename-for-protocol uri nil nil))
+  {count})"""
+
 
 def org_protocol_urlencode(protocol, *args, **kwargs):
     """ ``urllib.parse.urlencode`` with space encoded as ``%20``
@@ -56,9 +65,13 @@ def org_protocol_urlencode(protocol, *args, **kwargs):
     return f'org-protocol:/{protocol}?{query}'
 
 
+def org_protocol_store_link(url, title):
+    return org_protocol_urlencode(
+        'store-link', {'url': url, 'title': title or ''}, safe='')
+
+
 def call_org_protocol_store_link(url, title):
-    arg = org_protocol_urlencode(
-        'store-link', {'url': url, 'title': title}, safe='')
+    arg = org_protocol_store_link(url, title)
     try:
         run(['xdg-open', arg], check=True)
         return True
@@ -69,10 +82,59 @@ def call_org_protocol_store_link(url, title):
             HTTPStatus.INTERNAL_SERVER_ERROR)
 
 
-# Handler().capture(format='object', version='0.2', data=[{
-#     'url': [{'value': 'https://orgmode.org/', 'keys': ['window.location']}],
-#     'title': [{'value': 'Org Mode', 'keys': ['document.title']}],
-# }])
+def store_links(links, server):
+    """Pass ``[(url, title)]`` to org-protocol store-link in a single request
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "server")
+    >>> with emacs_server.FakeEmacsServer(path, lambda form: "2") as fake:
+    ...     store_links([
+    ...         ("https://orgmode.org/", "Org Mode"),
+    ...         ("https://www.gnu.org/", None),
+    ...     ], emacs_server.EmacsServer(path))
+    True
+    >>> print(emacs_server.unquote_argument(fake.requests[0][-1]))
+    (progn
+      (dolist (uri (list
+        "org-protocol:/store-link?url=https%3A%2F%2Forgmode.org%2F&title=Org%20Mode"
+        "org-protocol:/store-link?url=https%3A%2F%2Fwww.gnu.org%2F&title="))
+        (org-protocol-check-filename-for-protocol uri nil nil))
+      2)
+    """
+    uris = "\n    ".join(
+        emacs_server.elisp_string(org_protocol_store_link(url, title))
+        for url, title in links)
+    form = STORE_LINKS.format(uris=uris, count=len(links))
+    try:
+        output = server.eval(form)
+    except emacs_server.ServerNotRunning:
+        logging.warning("Emacs server is not running, using xdg-open")
+    except (emacs_server.EmacsServerError, OSError) as ex:
+        logging.error("store links in Emacs failed: %s", ex)
+        return JsonRpcError(
+            "Store links in Emacs failed",
+            HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(ex)})
+    else:
+        if output.strip() != str(len(links)):
+            logging.error("store links: unexpected result: %s", output)
+            return JsonRpcError(
+                "Unexpected result of store links in Emacs",
+                HTTPStatus.INTERNAL_SERVER_ERROR, {"output": output})
+        return True
+    for url, title in links:
+        result = call_org_protocol_store_link(url, title)
+        if result is not True:
+            return result
+    return True
+
+
+# Handler().capture(format='object', version='0.2', data={'body': {
+#     '_type': 'TabFrameChain',
+#     'elements': [{
+#         'url': [{'value': 'https://orgmode.org/', 'keys': ['window.location']}],
+#         'title': [{'value': 'Org Mode', 'keys': ['document.title']}],
+#     }],
+# }})
 class Handler:
     _format = "object"
     _version = "0.2"
@@ -82,6 +144,9 @@ class Handler:
         'window.location': 10,
     }
 
+    def __init__(self, emacs=None):
+        self._emacs = emacs if emacs is not None else emacs_server.EmacsServer()
+
     def hello(self, version=None, formats=None):
         """
         >>> Handler().hello(
@@ -112,7 +177,7 @@ class Handler:
             HTTPStatus.NOT_IMPLEMENTED,
             data)
 
-    # In the case of tab group only the first link is stored.
+    # In the case of tab group links to all tabs are stored.
     def capture(self, data=None, format=None, version=None, error=None, **kwargs):
         kwargs.pop("options", None)
         if kwargs:
@@ -124,21 +189,19 @@ class Handler:
         if format_error:
             return format_error
         try:
-            url, title = self._get_frame_link(data["body"]["elements"][0])
-
-            if error:
-                return {"preview": True, "status": "preview"}
-
+            links = self._get_links(data["body"])
         except ValueError as ex:
             return JsonRpcError(
                 "capture: " + str(ex),
                 HTTPStatus.NOT_ACCEPTABLE)
-
-        if call_org_protocol_store_link(url, title):
-            return {"preview": False, "status": "success"}
-        else:
+        if error:
             return {"preview": True, "status": "preview"}
 
+        result = store_links(links, self._emacs)
+        if result is not True:
+            return result
+        return {"preview": False, "status": "success"}
+
     def _check_format_version(self, data, format, version):
         if (
                 not isinstance(data, dict) or
@@ -146,8 +209,7 @@ class Handler:
                 not isinstance(data["body"], dict) or
                 "elements" not in data["body"] or
                 not isinstance(data["body"]["elements"], list) or
-                not len(data["body"]["elements"]) > 0 or
-                not isinstance(data["body"]["elements"][0], dict)):
+                not len(data["body"]["elements"]) > 0):
             return JsonRpcError(
                 "capture: data is not Array or its element is not Object",
                 HTTPStatus.BAD_REQUEST, data)
@@ -164,6 +226,53 @@ class Handler:
                 })
         return None
 
+    def _get_links(self, body):
+        """``[(url, title)]`` of a tab or of every tab in a group
+
+        Text elements of the group and tabs without URL are skipped.
+        ``ValueError`` is raised if the structure is not expected one.
+
+        >>> def tab(url, title):
+        ...     return {"_type": "TabFrameChain", "elements": [{
+        ...         "url": [{"value": url, "keys": ["window.location"]}],
+        ...         "title": [{"value": title, "keys": ["document.title"]}],
+        ...     }]}
+        >>> Handler()._get_links({"_type": "TabGroup", "elements": [
+        ...     {"_type": "Text", "elements": ["Capture of 1 tabs failed"]},
+        ...     tab("https://orgmode.org/", "Org Mode"),
+        ...     tab("https://www.gnu.org/", "GNU"),
+        ... ]})
+        [('https://orgmode.org/', 'Org Mode'), ('https://www.gnu.org/', 'GNU')]
+        >>> Handler()._get_links({"_type": "TabGroup", "elements": [
+        ...     {"_type": "TabFrameChain", "elements": [{"url": "https://gnu.org/"}]},
+        ... ]})
+        Traceback (most recent call last):
+            ...
+        ValueError: url is not an Array of Objects
+        """
+        if body.get("_type") == "TabGroup":
+            chains = body["elements"]
+        else:
+            chains = [body]
+        links = []
+        for chain in chains:
+            if not isinstance(chain, dict):
+                raise ValueError("tab group element is not an Object")
+            if chain.get("_type") == "Text":
+                continue
+            frames = chain.get("elements")
+            if not isinstance(frames, list) or not frames:
+                raise ValueError("tab has no frames")
+            frame = frames[0]
+            _check_frame(frame)
+            try:
+                links.append(self._get_frame_link(frame))
+            except ValueError:
+                logging.warning("capture: tab without URL is skipped")
+        if not links:
+            raise ValueError("url not found")
+        return links
+
     def _get_frame_link(self, frame):
         """
         >>> Handler()._get_frame_link({
@@ -185,7 +294,7 @@ class Handler:
                 best_score = score
                 url = variant['value']
         titleVariants = frame.get('title')
-        title = titleVariants[0]['value'] if len(titleVariants) > 0 else None
+        title = titleVariants[0]['value'] if titleVariants else None
         if not url:
             raise ValueError("url not found")
         return url, title
@@ -200,5 +309,24 @@ class Handler:
         return self._url_score_map.get(source, 1)
 
 
+def _check_frame(frame):
+    """Raise ``ValueError`` if fields used by ``Handler`` have other types"""
+    if not isinstance(frame, dict):
+        raise ValueError("frame is not an Object")
+    for field in ("url", "title"):
+        variants = frame.get(field, [])
+        if not isinstance(variants, list) or not all(
+                isinstance(variant, dict) for variant in variants):
+            raise ValueError(f"{field} is not an Array of Objects")
+        for variant in variants:
+            keys = variant.get("keys", [])
+            if (
+                    not isinstance(variant.get("value"), str)
+                    or not isinstance(keys, list)
+                    or not all(isinstance(key, str) for key in keys)):
+                raise ValueError(
+                    f"{field} variant is not {{value: String, keys: Array}}")
+
+
 if __name__ == '__main__':
     loop(Handler())
@@ -0,0 +1,157 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Native messaging backend that appends captures to an Org file
+
+Emacs and org-protocol are not involved, so capture of hundreds
+of tabs is fast. Captures formatted by the extension ("org" format)
+are preferred, for "object" format a heading with link is created
+for every tab. Entries are appended to the file specified
+by ``LR_ORG_FILE`` environment variable, set ``LR_ORG_FILE_FSYNC=1``
+to flush them to disk before response.
+
+Capture fails if the file is modified in an Emacs buffer, otherwise
+saving of the buffer would overwrite the entries. Enable
+``auto-revert-mode`` in Emacs for the file to see new entries.
+
+OS: Linux.
+"""
+
+from http import HTTPStatus
+import logging
+import os
+import lr_example
+from lr_webextensions.jsonrpc import JsonRpcError
+from lr_webextensions.jsonrpc_asyncio import loop
+from lr_webextensions.orgfile import ConcurrentEditError, OrgFileAppender
+
+
+def org_link(url, title=None):
+    """Org mode bracket link
+
+    >>> print(org_link("https://example.org/[1]", "Array[1]"))
+    [[https://example.org/%5B1%5D][Array{1}]]
+    """
+    url = url.replace("[", "%5B").replace("]", "%5D")
+    if not title:
+        return f"[[{url}]]"
+    title = title.replace("[", "{").replace("]", "}")
+    return f"[[{url}][{title}]]"
+
+
+def org_entry(body):
+    """Org subtree for the body of "org" format
+
+    The leading star is stripped by the extension for "entry"
+    capture template type.
+
+    >>> print(org_entry("Org Mode\\n- URL :: https://orgmode.org/"))
+    * Org Mode
+    - URL :: https://orgmode.org/
+    """
+    return body if body.startswith("*") else "* " + body
+
+
+# Handler(OrgFileAppender("inbox.org")).capture(format='org', version='0.2', data={
+#     'url': 'https://orgmode.org/', 'title': 'Org Mode',
+#     'body': '* Org Mode\n- URL :: https://orgmode.org/\n',
+# })
+class Handler(lr_example.Handler):
+    _formats = [("org", "0.2"), ("object", "0.2")]
+
+    def __init__(self, appender):
+        super().__init__()
+        self._appender = appender
+
+    def hello(self, version=None, formats=None):
+        """
+        >>> Handler(None).hello(
+        ...     formats=[
+        ...         {"format": "object", "version": "0.2"},
+        ...         {"format": "org", "version": "0.2"},
+        ...     ],
+        ...     version="0.2",
+        ... );
+        {'format': 'org', 'version': '0.2'}
+        """
+        if not isinstance(formats, list) or not all(
+                isinstance(descr, dict) for descr in formats):
+            return JsonRpcError(
+                "hello: formats are not specified",
+                HTTPStatus.BAD_REQUEST)
+        offered = {(descr.get("format"), descr.get("version")) for descr in formats}
+        for format, version in self._formats:
+            if (format, version) in offered:
+                return {"format": format, "version": version}
+        return JsonRpcError(
+            "hello: supported format not found",
+            HTTPStatus.NOT_IMPLEMENTED,
+            [{"format": f, "version": v} for f, v in self._formats])
+
+    def capture(self, data=None, format=None, version=None, error=None, **kwargs):
+        kwargs.pop("options", None)
+        if kwargs:
+            return JsonRpcError(
+                "capture: unsupported fields",
+                HTTPStatus.BAD_REQUEST, {"fields": list(kwargs.keys())})
+        if (format, version) == ("org", "0.2"):
+            if not isinstance(data, dict) or not isinstance(data.get("body"), str):
+                return JsonRpcError(
+                    'capture: data is not an Object with "body" String field',
+                    HTTPStatus.BAD_REQUEST, data)
+            entries = [org_entry(data["body"])]
+        else:
+            format_error = self._check_format_version(data, format, version)
+            if format_error:
+                return format_error
+            try:
+                entries = [
+                    "* " + org_link(url, title)
+                    for url, title in self._get_links(data["body"])]
+            except ValueError as ex:
+                return JsonRpcError(
+                    "capture: " + str(ex),
+                    HTTPStatus.NOT_ACCEPTABLE)
+        if error:
+            return {"preview": True, "status": "preview"}
+        try:
+            self._appender.append(entries)
+        except ConcurrentEditError as ex:
+            logging.error("capture: %s", ex)
+            return JsonRpcError(
+                str(ex), HTTPStatus.CONFLICT,
+                {"file": self._appender.path, "owner": ex.owner, "changed": ex.changed})
+        except OSError as ex:
+            logging.error(
+                "capture: append to %s failed", self._appender.path, exc_info=True)
+            return JsonRpcError(
+                "capture: " + str(ex),
+                HTTPStatus.INTERNAL_SERVER_ERROR, {"file": self._appender.path})
+        return {"preview": False, "status": "success"}
+
+
+def main():
+    path = os.environ.get("LR_ORG_FILE")
+    if not path:
+        raise SystemExit("LR_ORG_FILE environment variable is not set")
+    fsync = os.environ.get("LR_ORG_FILE_FSYNC", "") not in ("", "0")
+    # Captures processed concurrently are appended as a single batch.
+    loop(Handler(OrgFileAppender(os.path.expanduser(path), fsync=fsync)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Record native messaging sessions and replay them against a backend
+
+Record: create a wrapper script and specify it in the native messaging
+manifest instead of the backend executable
+
+    #!/bin/sh
+    exec /path/to/lr_replay.py record --output ~/lr-session.jsonl \\
+        -- /path/to/lr_emacsclient.py "$@"
+
+Every message is appended to the output file as a JSON line
+``{"t": SECONDS, "dir": "in"|"out", "message": MESSAGE}``.
+
+Generate synthetic "object" format captures instead of real traffic:
+
+    lr_replay.py generate --captures 200 --elements 50 --output synth.jsonl
+
+Replay requests ("in" messages) from a file through a pipe
+to a backend subprocess as fast as it accepts them:
+
+    lr_replay.py replay synth.jsonl -- ./lr_example.py
+    lr_replay.py replay synth.jsonl --handler lr_example:Handler
+
+and get requests per second, latency percentiles, and peak RSS
+of the backend process. Request ids are renumbered to be unique.
+"""
+
+import argparse
+import copy
+import json
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+from lr_webextensions import native_messaging
+
+DIR_IN = "in"
+DIR_OUT = "out"
+
+
+def make_object_capture(elements, variants):
+    """Capture in "object" format, e.g. a tab group, as ``data`` for ``capture``"""
+    keys = ["link.canonical", "og:url", "window.location", "twitter:url"]
+    return {"body": {"elements": [{
+        "url": [{
+            "value": f"https://example.org/section{i % 7}/page{i}?v={j}&ref=тест",
+            "keys": keys[:1 + j % len(keys)],
+        } for j in range(variants)],
+        "title": [
+            {"value": f"Page {i} – заголовок 😀", "keys": ["document.title"]},
+            {"value": f"Page {i}", "keys": ["og:title"]},
+        ],
+        "description": [{
+            "value": "Описание страницы. " * 10, "keys": ["meta.description"]}],
+    } for i in range(elements)]}}
+
+
+def generate_session(captures, elements, variants):
+    """Yield requests of a session with synthetic captures
+
+    ``error`` field makes ``lr_example.Handler`` skip launching
+    of external applications.
+    """
+    yield {"jsonrpc": "2.0", "id": 1, "method": "hello", "params": [{
+        "formats": [
+            {"format": "object", "version": "0.2"},
+            {"format": "org", "version": "0.2"},
+            {"format": "org-protocol", "version": "0.2"},
+        ],
+        "version": "0.2",
+    }]}
+    data = make_object_capture(elements, variants)
+    for i in range(captures):
+        yield {"jsonrpc": "2.0", "id": 2 + i, "method": "capture", "params": [{
+            "format": "object", "version": "0.2", "error": "replay",
+            "data": data,
+        }]}
+
+
+class Recorder:
+    """Append frames to a JSONL file without decoding"""
+
+    def __init__(self, output):
+        self._output = output
+        self._lock = threading.Lock()
+
+    def add(self, direction, frame):
+        line = b"".join((
+            f'{{"t":{time.time():.6f},"dir":"{direction}","message":'.encode(),
+            frame, b'}\n'))
+        with self._lock:
+            self._output.write(line)
+            self._output.flush()
+
+
+def relay(reader, output_file, recorder, direction):
+    writer = native_messaging.FrameWriter(output_file)
+    while True:
+        frame = reader.read_frame()
+        if frame is None:
+            break
+        frame = bytes(frame)
+        recorder.add(direction, frame)
+        writer.write_frames([len(frame).to_bytes(4, sys.byteorder), frame])
+        if writer.closed:
+            break
+    output_file.close()
+
+
+def command_record(args):
+    with open(args.output, "ab") as output:
+        recorder = Recorder(output)
+        child = subprocess.Popen(
+            args.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        # Browser limit applies to messages from the backend only.
+        browser = native_messaging.FrameReader(
+            sys.stdin.buffer, size_limit=1 << 32)
+        backend = native_messaging.FrameReader(child.stdout)
+        to_backend = threading.Thread(
+            target=relay, args=(browser, child.stdin, recorder, DIR_IN),
+            daemon=True)
+        to_backend.start()
+        relay(backend, sys.stdout.buffer, recorder, DIR_OUT)
+        return child.wait()
+
+
+def read_requests(path):
+    with open(path, "rb") as records:
+        for line in records:
+            record = json.loads(line)
+            if record.get("dir") == DIR_IN:
+                yield record["message"]
+
+
+def command_generate(args):
+    output = open(args.output, "w") if args.output != "-" else sys.stdout
+    with output:
+        for message in generate_session(
+                args.captures, args.elements, args.variants):
+            output.write(json.dumps(
+                {"t": 0, "dir": DIR_IN, "message": message},
+                ensure_ascii=False))
+            output.write("\n")
+
+
+def renumber(requests):
+    """Give unique ids to requests, return ``{id: method}``"""
+    methods = {}
+    next_id = 1
+    for request in requests:
+        for item in (request if isinstance(request, list) else [request]):
+            if isinstance(item, dict):
+                item["id"] = next_id
+                methods[next_id] = item.get("method")
+                next_id += 1
+    return methods
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction*len(values)))]
+
+
+def peak_rss_kib(pid):
+    """``VmHWM`` of a running process on Linux, otherwise ``None``"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def replay(command, requests, repeat=1):
+    """Send requests to ``command`` subprocess, return report ``dict``"""
+    requests = [copy.deepcopy(r) for _ in range(repeat) for r in requests]
+    methods = renumber(requests)
+    encoded = [b"".join(native_messaging.encode_message(r)) for r in requests]
+    child = subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    sent = {}
+
+    def send():
+        try:
+            for request, frame in zip(requests, encoded):
+                now = time.perf_counter()
+                for item in (request if isinstance(request, list) else [request]):
+                    sent[item["id"]] = now
+                child.stdin.write(frame)
+                child.stdin.flush()
+        except BrokenPipeError:
+            pass
+
+    latencies = {}
+    errors = 0
+    received = 0
+    sender = threading.Thread(target=send, daemon=True)
+    start = time.perf_counter()
+    sender.start()
+    reader = native_messaging.FrameReader(child.stdout, size_limit=1 << 32)
+    while received < len(methods):
+        frame = reader.read_frame()
+        if frame is None:
+            break
+        now = time.perf_counter()
+        response = reader.decode(frame)
+        for item in (response if isinstance(response, list) else [response]):
+            if not isinstance(item, dict) or item.get("id") not in sent:
+                continue
+            if "chunk" in item and not item["chunk"].get("last"):
+                continue
+            if "error" in item:
+                errors += 1
+            request_id = item["id"]
+            received += 1
+            latencies.setdefault(methods[request_id], []).append(
+                now - sent[request_id])
+    elapsed = time.perf_counter() - start
+    rss = peak_rss_kib(child.pid)
+    child.stdin.close()
+    sender.join()
+    returncode = child.wait()
+    if rss is None:
+        rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    all_latencies = sorted(x for values in latencies.values() for x in values)
+    return {
+        "requests": len(methods),
+        "responses": len(all_latencies),
+        "errors": errors,
+        "seconds": elapsed,
+        "rps": len(all_latencies)/elapsed if elapsed else None,
+        "p50": percentile(all_latencies, 0.5),
+        "p99": percentile(all_latencies, 0.99),
+        "methods": {
+            method: {
+                "count": len(values),
+                "p50": percentile(sorted(values), 0.5),
+                "p99": percentile(sorted(values), 0.99),
+            } for method, values in latencies.items()},
+        "peakRssKiB": rss,
+        "returncode": returncode,
+    }
+
+
+def handler_command(spec, use_async):
+    """Command to run ``module:Class`` handler from the current directory"""
+    module, _, cls = spec.partition(":")
+    loop_module = "jsonrpc_asyncio" if use_async else "jsonrpc"
+    code = (
+        f"import {module}\n"
+        f"from lr_webextensions.{loop_module} import loop\n"
+        f"loop({module}.{cls or 'Handler'}())\n")
+    return [sys.executable, "-u", "-c", code]
+
+
+def format_report(report):
+    ms = 1000
+    lines = [
+        f"requests {report['requests']} responses {report['responses']} "
+        f"errors {report['errors']} in {report['seconds']:.3f} s, "
+        f"{report['rps']:.1f} requests/s",
+        f"latency p50 {report['p50']*ms:.2f} ms p99 {report['p99']*ms:.2f} ms"
+        if report['p50'] is not None else "latency: no responses",
+        f"backend peak RSS {report['peakRssKiB']} KiB, "
+        f"exit code {report['returncode']}",
+    ]
+    for method, values in sorted(report["methods"].items(), key=str):
+        lines.append(
+            f"  {method}: {values['count']} "
+            f"p50 {values['p50']*ms:.2f} ms p99 {values['p99']*ms:.2f} ms")
+    return "\n".join(lines)
+
+
+def command_replay(args):
+    if args.handler:
+        command = handler_command(args.handler, args.use_async)
+    elif args.command:
+        command = args.command
+    else:
+        print("replay: backend command or --handler is required", file=sys.stderr)
+        return 2
+    report = replay(command, list(read_requests(args.input)), args.repeat)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print("")
+    else:
+        print(format_report(report))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    record = subparsers.add_parser(
+        "record", help="relay messages to backend and save them")
+    record.add_argument("--output", "-o", required=True)
+    record.add_argument("command", nargs="+", help="backend and its arguments")
+    record.set_defaults(func=command_record)
+
+    generate = subparsers.add_parser(
+        "generate", help="create session with synthetic captures")
+    generate.add_argument("--output", "-o", default="-")
+    generate.add_argument("--captures", type=int, default=100)
+    generate.add_argument("--elements", type=int, default=20)
+    generate.add_argument("--variants", type=int, default=4)
+    generate.set_defaults(func=command_generate)
+
+    replay_parser = subparsers.add_parser(
+        "replay", help="send recorded requests to a backend")
+    replay_parser.add_argument("input", help="recorded or generated session")
+    replay_parser.add_argument(
+        "--handler", help="MODULE:CLASS to run with lr_webextensions loop")
+    replay_parser.add_argument(
+        "--async", dest="use_async", action="store_true",
+        help="use jsonrpc_asyncio loop for --handler")
+    replay_parser.add_argument("--repeat", type=int, default=1)
+    replay_parser.add_argument("--json", action="store_true")
+    replay_parser.add_argument(
+        "command", nargs="*", help="backend and its arguments")
+    replay_parser.set_defaults(func=command_replay)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,382 @@
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Deliver captures in background, keep undelivered ones on disk
+
+A capture request should not wait for Emacs that is busy or is not
+running. ``CaptureQueue.put`` appends the capture to ``CaptureSpool``,
+a log file, and returns as soon as the record is on disk.
+A background thread delivers captures in the order they are received,
+retrying with exponential backoff. Captures that are not delivered
+before exit are delivered by the next process that opens the spool.
+
+Delivery is at-least-once: a capture is delivered again
+if the process is killed before the delivery is recorded.
+A capture rejected by ``deliver`` several times is moved
+to ``PATH.failed``, renaming it to ``PATH.replay`` queues
+its captures again when the spool is opened.
+
+>>> import tempfile
+>>> path = os.path.join(tempfile.mkdtemp(), "captures.log")
+>>> spool = CaptureSpool(path)
+>>> spool.open()
+[]
+>>> for record in ({"id": 1, "url": "a"}, {"id": 2, "url": "b"}, {"done": 1}):
+...     number = spool.append(record)
+>>> spool.sync(number)
+>>> spool.close()
+>>> delivered = []
+>>> queue = CaptureQueue(CaptureSpool(path), delivered.append)
+>>> queue.start()
+>>> queue.put("c")
+3
+>>> queue.wait_idle(5), delivered
+(True, ['b', 'c'])
+>>> queue.close()
+>>> os.path.getsize(path)
+0
+"""
+
+import collections
+import fcntl
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger("lr_webextensions.capture_queue")
+
+#: Seconds before the first retry, it is doubled for next ones
+RETRY_DELAY = 1
+#: Maximal delay between attempts to deliver a capture
+RETRY_DELAY_MAX = 60
+#: Captures failed with non-transient errors are moved to ``PATH.failed``
+#: after attempts
+MAX_ATTEMPTS = 5
+
+
+def default_path(name):
+    """``$XDG_STATE_HOME/linkremark/NAME-captures.log``"""
+    state_dir = os.environ.get("XDG_STATE_HOME") or os.path.expanduser(
+        "~/.local/state")
+    return os.path.join(state_dir, "linkremark", f"{name}-captures.log")
+
+
+class CaptureSpool:
+    """Append-only log of captures and results of their delivery
+
+    Records are JSON lines: ``{"id": 1, "url": ...}`` for a capture,
+    ``{"done": 1}`` or ``{"failed": 1, "error": ...}`` after delivery.
+    Several records appended by concurrent threads are written to disk
+    by a single ``fsync`` call. An incomplete last line left by a crash
+    is ignored. The spool is rewritten atomically to drop delivered
+    captures when it is opened. ``PATH.lock`` prevents access
+    by another process.
+
+    Failed captures are appended to ``PATH.failed`` as
+    ``{"id": 1, "url": ..., "error": ...}``, so they are not lost.
+    Captures from ``PATH.replay``, e.g. renamed ``PATH.failed``,
+    are added to undelivered ones by ``open``.
+
+    >>> import tempfile
+    >>> spool = CaptureSpool(os.path.join(tempfile.mkdtemp(), "captures.log"))
+    >>> spool.open()
+    []
+    >>> spool.sync(spool.append({"id": 1, "url": "a"}))
+    >>> spool.sync(spool.fail(1, "a", "No template"))
+    >>> spool.close()
+    >>> os.rename(spool.failed_path, spool.path + ".replay")
+    >>> spool.open()
+    [(1, 'a')]
+    >>> spool.close()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        #: Dead-letter file for captures that are not delivered
+        self.failed_path = path + ".failed"
+        self._fd = -1
+        self._lock_fd = -1
+        # Counters of written and synced records.
+        self._written = 0
+        self._synced = 0
+        self.sync_count = 0
+        self._lock = threading.Lock()
+        # Held during ``fsync``, waiting threads get their records synced.
+        self._sync_lock = threading.Lock()
+
+    def open(self):
+        """Lock the spool and return undelivered ``[(id, url)]``
+
+        ``BlockingIOError`` is raised if the spool is used by another process.
+        """
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        lock_fd = os.open(
+            self.path + ".lock", os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            pending = self._read_pending()
+            replay_path = self.path + ".replay"
+            replay = self._read_replay(replay_path)
+            next_id = pending[-1][0] + 1 if pending else 1
+            pending.extend(enumerate(replay, next_id))
+            self._rewrite(pending)
+            if replay:
+                # Captures are in the spool, duplicates are possible
+                # only if the process is killed just now.
+                os.unlink(replay_path)
+                logger.warning(
+                    "%d captures from %s are queued again", len(replay), replay_path)
+            fd = os.open(
+                self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC,
+                0o600)
+        except BaseException:
+            os.close(lock_fd)
+            raise
+        with self._lock:
+            self._fd = fd
+            self._lock_fd = lock_fd
+        if pending:
+            logger.info("%d undelivered captures in %s", len(pending), self.path)
+        return pending
+
+    def close(self):
+        with self._lock:
+            for fd in (self._fd, self._lock_fd):
+                if fd >= 0:
+                    os.close(fd)
+            self._fd = self._lock_fd = -1
+
+    def _read_pending(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        pending = {}
+        # The last item is empty or incomplete record.
+        for line in data.split(b"\n")[:-1]:
+            try:
+                record = json.loads(line)
+                if "id" in record:
+                    pending[record["id"]] = record["url"]
+                else:
+                    pending.pop(record.get("done", record.get("failed")), None)
+            except (ValueError, TypeError, KeyError, AttributeError):
+                logger.warning("%s: invalid record %r", self.path, line[:200])
+        return sorted(pending.items())
+
+    def _read_replay(self, path):
+        """URLs from ``path`` having records of ``PATH.failed`` format"""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        urls = []
+        for line in data.split(b"\n"):
+            if not line.strip():
+                continue
+            try:
+                url = json.loads(line)["url"]
+                if not isinstance(url, str):
+                    raise TypeError("url is not a string")
+                urls.append(url)
+            except (ValueError, TypeError, KeyError):
+                logger.warning("%s: invalid record %r", path, line[:200])
+        return urls
+
+    def _rewrite(self, pending):
+        """Replace the spool file with ``pending`` records"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"".join(
+                _encode({"id": item_id, "url": url}) for item_id, url in pending))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        _fsync_directory(os.path.dirname(self.path))
+
+    def append(self, record):
+        """Write ``record``, return its number for ``sync``"""
+        data = _encode(record)
+        with self._lock:
+            if self._fd < 0:
+                raise ValueError("spool is not open")
+            # ``O_APPEND``, the record is written by a single call.
+            written = os.write(self._fd, data)
+            if written != len(data):
+                raise OSError(f"{self.path}: short write")
+            self._written += 1
+            return self._written
+
+    def fail(self, item_id, url, error):
+        """Move capture to ``failed_path``, return number for ``sync``
+
+        The capture is kept in the spool if it is not saved
+        to the dead-letter file.
+        """
+        fd = os.open(
+            self.failed_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC,
+            0o600)
+        try:
+            os.write(fd, _encode({"id": item_id, "url": url, "error": error}))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return self.append({"failed": item_id, "error": error})
+
+    def sync(self, number):
+        """Wait till records up to ``number`` are written to disk"""
+        with self._sync_lock:
+            if self._synced >= number:
+                return
+            with self._lock:
+                target = self._written
+                fd = self._fd
+            os.fsync(fd)
+            self.sync_count += 1
+            self._synced = target
+
+    def truncate(self):
+        """Drop all records when every capture is delivered"""
+        with self._lock:
+            if self._fd >= 0:
+                os.ftruncate(self._fd, 0)
+
+
+def _encode(record):
+    text = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+    return text.encode() + b"\n"
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class CaptureQueue:
+    """Deliver captures saved to ``spool`` using ``deliver(url)``
+
+    Failed delivery is retried with exponential backoff, a new capture
+    triggers an attempt at once. If ``transient(exception)`` is false,
+    the capture is moved to ``spool.failed_path`` after ``MAX_ATTEMPTS``,
+    otherwise it blocks later captures to preserve their order.
+    """
+
+    def __init__(
+            self, spool, deliver, transient=lambda ex: isinstance(ex, OSError),
+            retry_delay=RETRY_DELAY, retry_delay_max=RETRY_DELAY_MAX):
+        self.spool = spool
+        self.deliver = deliver
+        self.transient = transient
+        self.retry_delay = retry_delay
+        self.retry_delay_max = retry_delay_max
+        self._queue = collections.deque()
+        self._next_id = 1
+        self._closed = False
+        self._busy = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """Open the spool and start delivery of undelivered captures"""
+        pending = self.spool.open()
+        with self._cond:
+            self._queue.extend(pending)
+            if pending:
+                self._next_id = pending[-1][0] + 1
+        self._thread = threading.Thread(
+            target=self._run, name="capture-queue", daemon=True)
+        self._thread.start()
+
+    def close(self, timeout=None):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.spool.close()
+
+    def put(self, url):
+        """Save capture to disk, return its ID"""
+        with self._cond:
+            if self._closed:
+                raise ValueError("capture queue is closed")
+            item_id = self._next_id
+            number = self.spool.append({"id": item_id, "url": url})
+            self._next_id += 1
+            self._queue.append((item_id, url))
+            self._cond.notify_all()
+        self.spool.sync(number)
+        return item_id
+
+    def __len__(self):
+        with self._cond:
+            return len(self._queue)
+
+    def wait_idle(self, timeout=None):
+        """Wait till all captures are delivered, return ``False`` on timeout"""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._queue and not self._busy, timeout)
+
+    def _run(self):
+        attempts = 0
+        while True:
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: self._queue or self._closed)
+                if self._closed:
+                    return
+                item_id, url = self._queue[0]
+                self._busy = True
+            error = None
+            try:
+                self.deliver(url)
+                attempts = 0
+            except Exception as ex:
+                attempts += 1
+                if self.transient(ex) or attempts < MAX_ATTEMPTS:
+                    delay = min(
+                        self.retry_delay*2**(attempts - 1), self.retry_delay_max)
+                    logger.warning(
+                        "capture %d: attempt %d failed, retry in %s s: %s",
+                        item_id, attempts, delay, ex)
+                    with self._cond:
+                        # ``put`` interrupts waiting.
+                        self._cond.wait(delay)
+                    continue
+                error = str(ex)
+                attempts = 0
+            with self._cond:
+                self._queue.popleft()
+                try:
+                    if error is None:
+                        self.spool.append({"done": item_id})
+                    else:
+                        self.spool.fail(item_id, url, error)
+                        logger.error(
+                            "capture %d is not delivered, moved to %s: %s: %s",
+                            item_id, self.spool.failed_path, error, url)
+                    if not self._queue:
+                        self.spool.truncate()
+                except (OSError, ValueError):
+                    # The capture may be delivered again after restart.
+                    logger.exception("capture %d: result is not saved", item_id)
@@ -0,0 +1,174 @@
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Long-lived process serving native messaging connections
+
+``serve`` accepts connections on a Unix socket, usually from
+``shim`` processes started by the browser, and processes requests
+using ``jsonrpc_asyncio.loop_async``. The handler, its caches
+and indexes are shared by all connections. The daemon exits when
+there are no connections during ``idle_timeout`` seconds.
+
+>>> import tempfile, threading
+>>> from .native_messaging import encode_message, message_source
+>>> from .shim import connect
+>>> class Handler:
+...     def echo(self, value):
+...         return value
+>>> path = os.path.join(tempfile.mkdtemp(), "test.sock")
+>>> server = threading.Thread(
+...     target=serve, args=(Handler(), path), kwargs={"idle_timeout": 0.2})
+>>> server.start()
+>>> with connect(path) as sock:
+...     sock.sendall(b"".join(encode_message(
+...         {"jsonrpc": "2.0", "id": 1, "method": "echo", "params": [{"value": "hi"}]})))
+...     sock.shutdown(socket.SHUT_WR)
+...     with sock.makefile("rb") as responses:
+...         [response["result"] for response in message_source(responses)]
+['hi']
+>>> server.join()
+>>> os.path.exists(path)
+False
+"""
+
+import asyncio
+import fcntl
+import logging
+import os
+import socket
+import time
+
+from . import jsonrpc_asyncio
+from .jsonrpc import get_dispatcher
+from .shim import IDLE_TIMEOUT
+
+logger = logging.getLogger("lr_webextensions.daemon")
+
+
+def serve(
+        handler, path, idle_timeout=IDLE_TIMEOUT, concurrency=None,
+        chunked=False, stats=None):
+    """Process requests from connections to ``path``
+
+    Return after ``idle_timeout`` seconds without connections.
+    Return ``False`` at once if another daemon is running.
+    ``handler`` is shared by all connections.
+    """
+    lock = _acquire_lock(path)
+    if lock is None:
+        return False
+    try:
+        listener = _listen(path)
+    except BaseException:
+        os.close(lock)
+        raise
+    dispatcher = get_dispatcher(handler)
+    if stats is not None:
+        stats.register(dispatcher)
+    options = {
+        "concurrency": concurrency or jsonrpc_asyncio.CONCURRENCY,
+        "chunked": chunked,
+        "stats": stats,
+    }
+    with listener:
+        asyncio.run(_serve_async(
+            dispatcher, listener, path, lock, idle_timeout, options))
+    return True
+
+
+def _acquire_lock(path):
+    """Lock is held while the socket is accepting connections"""
+    lock = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(lock)
+        return None
+    return lock
+
+
+def _listen(path):
+    # Socket of a crashed daemon.
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(path)
+        listener.listen()
+        listener.setblocking(False)
+    except BaseException:
+        listener.close()
+        raise
+    return listener
+
+
+async def _serve_async(dispatcher, listener, path, lock, idle_timeout, options):
+    event_loop = asyncio.get_running_loop()
+    connections = set()
+    idle_since = time.monotonic()
+
+    def on_done(task):
+        nonlocal idle_since
+        connections.discard(task)
+        if not connections:
+            idle_since = time.monotonic()
+
+    def add(conn):
+        task = event_loop.create_task(
+            _serve_connection(dispatcher, conn, options))
+        connections.add(task)
+        task.add_done_callback(on_done)
+
+    try:
+        while True:
+            if connections:
+                timeout = idle_timeout
+            else:
+                timeout = idle_since + idle_timeout - time.monotonic()
+                if timeout <= 0:
+                    break
+            try:
+                conn, _ = await asyncio.wait_for(
+                    event_loop.sock_accept(listener), timeout)
+            except asyncio.TimeoutError:
+                continue
+            add(conn)
+    finally:
+        # New shims start another daemon, connections that
+        # are already queued are served by this one.
+        os.unlink(path)
+        os.close(lock)
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                break
+            add(conn)
+        if connections:
+            await asyncio.wait(connections)
+
+
+async def _serve_connection(dispatcher, conn, options):
+    conn.setblocking(True)
+    with conn, conn.makefile("rb") as input_file, \
+            conn.makefile("wb") as output_file:
+        try:
+            await jsonrpc_asyncio.loop_async(
+                dispatcher, input_file, output_file,
+                options["concurrency"], chunked=options["chunked"],
+                stats=options["stats"])
+        except OSError:
+            logger.warning("connection failed", exc_info=True)
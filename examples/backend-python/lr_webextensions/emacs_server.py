@@ -0,0 +1,361 @@
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Emacs server protocol client, ``emacsclient --eval`` without a process
+
+A request is a line of space-separated commands, e.g.
+``-dir /home/user/ -current-frame -eval (+&_1&_2)``. Arguments are
+quoted: ``&`` is ``&&``, space is ``&_``, newline is ``&n``, leading
+``-`` is ``&-``. Emacs replies ``-emacs-pid PID``, result of evaluation
+as ``-print`` and ``-print-nonl`` chunks or ``-error MESSAGE``,
+and closes the connection.
+
+The server is a Unix socket (``server-use-tcp`` is ``nil``)
+or a TCP port written to a server file together with the key
+passed as ``-auth``. Locations are the same as for emacsclient:
+``EMACS_SOCKET_NAME``, ``EMACS_SERVER_FILE``,
+``$XDG_RUNTIME_DIR/emacs/server``, ``$TMPDIR/emacsUID/server``.
+
+>>> import tempfile
+>>> path = os.path.join(tempfile.mkdtemp(), "server")
+>>> with FakeEmacsServer(path, lambda form: "6" if form == "(* 2 3)" else "nil"):
+...     EmacsServer(socket_name=path).eval("(* 2 3)")
+'6'
+"""
+
+import errno
+import logging
+import os
+import re
+import socket
+import stat
+import threading
+
+logger = logging.getLogger("lr_webextensions.emacs_server")
+
+#: Seconds to wait for a reply, evaluation should not be interactive
+TIMEOUT = 60
+_BUFFER_SIZE = 64*1024
+_UNQUOTE_RE = re.compile(r"&(.)", re.S)
+_UNQUOTE = {"_": " ", "n": "\n"}
+
+
+class EmacsServerError(Exception):
+    """Emacs replied ``-error``"""
+
+
+class ServerNotRunning(EmacsServerError, OSError):
+    """Socket or server file does not exist or connection is refused"""
+
+
+def quote_argument(text):
+    """Argument as it is sent to Emacs server
+
+    >>> quote_argument("-a b&c\\nd")
+    '&-a&_b&&c&nd'
+    """
+    quoted = text.replace("&", "&&").replace(" ", "&_").replace("\n", "&n")
+    return "&" + quoted if quoted.startswith("-") else quoted
+
+
+def unquote_argument(text):
+    """Inverse of ``quote_argument``
+
+    >>> unquote_argument('&-a&_b&&c&nd')
+    '-a b&c\\nd'
+    """
+    return _UNQUOTE_RE.sub(
+        lambda match: _UNQUOTE.get(match.group(1), match.group(1)), text)
+
+
+def elisp_string(text):
+    """Emacs Lisp string literal
+
+    >>> print(elisp_string('C:\\\\notes\\\\"a".org'))
+    "C:\\\\notes\\\\\\"a\\".org"
+    """
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _default_server_dir():
+    config_home = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    directory = os.path.join(config_home, "emacs", "server")
+    if os.path.isdir(directory):
+        return directory
+    return os.path.expanduser("~/.emacs.d/server")
+
+
+def server_address(socket_name=None, server_file=None):
+    """``(socket.AF_UNIX, path)`` or ``(socket.AF_INET, server_file)``
+
+    Arguments have precedence over environment variables.
+    A relative server file name is in the ``server-auth-dir``.
+    """
+    socket_name = socket_name or os.environ.get("EMACS_SOCKET_NAME")
+    server_file = server_file or os.environ.get("EMACS_SERVER_FILE")
+    if socket_name:
+        if os.sep not in socket_name:
+            socket_name = os.path.join(_default_socket_dirs()[0], socket_name)
+        return socket.AF_UNIX, socket_name
+    if not server_file:
+        for directory in _default_socket_dirs():
+            path = os.path.join(directory, "server")
+            if os.path.exists(path):
+                return socket.AF_UNIX, path
+        server_file = "server"
+        if not os.path.exists(os.path.join(_default_server_dir(), server_file)):
+            # Nothing is running, error is reported for the preferred path.
+            return socket.AF_UNIX, os.path.join(_default_socket_dirs()[0], "server")
+    if os.sep not in server_file:
+        server_file = os.path.join(_default_server_dir(), server_file)
+    return socket.AF_INET, server_file
+
+
+def _default_socket_dirs():
+    result = []
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        result.append(os.path.join(runtime_dir, "emacs"))
+    tmp_dir = os.environ.get("TMPDIR") or "/tmp"
+    result.append(os.path.join(tmp_dir, f"emacs{os.getuid()}"))
+    return result
+
+
+class EmacsServer:
+    """Evaluate forms in a running Emacs
+
+    Server address is resolved on the first request and reused.
+    It is resolved again if connection fails, e.g. Emacs is restarted
+    with another ``server-use-tcp`` value. Every request is a new
+    connection, so concurrent calls from several threads are allowed.
+    """
+
+    def __init__(self, socket_name=None, server_file=None, timeout=TIMEOUT):
+        self.socket_name = socket_name
+        self.server_file = server_file
+        self.timeout = timeout
+        self._address = None
+        # ``(path, inode, mtime_ns): (host, port, auth_key)``
+        self._server_file_cache = None
+        self._lock = threading.Lock()
+
+    def server_id(self):
+        """Server path, its inode, and mtime, they change on restart"""
+        _, path = self._get_address()
+        try:
+            st = os.stat(path)
+        except OSError:
+            return (path,)
+        return path, st.st_ino, st.st_mtime_ns
+
+    def eval(self, form):
+        """Printed result of ``form``, ``emacsclient --eval`` counterpart
+
+        ``socket.timeout`` is raised if Emacs does not reply
+        in ``timeout`` seconds, it is ``TimeoutError`` since Python 3.10.
+        """
+        try:
+            return self._eval(form)
+        except ServerNotRunning:
+            with self._lock:
+                self._address = None
+            return self._eval(form)
+
+    def _eval(self, form):
+        family, path = self._get_address()
+        commands = []
+        if family == socket.AF_UNIX:
+            sock = self._connect_unix(path)
+        else:
+            sock, auth_key = self._connect_tcp(path)
+            commands += ["-auth", auth_key]
+        with sock:
+            commands += [
+                "-dir", quote_argument(os.getcwd().rstrip(os.sep) + os.sep),
+                "-current-frame", "-eval", quote_argument(form)]
+            sock.sendall((" ".join(commands) + "\n").encode("UTF-8"))
+            return self._read_reply(sock, path)
+
+    def _get_address(self):
+        with self._lock:
+            if self._address is None:
+                self._address = server_address(self.socket_name, self.server_file)
+            return self._address
+
+    def _connect_unix(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError as ex:
+            raise ServerNotRunning(ex.errno, "Emacs server socket not found", path)
+        # The same check as in emacsclient, a socket of another user
+        # may be a trap.
+        if st.st_uid != os.getuid() or not stat.S_ISSOCK(st.st_mode):
+            raise EmacsServerError(f"{path} is not a socket owned by the user")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError) as ex:
+            sock.close()
+            raise ServerNotRunning(ex.errno, "Emacs server is not running", path)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def _connect_tcp(self, server_file):
+        host, port, auth_key = self._read_server_file(server_file)
+        try:
+            sock = socket.create_connection((host, port), timeout=self.timeout)
+        except ConnectionRefusedError as ex:
+            raise ServerNotRunning(ex.errno, "Emacs server is not running", server_file)
+        return sock, auth_key
+
+    def _read_server_file(self, server_file):
+        try:
+            st = os.stat(server_file)
+            file_id = (server_file, st.st_ino, st.st_mtime_ns)
+            cache = self._server_file_cache
+            if cache is not None and cache[0] == file_id:
+                return cache[1]
+            with open(server_file) as f:
+                text = f.read()
+        except FileNotFoundError as ex:
+            raise ServerNotRunning(ex.errno, "Emacs server file not found", server_file)
+        # "HOST:PORT PID\nAUTH_KEY"
+        address, _, auth_key = text.partition("\n")
+        host, _, port = address.split(" ", 1)[0].rpartition(":")
+        auth_key = auth_key.strip()
+        if not host or not port.isdigit() or not auth_key:
+            raise EmacsServerError(f"{server_file}: invalid server file")
+        result = host, int(port), auth_key
+        self._server_file_cache = (file_id, result)
+        return result
+
+    @staticmethod
+    def _read_reply(sock, path):
+        chunks = []
+        while True:
+            try:
+                data = sock.recv(_BUFFER_SIZE)
+            except ConnectionResetError as ex:
+                raise ServerNotRunning(ex.errno, "Emacs server closed connection", path)
+            if not data:
+                break
+            chunks.append(data)
+        result = []
+        for line in b"".join(chunks).decode("UTF-8", "replace").split("\n"):
+            command, _, arg = line.partition(" ")
+            if command in ("-print", "-print-nonl"):
+                result.append(unquote_argument(arg))
+            elif command == "-error":
+                raise EmacsServerError(unquote_argument(arg).strip())
+            elif command == "-window-system-unsupported":
+                raise EmacsServerError("Emacs does not support window system")
+            elif command and command not in ("-emacs-pid", "-suspend"):
+                logger.debug("unsupported reply %r", line)
+        return "".join(result)
+
+
+class FakeEmacsServer:
+    """Emacs server for tests, replies ``evaluate(form)`` to ``-eval``
+
+    TCP server is started if ``auth_key`` is specified, ``path``
+    is the server file in this case, otherwise it is a Unix socket.
+    An exception raised by ``evaluate`` is sent as ``-error``.
+    Received commands are stored to ``requests``.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "server")
+    >>> def evaluate(form):
+    ...     raise ValueError(f"Symbol’s value as variable is void: {form}")
+    >>> with FakeEmacsServer(path, evaluate, auth_key="k"*64) as server:
+    ...     try:
+    ...         EmacsServer(server_file=path).eval("no-such-var")
+    ...     except EmacsServerError as ex:
+    ...         print(ex)
+    Symbol’s value as variable is void: no-such-var
+    >>> server.requests[0][:2]
+    ['-auth', 'kkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkkk']
+    """
+
+    def __init__(self, path, evaluate, auth_key=None):
+        self.path = path
+        self.evaluate = evaluate
+        self.auth_key = auth_key
+        self.requests = []
+        if auth_key is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.bind(path)
+        else:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.bind(("127.0.0.1", 0))
+            port = self._sock.getsockname()[1]
+            with open(path, "w") as f:
+                f.write(f"127.0.0.1:{port} {os.getpid()}\n{auth_key}")
+        self._sock.listen()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # ``shutdown`` interrupts ``accept`` in the server thread.
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._thread.join()
+        os.unlink(self.path)
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError as ex:
+                if ex.errno in (errno.EINVAL, errno.EBADF, errno.ECONNABORTED):
+                    return
+                raise
+            with conn:
+                try:
+                    self._handle(conn)
+                except ConnectionError:
+                    # The client gave up waiting for reply.
+                    pass
+
+    def _handle(self, conn):
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = conn.recv(_BUFFER_SIZE)
+            if not chunk:
+                return
+            data += chunk
+        args = data.decode("UTF-8").split()
+        self.requests.append(args)
+        replies = [f"-emacs-pid {os.getpid()}"]
+        if self.auth_key is not None and args[:2] != ["-auth", self.auth_key]:
+            return
+        try:
+            for command, arg in zip(args, args[1:]):
+                if command == "-eval":
+                    result = self.evaluate(unquote_argument(arg))
+                    replies.append("-print " + quote_argument(result))
+        except Exception as ex:
+            replies.append("-error " + quote_argument(str(ex)))
+        conn.sendall("".join(reply + "\n" for reply in replies).encode("UTF-8"))
@@ -0,0 +1,619 @@
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Handler and command line of the ``lr_emacsclient.py`` backend
+
+The script is just an entry point, so the shim started by the browser
+for every connection does not load modules imported here.
+See the script docstring for requirements and Emacs configuration.
+"""
+
+import json
+from http import HTTPStatus
+import logging
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from . import (
+    capture_queue, emacs_server, mentions, mentions_compact, mentions_sqlite, shim,
+    urlkey)
+from .daemon import serve
+from .jsonrpc import CAPABILITY_BATCH, CAPABILITY_CHUNKED, JsonRpcError
+from .jsonrpc_asyncio import loop
+from .stats import Stats
+
+APP_NAME = shim.app_name()
+APP_DESCRIPTION = "LinkRemark interface to emacsclient"
+
+EXTENSION_FIREFOX = "linkremark@maxnikulin.github.io"
+EXTENSION_CHROME = "mgmcoaemjnaehlliifkgljdnbpedihoe"
+
+EMACSCLIENT = "emacsclient"
+#: Environment variable to use emacsclient instead of ``emacs_server``
+EMACSCLIENT_ENV = "LR_EMACSCLIENT"
+#: Environment variable with path of spool for captures in daemon mode
+CAPTURE_SPOOL_ENV = "LR_CAPTURE_SPOOL"
+EMACSCLIENT_ARGS = [
+    "--quiet",
+    # Attempt to discriminate "can't find socket" from other errors
+    # and to suppress excessively verbose error message.
+    # --quiet and --suppress-output does not prevent the following
+    # message if emacs server is not running:
+    #
+    #    emacsclient: No socket or alternate editor.  Please use:
+    #
+    #            --socket-name
+    #            --server-file      (or environment variable EMACS_SERVER_FILE)
+    #            --alternate-editor (or environment variable ALTERNATE_EDITOR)
+    #
+    # The trick with --alternate-editor allows to get minimal message
+    #
+    #     emacsclient: can't find socket; have you started the server?
+    #     To start the server in Emacs, type "M-x server-start".
+    '--alternate-editor=sh -c "exit 9',
+]
+EMACSCLIENT_ENSURE_FRAME = [
+        "--eval", """\
+(if (and (symbolp 'linkremark-ensure-frame) (fboundp 'linkremark-ensure-frame))
+    (linkremark-ensure-frame)
+  (or (memq 'x (mapcar #'framep (frame-list)))
+      (select-frame
+       (make-frame '((name . "LinkRemark") (window-system . x))))))"""]
+# Single emacsclient process for org-protocol check, frame, and capture.
+# The first non-nil clause is the result, so a failed step is reported.
+EMACSCLIENT_CAPTURE = """\
+(cond
+ ((and {check_org_protocol} (not (memq 'org-protocol features)))
+  'linkremark-no-org-protocol)
+ ((condition-case err (progn {ensure_frame} nil)
+    (error (list 'linkremark-frame-error (error-message-string err)))))
+ ((condition-case err
+      (progn (org-protocol-check-filename-for-protocol {uri} nil nil) nil)
+    (error (list 'linkremark-capture-error (error-message-string err)))))
+ (t 'linkremark-captured))"""
+# Single emacsclient process for frame, file, and line.
+EMACSCLIENT_VISIT = """\
+(progn
+  {ensure_frame}
+  (find-file {file})
+  (goto-char (point-min))
+  (forward-line {line})
+  (when (derived-mode-p 'org-mode)
+    (if (fboundp 'org-fold-show-context) (org-fold-show-context) (org-show-context)))
+  (select-frame-set-input-focus (selected-frame))
+  t)"""
+
+USAGE = """\
+Usage: {0} IGNORED_ARGS_PASSED_BY_BROWSER...
+   or: {0} {{--manifest-chrome|--manifest-firefox}} >MANIFEST_DIR/NAME.json
+   or: {0} --daemon
+   or: {0} {{-h|--help}}
+
+  -h, --help    print this message
+  --daemon      process requests from connections to the Unix socket
+                {SOCKET}
+                till there are no connections during {IDLE_TIMEOUT_ENV}
+                seconds. When started by the browser, the application
+                just passes messages to the daemon and starts it
+                if necessary.
+  --manifest-chrome
+  --manifest-firefox
+                print native messaging manifest for Chrome or Firefox.
+                Output should be redirected to NAME.json file where NAME
+                is the same as the similar field in the manifest
+                ({APP_NAME}.json).
+                in a browser-specific directory (system-wide, user,
+                or browser profile configuration), e.g.
+                ~/.mozilla/native-messaging-hosts/{APP_NAME}.json
+                See for details:
+                https://developer.chrome.com/docs/apps/nativeMessaging/#native-messaging-host-location
+                https://developer.mozilla.org/en-US/docs/Mozilla/Add-ons/WebExtensions/Native_manifests
+                https://developer.mozilla.org/en-US/docs/Mozilla/Add-ons/WebExtensions/Native_messaging#app_manifest
+
+Environment:
+  LR_MENTIONS_FILES
+                list of Org files and directories separated by "{PATHSEP}"
+                to search for links to the current page ("urlMentions"
+                capability). Directories are scanned recursively
+                for "*.org" files. Links are saved to
+                $XDG_CACHE_HOME/linkremark/{APP_NAME}-mentions.sqlite
+                and only changed files are parsed again. Without
+                the sqlite3 module, links are kept in memory.
+  LR_MENTIONS_IGNORED_PARAMS
+                comma-separated query parameters that are ignored
+                when URLs are compared, "*" at the end matches any
+                suffix. Default is "{IGNORED_PARAMS}".
+  {EMACSCLIENT_ENV}
+                emacsclient executable to pass requests to Emacs.
+                By default, requests are sent directly to Emacs server
+                socket or to the port from EMACS_SERVER_FILE.
+  {CAPTURE_SPOOL_ENV}
+                file where the daemon saves captures before delivery
+                to Emacs, so a capture is not lost if Emacs is not
+                running. Captures are acknowledged with "queued"
+                status at once. Default is
+                $XDG_STATE_HOME/linkremark/{APP_NAME}-captures.log,
+                empty value means synchronous delivery. Captures
+                rejected by Emacs are moved to the same file with
+                ".failed" suffix. Rename it to ".replay" to queue them
+                again when the daemon is started.
+  LR_STATS_FILE  append request statistics as a JSON line to this file
+                on exit and on SIGUSR1. Statistics are available
+                through "linkremark.stats" method as well.
+  {IDLE_TIMEOUT_ENV}
+                seconds without connections before the daemon exits,
+                default is {IDLE_TIMEOUT}. Set it to 0 to process requests
+                in the process started by the browser.
+"""
+
+
+def run(*args, error_message="", **kwargs):
+    kwargs.setdefault("check", True)
+    # new in Python-3.7
+    if "capture_output" not in kwargs:
+        kwargs.setdefault("stdout", subprocess.PIPE)
+        kwargs.setdefault("stderr", subprocess.PIPE)
+    exe = emacsclient_executable()
+    cmd_args = [exe] + EMACSCLIENT_ARGS + list(args)
+    try:
+        return subprocess.run(cmd_args, **kwargs)
+    except subprocess.SubprocessError as ex:
+        def decoded_attr(obj, attr):
+            value = getattr(obj, attr, None)
+            if isinstance(value, bytes):
+                value = value.decode('UTF-8').strip()
+            return value
+
+        if getattr(ex, "returncode", 1) == 9:
+            logging.error(
+                "emacsclient not running: %s stdout %s, stderr: %s",
+                " ".join(cmd_args),
+                decoded_attr(ex, "stdout"),
+                decoded_attr(ex, "stderr"))
+            message = "Emacs server is not running, please, start it"
+            code = HTTPStatus.BAD_GATEWAY
+            raise JsonRpcError(message, code)
+
+        data = {"command": exe}
+        for attr in ("returncode", "stderr", "stdout"):
+            value = decoded_attr(ex, attr)
+            if value is not None and value != "":
+                data[attr] = value
+        message = (error_message or "External process failed")
+        code = HTTPStatus.INTERNAL_SERVER_ERROR
+        raise JsonRpcError(message, code, data)
+
+
+def eval_in_emacs(form, error_message, server=None):
+    """Evaluate ``form`` in Emacs, return printed result
+
+    ``server`` is ``emacs_server.EmacsServer``, emacsclient
+    process is started if it is ``None``.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "server")
+    >>> logging.disable(logging.WARNING)
+    >>> with emacs_server.FakeEmacsServer(path, lambda form: time.sleep(0.3) or "t"):
+    ...     eval_in_emacs("(sleep-for 0.3)", "Sleep failed",
+    ...                   emacs_server.EmacsServer(path, timeout=0.05))
+    Traceback (most recent call last):
+        ...
+    lr_webextensions.jsonrpc.JsonRpcError: ('Emacs server does not respond', \
+<HTTPStatus.GATEWAY_TIMEOUT: 504>, {'error': 'timed out'})
+    >>> logging.disable(logging.NOTSET)
+    """
+    if server is None:
+        try:
+            res = run("--eval", form, error_message=error_message)
+        except FileNotFoundError:
+            logging.error("emacsclient command not found", exc_info=True)
+            raise JsonRpcError(
+                f"{emacsclient_executable()} is not in PATH",
+                HTTPStatus.INTERNAL_SERVER_ERROR)
+        return res.stdout.decode("UTF-8", "replace").strip()
+    try:
+        return server.eval(form).strip()
+    except emacs_server.ServerNotRunning as ex:
+        logging.error("Emacs server not running: %s", ex)
+        raise JsonRpcError(
+            "Emacs server is not running, please, start it",
+            HTTPStatus.BAD_GATEWAY, {"server": ex.filename})
+    except (TimeoutError, socket.timeout) as ex:
+        # ``socket.timeout`` is not ``TimeoutError`` before Python 3.10.
+        # Emacs may be just busy, queued captures are delivered later.
+        logging.warning("%s: Emacs server does not respond: %s", error_message, ex)
+        raise JsonRpcError(
+            "Emacs server does not respond", HTTPStatus.GATEWAY_TIMEOUT,
+            {"error": str(ex)})
+    except (emacs_server.EmacsServerError, OSError) as ex:
+        logging.error("%s: %s", error_message, ex)
+        raise JsonRpcError(
+            error_message, HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(ex)})
+
+
+def emacsclient_executable():
+    return os.environ.get(EMACSCLIENT_ENV) or EMACSCLIENT
+
+
+def capture_spool():
+    """Spool for captures at ``LR_CAPTURE_SPOOL``, empty value disables it"""
+    path = os.environ.get(CAPTURE_SPOOL_ENV)
+    if path is None:
+        path = capture_queue.default_path(APP_NAME)
+    return capture_queue.CaptureSpool(path) if path else None
+
+
+def is_transient_error(ex):
+    """Emacs is not running or busy, so delivery should be retried"""
+    return isinstance(ex, JsonRpcError) and ex.code in (
+        HTTPStatus.BAD_GATEWAY, HTTPStatus.GATEWAY_TIMEOUT)
+
+
+def emacs_server_client():
+    """Direct connection to Emacs server unless ``LR_EMACSCLIENT`` is set"""
+    if os.environ.get(EMACSCLIENT_ENV):
+        return None
+    return emacs_server.EmacsServer()
+
+
+class OrgProtocolCheck:
+    """Emacs servers where org-protocol is known to be loaded
+
+    The check is repeated after ``ttl`` seconds since the feature
+    may be unloaded.
+
+    >>> check = OrgProtocolCheck(ttl=10, clock=iter([0, 5, 20]).__next__)
+    >>> check.needed("server"), check.passed("server"), check.needed("server")
+    (True, None, False)
+    >>> check.needed("server")
+    True
+    """
+
+    #: Seconds before org-protocol is checked again
+    TTL = 300
+
+    def __init__(self, ttl=TTL, clock=time.monotonic):
+        self.ttl = ttl
+        self._clock = clock
+        # ``server_id: expiration time``
+        self._passed = {}
+        self._lock = threading.Lock()
+
+    def needed(self, server_id):
+        with self._lock:
+            expires = self._passed.get(server_id)
+            if expires is not None and expires > self._clock():
+                return False
+            self._passed.pop(server_id, None)
+            return True
+
+    def passed(self, server_id):
+        with self._lock:
+            self._passed[server_id] = self._clock() + self.ttl
+
+    def failed(self, server_id):
+        with self._lock:
+            self._passed.pop(server_id, None)
+
+
+def elisp_read_string(text):
+    """Value of printed Emacs Lisp string
+
+    >>> elisp_read_string('"No \\\\"org\\\\" \\\\\\\\ here"')
+    'No "org" \\\\ here'
+    """
+    if len(text) < 2 or text[0] != '"' or text[-1] != '"':
+        return text
+    return re.sub(r"\\(.)", r"\1", text[1:-1], flags=re.S)
+
+
+def parse_capture_result(output):
+    """``(status, error_message)`` for result of ``EMACSCLIENT_CAPTURE``
+
+    >>> parse_capture_result('(linkremark-capture-error "No template")')
+    ('linkremark-capture-error', 'No template')
+    >>> parse_capture_result("linkremark-captured")
+    ('linkremark-captured', None)
+    """
+    if output.startswith("(") and output.endswith(")"):
+        status, _, message = output[1:-1].partition(" ")
+        return status, elisp_read_string(message.strip())
+    return output, None
+
+
+def capture_in_emacs(url, org_protocol_check, server=None):
+    """Pass org-protocol ``url`` to Emacs in a single request
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "server")
+    >>> with emacs_server.FakeEmacsServer(
+    ...         path, lambda form: "linkremark-captured") as fake:
+    ...     capture_in_emacs(
+    ...         "org-protocol:/capture?url=https%3A%2F%2Forgmode.org%2F",
+    ...         OrgProtocolCheck(), emacs_server.EmacsServer(path))
+    True
+    >>> "org-protocol-check-filename-for-protocol" in fake.requests[0][-1]
+    True
+    """
+    # emacsclient finds the server at the same location.
+    server_id = (server or emacs_server.EmacsServer()).server_id()
+    check = org_protocol_check.needed(server_id)
+    form = EMACSCLIENT_CAPTURE.format(
+        check_org_protocol="t" if check else "nil",
+        ensure_frame=EMACSCLIENT_ENSURE_FRAME[1],
+        uri=emacs_server.elisp_string(url))
+    output = eval_in_emacs(
+        form, error_message="Capture using org-protocol failed", server=server)
+    status, error = parse_capture_result(output)
+    if status == "linkremark-captured":
+        if check:
+            org_protocol_check.passed(server_id)
+        return True
+    org_protocol_check.failed(server_id)
+    if status == "linkremark-no-org-protocol":
+        logging.error("org-protocol is not loaded: %s", output)
+        raise JsonRpcError(
+            "org-protocol is not loaded",
+            HTTPStatus.INTERNAL_SERVER_ERROR)
+    data = {"output": output}
+    if error is not None:
+        data["error"] = error
+    if status == "linkremark-frame-error":
+        message = "Ensure Emacs frame for capture failed"
+    elif status == "linkremark-capture-error":
+        message = "Open org-protocol URI failed"
+    else:
+        message = "Unexpected result of capture in Emacs"
+    logging.error("%s: %s", message, output)
+    raise JsonRpcError(message, HTTPStatus.INTERNAL_SERVER_ERROR, data)
+
+
+def visit_in_emacs(path, line_no, server=None):
+    """Open ``path`` at ``line_no`` in an Emacs frame"""
+    form = EMACSCLIENT_VISIT.format(
+        ensure_frame=EMACSCLIENT_ENSURE_FRAME[1],
+        file=emacs_server.elisp_string(path), line=line_no - 1)
+    eval_in_emacs(form, error_message="Open file in Emacs failed", server=server)
+    return True
+
+
+# Handler().capture(format='object', version='0.2', data={
+#     'body': 'org-protocol:/capture?url=https%3A%2F%2Forgmode.org%2F&title=Org%20Mode&body=Web%20site',
+# })
+class Handler:
+    """Capture through org-protocol, ``linkremark.*`` if index is specified
+
+    Helper objects are private, so they are not published as methods.
+
+    >>> from lr_webextensions import jsonrpc
+    >>> methods = jsonrpc.Dispatcher(
+    ...     Handler(emacs=emacs_server.EmacsServer())).methods
+    >>> sorted(methods)
+    ['capture', 'hello']
+    >>> "emacs.eval" in methods
+    False
+    """
+    _format = "org-protocol"
+    _version = "0.2"
+    # Published by ``jsonrpc.Dispatcher``, e.g. ``linkremark.urlMentions``.
+    rpc_namespaces = ("linkremark",)
+
+    def __init__(self, mentions_index=None, emacs=None, spool=None):
+        # ``emacs_server.EmacsServer`` or ``None`` for emacsclient process
+        self._emacs = emacs
+        self._org_protocol_check = OrgProtocolCheck()
+        if mentions_index is not None:
+            self.linkremark = mentions.Linkremark(mentions_index, self._visit)
+        # Captures are delivered in background if ``spool`` is specified.
+        self._spool = spool
+        self._capture_queue = None
+        self._capture_queue_lock = threading.Lock()
+        self._get_capture_queue()
+
+    def _get_capture_queue(self):
+        """Started ``CaptureQueue``, ``None`` if the spool is not available"""
+        if self._spool is None:
+            return None
+        with self._capture_queue_lock:
+            if self._capture_queue is None:
+                queue = capture_queue.CaptureQueue(
+                    self._spool, self._deliver, transient=is_transient_error)
+                try:
+                    # Undelivered captures are replayed.
+                    queue.start()
+                except OSError as ex:
+                    # Tried again for the next capture.
+                    logging.warning(
+                        "capture spool %s is not available: %s", self._spool.path, ex)
+                    return None
+                self._capture_queue = queue
+            return self._capture_queue
+
+    def _deliver(self, url):
+        capture_in_emacs(url, self._org_protocol_check, self._emacs)
+
+    def _visit(self, path, line_no):
+        return visit_in_emacs(path, line_no, self._emacs)
+
+    def hello(self, version=None, formats=None):
+        """
+        >>> Handler().hello(
+        ...     formats=[
+        ...         {"format": "object", "version": "0.2"},
+        ...         {"format": "org", "version": "0.2"},
+        ...         {"format": "org-protocol", "version": "0.2"},
+        ...     ],
+        ...     version="0.2",
+        ... );
+        {'format': 'org-protocol', 'version': '0.2', \
+'options': {'clipboardForBody': False}, \
+'capabilities': ['jsonrpcBatch', 'chunkedResponse']}
+        """
+
+        # Extension ID could be obtained from `sys.argv`.
+        if not isinstance(formats, list):
+            return JsonRpcError(
+                "hello: formats are not specified",
+                HTTPStatus.BAD_REQUEST)
+        data = {
+            'format': self._format,
+            'version': self._version,
+            'options': {'clipboardForBody': False},
+            # Both loops are started with ``chunked=True``.
+            'capabilities': [CAPABILITY_BATCH, CAPABILITY_CHUNKED],
+        }
+        if hasattr(self, "linkremark"):
+            data['capabilities'] += [
+                mentions.CAPABILITY, mentions.CAPABILITY_BATCH,
+                mentions.CAPABILITY_PREFIX, mentions.CAPABILITY_VISIT]
+        for descr in formats:
+            if not isinstance(descr, dict):
+                return JsonRpcError(
+                    "hello: format descriptor is not an object",
+                    HTTPStatus.BAD_REQUEST)
+            if descr['format'] == self._format and descr['version'] == self._version:
+                return data
+        return JsonRpcError(
+            "hello: supported format not found",
+            HTTPStatus.NOT_IMPLEMENTED,
+            data)
+
+    # In the case of tab group only the first link is stored.
+    def capture(self, data=None, format=None, version=None, error=None, **kwargs):
+        kwargs.pop("options", None)
+        if kwargs:
+            return JsonRpcError(
+                "capture: unsupported fields",
+                HTTPStatus.BAD_REQUEST, {"fields": list(kwargs.keys())})
+
+        format_error = self._check_format_version(data, format, version)
+        if format_error:
+            return format_error
+        if error:
+            return {"preview": True, "status": "preview"}
+        queue = self._get_capture_queue()
+        if queue is not None:
+            try:
+                queue.put(data["url"])
+                return {"preview": False, "status": "queued"}
+            except (OSError, ValueError):
+                logging.exception("capture is not queued, delivering it now")
+        if capture_in_emacs(data["url"], self._org_protocol_check, self._emacs):
+            return {"preview": False, "status": "success"}
+        else:
+            return {"preview": True, "status": "preview"}
+
+    def _check_format_version(self, data, format, version):
+        if format != self._format or version != self._version:
+            return JsonRpcError(
+                "capture: unsupported format",
+                HTTPStatus.NOT_IMPLEMENTED, {
+                    'expected': {
+                        'format': self._format, 'version': self._version
+                    },
+                    'received': {
+                        'format': format, 'version': version
+                    }
+                })
+        if not isinstance(data, dict) or not isinstance(data.get("url"), str):
+            return JsonRpcError(
+                'capture: data is not an Object with "url" String field',
+                HTTPStatus.BAD_REQUEST, data)
+        return None
+
+
+def mentions_index():
+    """Index of files from ``LR_MENTIONS_FILES`` saved in the user cache"""
+    value = os.environ.get("LR_MENTIONS_FILES", "")
+    paths = [path for path in value.split(os.pathsep) if path]
+    if not paths:
+        return None
+    value = os.environ.get("LR_MENTIONS_IGNORED_PARAMS")
+    denylist = urlkey.DENYLIST if value is None else [
+        name.strip() for name in value.split(",") if name.strip()]
+    canonicalizer = urlkey.UrlCanonicalizer(denylist)
+    if mentions_sqlite.sqlite3 is None:
+        return mentions_compact.CompactUrlIndex(
+            paths, canonicalizer=canonicalizer)
+    return mentions_sqlite.SqliteUrlIndex(
+        paths, mentions_sqlite.default_path(APP_NAME),
+        canonicalizer=canonicalizer)
+
+
+def exe_realpath():
+    return os.path.realpath(sys.argv[0])
+
+
+def manifest_chrome():
+    manifest = {
+        "name": APP_NAME,
+        "description": APP_DESCRIPTION,
+        "path": exe_realpath(),
+        "type": "stdio",
+        "allowed_origins": [f"chrome-extension://{EXTENSION_CHROME}/"],
+    }
+    json.dump(manifest, sys.stdout, indent=2)
+    print("")
+
+
+def manifest_firefox():
+    manifest = {
+        "name": APP_NAME,
+        "description": APP_DESCRIPTION,
+        "path": exe_realpath(),
+        "type": "stdio",
+        "allowed_extensions": [EXTENSION_FIREFOX],
+    }
+    json.dump(manifest, sys.stdout, indent=2)
+    print("")
+
+
+def main(description=__doc__):
+    """Run as ``lr_emacsclient.py`` script with ``sys.argv`` options"""
+    # argparse is intentionally avoided here to avoid
+    # risk of excessively clever actions.
+    arg = sys.argv[1] if len(sys.argv) > 1 else None
+    if arg == "-h" or arg == "-help" or arg == "--help":
+        print(USAGE.format(
+            *sys.argv, APP_NAME=APP_NAME,
+            SOCKET=f"$XDG_RUNTIME_DIR/linkremark/{APP_NAME}.sock",
+            IDLE_TIMEOUT=shim.IDLE_TIMEOUT,
+            IDLE_TIMEOUT_ENV=shim.IDLE_TIMEOUT_ENV, PATHSEP=os.pathsep,
+            IGNORED_PARAMS=",".join(urlkey.DENYLIST),
+            EMACSCLIENT_ENV=EMACSCLIENT_ENV,
+            CAPTURE_SPOOL_ENV=CAPTURE_SPOOL_ENV))
+        print(description)
+    elif arg == "--manifest-chrome" or arg == "-manifest-chrome":
+        manifest_chrome()
+    elif arg == "--manifest-firefox" or arg == "-manifest-firefox":
+        manifest_firefox()
+    elif arg == "--daemon" or arg == "-daemon":
+        stats = Stats()
+        stats.install(os.environ.get("LR_STATS_FILE"))
+        serve(
+            Handler(mentions_index(), emacs_server_client(), capture_spool()),
+            shim.socket_path(APP_NAME),
+            shim.idle_timeout() or shim.IDLE_TIMEOUT, chunked=True, stats=stats)
+    else:
+        stats = Stats()
+        stats.install(os.environ.get("LR_STATS_FILE"))
+        loop(
+            Handler(mentions_index(), emacs_server_client()),
+            chunked=True, stats=stats)
+
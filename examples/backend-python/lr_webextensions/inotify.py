@@ -0,0 +1,178 @@
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Minimal Linux inotify binding to notice changes in note files
+
+``DirectoryWatcher`` reports files changed since the previous call
+without blocking. ``None`` is returned when the set of changes
+is unknown (queue overflow, new directory), so the caller should
+check all files. ``DirectoryWatcher.create`` returns ``None``
+if inotify is not available.
+
+>>> import tempfile
+>>> directory = tempfile.mkdtemp()
+>>> watcher = DirectoryWatcher.create([directory])
+>>> watcher is None or watcher.changes() == set()
+True
+>>> with open(os.path.join(directory, "a.org"), "w") as f:
+...     _ = f.write("* A")
+>>> watcher is None or watcher.changes() == {os.path.join(directory, "a.org")}
+True
+"""
+
+import ctypes
+import errno
+import logging
+import os
+import struct
+import sys
+
+logger = logging.getLogger("lr_webextensions.inotify")
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+#: Events that may change content of a file or a directory
+WATCH_MASK = (
+    IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    | IN_DELETE_SELF | IN_ONLYDIR)
+
+_EVENT = struct.Struct("iIII")
+_READ_SIZE = 64*1024
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class DirectoryWatcher:
+    """Watch directories recursively
+
+    Create instances using ``create``.
+    """
+
+    def __init__(self, libc, fd):
+        self._libc = libc
+        self._fd = fd
+        self._directories = {}
+
+    @classmethod
+    def create(cls, trees=(), directories=()):
+        """Watch ``trees`` recursively and just ``directories``"""
+        libc = _load_libc()
+        if libc is None:
+            return None
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logger.warning(
+                "inotify_init1: %s", os.strerror(ctypes.get_errno()))
+            return None
+        watcher = cls(libc, fd)
+        try:
+            for directory in trees:
+                watcher.add_tree(directory)
+            for directory in directories:
+                watcher.add(directory)
+        except OSError:
+            logger.warning("inotify is not used", exc_info=True)
+            watcher.close()
+            return None
+        return watcher
+
+    def add_tree(self, directory):
+        """Watch ``directory`` and its subdirectories except hidden ones"""
+        for path, subdirs, _files in os.walk(directory):
+            subdirs[:] = [d for d in subdirs if not d.startswith(".")]
+            self.add(path)
+
+    def add(self, directory):
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), directory)
+        self._directories[wd] = directory
+
+    def changes(self):
+        """Paths changed since the previous call, ``None`` if unknown"""
+        result = set()
+        complete = True
+        while True:
+            try:
+                data = os.read(self._fd, _READ_SIZE)
+            except BlockingIOError:
+                break
+            except OSError as ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                raise
+            if not data:
+                break
+            for wd, mask, name in self._parse(data):
+                if mask & IN_Q_OVERFLOW:
+                    complete = False
+                    continue
+                directory = self._directories.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_IGNORED:
+                    # Directory is removed.
+                    del self._directories[wd]
+                    complete = False
+                    continue
+                path = os.path.join(directory, name) if name else directory
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        try:
+                            self.add_tree(path)
+                        except OSError:
+                            logger.warning("watch of %s failed", path, exc_info=True)
+                    complete = False
+                    continue
+                result.add(path)
+        return result if complete else None
+
+    @staticmethod
+    def _parse(data):
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
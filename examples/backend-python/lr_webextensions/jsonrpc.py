@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import inspect
 import logging
 import sys
 from typing import Dict, Any
@@ -30,8 +31,16 @@ METHOD_KEY = 'method'
 PARAMS_KEY = 'params'
 INVALID_REQUEST = -32600
 METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
 INTERNAL_ERROR = -32603
 
+#: Add it to ``capabilities`` in response to ``hello``
+#: to inform the extension that requests may be sent as a batch (array)
+CAPABILITY_BATCH = 'jsonrpcBatch'
+#: Large responses are split into chunks, see ``native_messaging.iter_chunks``.
+#: Pass ``chunked=True`` to ``loop`` if this capability is announced.
+CAPABILITY_CHUNKED = 'chunkedResponse'
+
 go_net_rpc_jsonrpc_compat = True
 
 logger = logging.getLogger("lr_webextensions.jsonrpc")
@@ -59,98 +68,351 @@ class JsonRpcError(Exception):
             code=self.code, message=self.message, data=self.data)
 
 
-def loop(handler, input_file=sys.stdin.buffer, output_file=sys.stdout.buffer):
-    for message in native_messaging.message_source(input_file):
+class Method:
+    """Handler method with cached signature details
+
+    Allows to check if ``params`` fit the method without calling it
+    and without ``TypeError`` exceptions.
+    """
+    __slots__ = (
+        'name', 'func', 'is_coroutine', 'positional', 'required_positional',
+        'var_positional', 'keywords', 'required_keywords', 'var_keyword',
+        'required_keyword_only')
+
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+        self.is_coroutine = inspect.iscoroutinefunction(func)
+        try:
+            parameters = inspect.signature(func).parameters.values()
+        except (TypeError, ValueError):
+            # Builtins may have no signature, accept anything.
+            parameters = None
+        self.positional = 0
+        self.required_positional = 0
+        self.var_positional = parameters is None
+        self.keywords = frozenset()
+        self.required_keywords = frozenset()
+        self.var_keyword = parameters is None
+        self.required_keyword_only = False
+        if parameters is None:
+            return
+        keywords = set()
+        required_keywords = set()
+        for param in parameters:
+            required = param.default is inspect.Parameter.empty
+            if param.kind is inspect.Parameter.VAR_POSITIONAL:
+                self.var_positional = True
+            elif param.kind is inspect.Parameter.VAR_KEYWORD:
+                self.var_keyword = True
+            elif param.kind is inspect.Parameter.KEYWORD_ONLY:
+                keywords.add(param.name)
+                if required:
+                    required_keywords.add(param.name)
+                    self.required_keyword_only = True
+            else:
+                self.positional += 1
+                if required:
+                    self.required_positional += 1
+                if param.kind is inspect.Parameter.POSITIONAL_OR_KEYWORD:
+                    keywords.add(param.name)
+                    if required:
+                        required_keywords.add(param.name)
+                elif required:
+                    # Positional-only argument can not be passed by name.
+                    required_keywords.add(None)
+        self.keywords = frozenset(keywords)
+        self.required_keywords = frozenset(required_keywords)
+
+    def check_params(self, args, kwargs):
+        """Return description of the problem or ``None`` if params fit
+
+        >>> method = Method('f', lambda a, b=1, *, c=2: None)
+        >>> method.check_params([1], {}), method.check_params([], {'a': 1})
+        (None, None)
+        >>> method.check_params([1, 2, 3], {})
+        'Too many positional arguments'
+        >>> method.check_params([], {'d': 1})
+        'Unexpected named arguments'
+        """
+        if kwargs:
+            if not self.var_keyword and not self.keywords.issuperset(kwargs):
+                return 'Unexpected named arguments'
+            if not self.required_keywords.issubset(kwargs):
+                return 'Missed required arguments'
+            return None
+        if len(args) < self.required_positional:
+            return 'Missed required arguments'
+        if len(args) > self.positional and not self.var_positional:
+            return 'Too many positional arguments'
+        if self.required_keyword_only:
+            return 'Missed required arguments'
+        return None
+
+
+class Dispatcher:
+    """Map of method names to handler methods built once
+
+    Public (not starting with underscore) methods of ``handler``
+    are RPC methods. Attributes listed in ``rpc_namespaces``
+    class attribute are namespaces, e.g. ``linkremark.urlMentions``
+    is ``handler.linkremark.urlMentions``. Other attributes,
+    such as helper objects, are not published and properties
+    are not evaluated.
+
+    >>> class Linkremark:
+    ...     def urlMentions(self, variants):
+    ...         return {"total": len(variants)}
+    >>> class Server:
+    ...     def eval(self, form):
+    ...         return form
+    >>> class Handler:
+    ...     rpc_namespaces = ("linkremark",)
+    ...     linkremark = Linkremark()
+    ...     server = Server()
+    ...     def hello(self, version=None, formats=None):
+    ...         return {}
+    ...     @property
+    ...     def state(self):
+    ...         raise RuntimeError("must not be evaluated")
+    >>> sorted(Dispatcher(Handler()).methods)
+    ['hello', 'linkremark.urlMentions']
+    """
+
+    def __init__(self, handler, max_depth=4):
+        self.handler = handler
+        self.methods = {}
+        self._add_namespace(handler, "", max_depth, set())
+
+    def add_method(self, name, func):
+        """Register a method that is not an attribute of the handler"""
+        self.methods[name] = Method(name, func)
+
+    def _add_namespace(self, obj, prefix, depth, visited):
+        if depth <= 0 or id(obj) in visited:
+            return
+        visited.add(id(obj))
+        namespaces = getattr(type(obj), "rpc_namespaces", ())
+        for attr in dir(obj):
+            if attr.startswith('_'):
+                continue
+            name = prefix + attr
+            if attr in namespaces:
+                value = getattr(obj, attr, None)
+                if value is not None:
+                    self._add_namespace(value, name + '.', depth - 1, visited)
+                continue
+            if isinstance(inspect.getattr_static(obj, attr, None), property):
+                continue
+            value = getattr(obj, attr, None)
+            if inspect.isroutine(value):
+                self.methods[name] = Method(name, value)
+
+
+def get_dispatcher(handler):
+    """Loops call it once, ``process`` with a raw handler builds table per call"""
+    return handler if isinstance(handler, Dispatcher) else Dispatcher(handler)
+
+
+def loop(
+        handler, input_file=sys.stdin.buffer, output_file=sys.stdout.buffer,
+        chunked=False, stats=None):
+    """Process requests one by one till end of input
+
+    ``stats`` is ``stats.Stats`` instance to measure processing time.
+    """
+    dispatcher = get_dispatcher(handler)
+    if stats is not None:
+        stats.register(dispatcher)
+    reader = native_messaging.FrameReader(input_file)
+    writer = native_messaging.FrameWriter(output_file, chunked=chunked)
+    while True:
+        frame = reader.read_frame()
+        if frame is None:
+            break
+        sample = stats.new_sample(len(frame)) if stats is not None else None
+        message = reader.decode(frame)
+        if sample is not None:
+            sample.decode = sample.lap()
         result = None
         try:
-            result = process(handler, message)
-            native_messaging.send_message(output_file, result)
+            result = process(dispatcher, message, sample)
+            frames = writer.encode(result)
         except Exception:
-            message = "exception while processing request"
-            logger.exception(message, exc_info=True)
+            error = "exception while processing request"
+            logger.exception(error, exc_info=True)
             result = make_error(
-                request_id=result.get('id', None) if result else None,
-                code=INTERNAL_ERROR, message=message)
-            native_messaging.send_message(output_file, result)
-
-
-def process(handler, message: Dict[str, Any]) -> Dict[str, Any]:
+                request_id=get_request_id(message),
+                code=INTERNAL_ERROR, message=error)
+            frames = writer.encode(result)
+            if sample is not None:
+                sample.error = True
+        if sample is not None:
+            sample.encode = sample.lap()
+            if isinstance(frames, list):
+                sample.response_size = len(frames[1])
+            stats.add(sample)
+        writer.write_frames(frames)
+        if writer.closed:
+            logger.info("output is closed, exiting")
+            break
+
+
+def process(handler, message, sample=None):
+    """Call handler method and return response
+
+    A batch (list of requests) is processed sequentially,
+    see ``jsonrpc_asyncio.process`` for parallel execution.
+    ``sample`` is ``stats.Sample`` to record time of stages.
+
+    >>> class Handler:
+    ...     def add(self, a, b):
+    ...         return a + b
+    >>> [response.get('result') for response in process(Handler(), [
+    ...     {'jsonrpc': '2.0', 'id': 1, 'method': 'add', 'params': [1, 2]},
+    ...     {'jsonrpc': '2.0', 'id': 2, 'method': 'add', 'params': [3, 4]},
+    ... ])]
+    [3, 7]
+    """
+    dispatcher = get_dispatcher(handler)
+    if isinstance(message, list):
+        batch_error = check_batch(message)
+        if batch_error is not None:
+            return batch_error
+        return [
+            process_single(
+                dispatcher, item, sample.child() if sample is not None else None)
+            for item in message]
+    return process_single(dispatcher, message, sample)
+
+
+def process_single(dispatcher, message: Dict[str, Any], sample=None) -> Dict[str, Any]:
+    response, call = prepare_call(dispatcher, message)
+    if call is None:
+        if sample is not None:
+            sample.dispatch = sample.lap()
+            sample.error = True
+        return response
+    request_id, log_id, method, entry, args, kwargs = call
+    if sample is not None:
+        sample.method = method
+        sample.dispatch = sample.lap()
+    try:
+        result = entry.func(*args, **kwargs)
+        response = make_result_response(request_id, result)
+    except Exception as ex:
+        response = make_exception_response(request_id, log_id, method, ex)
+    if sample is not None:
+        sample.handler = sample.lap()
+        sample.error = ERROR_KEY in response
+    return response
+
+
+def prepare_call(dispatcher, message: Dict[str, Any]):
+    """Validate request and find method
+
+    Return ``(response, None)`` if request is invalid, otherwise
+    ``(None, (request_id, log_id, method, entry, args, kwargs))``
+    where ``entry`` is ``Method`` from ``dispatcher``.
+    Split from ``process`` to share request validation with other loops.
+    """
     if not isinstance(message, dict):
         error = f'Expected dict (Object), got {type(message)}'
         logger.warning(error)
-        return make_invalid_request_response(None, {'type': error})
+        return make_invalid_request_response(None, {'type': error}), None
 
     request_id = message.get(ID_KEY)
-    log_id = [message[key] for key in [ID_KEY, METHOD_KEY] if key in message]
-    missed = [
-            key for key in [JSONRPC_KEY, ID_KEY, METHOD_KEY]
-            if key not in message]
-    if len(missed) > 0:
+    if JSONRPC_KEY not in message or ID_KEY not in message or METHOD_KEY not in message:
+        log_id = _get_log_id(message)
+        missed = [
+                key for key in [JSONRPC_KEY, ID_KEY, METHOD_KEY]
+                if key not in message]
         error = "Required fields are missed"
         logger.warning("request %r: %s: %s", log_id, error, missed)
         return make_invalid_request_response(
-            request_id, {'type': error, 'arg': missed})
+            request_id, {'type': error, 'arg': missed}), None
 
+    method = message[METHOD_KEY]
+    log_id = [request_id, method]
     version = message[JSONRPC_KEY]
     if version != JSONRPC_VERSION:
         error = f'JSON-RPC version must be {JSONRPC_VERSION}'
         logger.warning('request %r: %s got: %r', log_id, error, version)
         return make_invalid_request_response(
-            request_id, {'type': error, 'arg': version})
+            request_id, {'type': error, 'arg': version}), None
 
-    method = message[METHOD_KEY]
-    method_handler = handler
-    for attr in method.split('.'):
-        if not attr:
+    entry = dispatcher.methods.get(method) if isinstance(method, str) else None
+    if entry is None:
+        if isinstance(method, str) and '' in method.split('.'):
             error = 'Empty method component'
             logger.warning('request %r: %s', log_id, error)
-            return make_invalid_request_response(request_id, {'type': error})
-        if attr.startswith('_') or not hasattr(method_handler, attr):
-            logger.warning('request %r: method not found', log_id)
-            return make_method_not_found(request_id, method)
-        method_handler = getattr(method_handler, attr)
+            return make_invalid_request_response(
+                request_id, {'type': error}), None
+        logger.warning('request %r: method not found', log_id)
+        return make_method_not_found(request_id, method), None
+
+    params = message.get(PARAMS_KEY)
+    if go_net_rpc_jsonrpc_compat and isinstance(params, list) and len(params) == 1:
+        params = params[0]
+    if params is None:
+        args, kwargs = (), {}
+    elif isinstance(params, dict):
+        args, kwargs = (), params
+    elif isinstance(params, list):
+        args, kwargs = params, {}
+    else:
+        error = "params is neither Object nor Array"
+        logger.warning("request %r: %s: %s", log_id, error, type(params))
+        return make_invalid_request_response(
+                request_id, {'type': error, 'arg': str(type(params))}), None
 
-    if not callable(method_handler):
-        logger.warning('request %r: method not callable', log_id)
-        return make_method_not_found(request_id, method)
+    error = entry.check_params(args, kwargs)
+    if error is not None:
+        logger.warning("request %r: %s", log_id, error)
+        return make_invalid_params_response(request_id, {'type': error}), None
 
-    try:
-        result = None
-        params = message.get(PARAMS_KEY)
-        if go_net_rpc_jsonrpc_compat and isinstance(params, list) and len(params) == 1:
-            params = params[0]
-        if params is None:
-            result = method_handler()
-        elif isinstance(params, dict):
-            result = method_handler(**params)
-        elif isinstance(params, list):
-            result = method_handler(*params)
-        else:
-            error = "params is neither Object nor Array"
-            logger.warning("request %r: %s: %s", log_id, error, type(params))
-            return make_invalid_request_response(
-                    request_id, {'type': error, 'arg': str(type(params))})
+    return None, (request_id, log_id, method, entry, args, kwargs)
+
+
+def _get_log_id(message):
+    return [message[key] for key in [ID_KEY, METHOD_KEY] if key in message]
+
+
+def check_batch(message):
+    """Return error response for empty batch, otherwise ``None``
+
+    >>> check_batch([])['error']['message']
+    'Invalid Request'
+    """
+    if len(message) == 0:
+        error = 'Empty batch'
+        logger.warning(error)
+        return make_invalid_request_response(None, {'type': error})
+    return None
 
-        if isinstance(result, JsonRpcError):
-            return result.make_response(request_id)
 
-        return make_response(request_id, result)
+def get_request_id(message):
+    return message.get(ID_KEY) if isinstance(message, dict) else None
 
-    except JsonRpcError as ex:
+
+def make_result_response(request_id, result):
+    if isinstance(result, JsonRpcError):
+        return result.make_response(request_id)
+    return make_response(request_id, result)
+
+
+def make_exception_response(request_id, log_id, method, ex):
+    if isinstance(ex, JsonRpcError):
         response = ex.make_response(request_id)
         logger.error("%s: %r", method, response)
         return response
 
-    except Exception:
-        error = 'Exception while calling handler'
-        logger.exception('request %r: %s', log_id, error, exc_info=True)
-        return make_error(
-            request_id=request_id, code=INTERNAL_ERROR, message=error)
-
-    error = 'Internal error, code should be unreachable'
-    logger.error('request %r: %s', log_id, error)
+    error = 'Exception while calling handler'
+    logger.error(
+        'request %r: %s', log_id, error,
+        exc_info=(type(ex), ex, ex.__traceback__))
     return make_error(
-            request_id=request_id, code=INTERNAL_ERROR, message=error)
+        request_id=request_id, code=INTERNAL_ERROR, message=error)
 
 
 # Spec 5
@@ -176,6 +438,10 @@ def make_invalid_request_response(request_id, data):
     return make_error(request_id, INVALID_REQUEST, "Invalid Request", data)
 
 
+def make_invalid_params_response(request_id, data):
+    return make_error(request_id, INVALID_PARAMS, "Invalid params", data)
+
+
 def make_method_not_found(request_id, method):
     return make_error(request_id, METHOD_NOT_FOUND, "Method not found", {
         'name': method
@@ -0,0 +1,272 @@
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Concurrent JSON-RPC loop for native messaging backends
+
+Variant of ``jsonrpc.loop`` that does not wait for completion
+of a request before reading the next one. Responses are written
+as soon as they are ready, so they may be sent in the order
+different from the order of requests. The extension matches
+responses to requests by ``id``.
+
+Handler methods may be either coroutine functions or plain functions.
+Plain functions are called in a thread pool, so blocking calls,
+e.g. ``subprocess.run``, do not delay other requests.
+
+>>> import io
+>>> from .native_messaging import encode_message, message_source
+>>> class Handler:
+...     async def slow(self):
+...         await asyncio.sleep(0.05)
+...         return "slow"
+...     def fast(self):
+...         return "fast"
+>>> requests = io.BytesIO()
+>>> for request_id, method in ((1, "slow"), (2, "fast")):
+...     _ = requests.write(b"".join(encode_message(
+...         {"jsonrpc": "2.0", "id": request_id, "method": method})))
+>>> _ = requests.seek(0)
+>>> output = io.BytesIO()
+>>> loop(Handler(), requests, output)
+>>> _ = output.seek(0)
+>>> [response["id"] for response in message_source(output)]
+[2, 1]
+
+>>> batch = [
+...     {"jsonrpc": "2.0", "id": 3, "method": "slow"},
+...     {"jsonrpc": "2.0", "id": 4, "method": "fast"}]
+>>> [response["result"] for response in asyncio.run(process(Handler(), batch))]
+['slow', 'fast']
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import inspect
+import logging
+import sys
+from typing import Dict, Any
+
+from . import native_messaging
+from .jsonrpc import (
+    ERROR_KEY, INTERNAL_ERROR, check_batch, get_dispatcher, get_request_id, make_error,
+    make_exception_response, make_result_response, prepare_call)
+
+#: Default limit of requests processed simultaneously
+CONCURRENCY = 8
+
+logger = logging.getLogger("lr_webextensions.jsonrpc_asyncio")
+
+_EOF = object()
+
+
+class ResponseQueue:
+    """Write responses, ones ready at the same time are coalesced
+
+    Responses are encoded immediately, so errors are reported
+    for particular request, but written to ``writer`` when the event loop
+    has nothing more to do in the current iteration. Writes may block
+    if the peer does not read, so they are performed in order
+    by ``write_executor`` having a single thread.
+    """
+
+    def __init__(self, writer, write_executor, coalesce=True, stats=None):
+        self.writer = writer
+        self._write_executor = write_executor
+        self._coalesce = coalesce
+        self._stats = stats
+        self._frames = []
+        # Completed when ``_frames`` are written.
+        self._written = None
+
+    def put(self, response, sample=None):
+        """Encode ``response``, return a future completed when it is written"""
+        frames = self.writer.encode(response)
+        if sample is not None:
+            sample.encode = sample.lap()
+            if isinstance(frames, list):
+                sample.response_size = len(frames[1])
+            self._stats.add(sample)
+        if not isinstance(frames, list):
+            # Chunked response is encoded while it is written.
+            self.flush()
+            return self._write(frames)
+        if not self._coalesce:
+            return self._write(frames)
+        if self._written is None:
+            event_loop = asyncio.get_running_loop()
+            self._written = event_loop.create_future()
+            event_loop.call_soon(self.flush)
+        self._frames.extend(frames)
+        return self._written
+
+    def flush(self):
+        """Start writing of coalesced responses, return a future"""
+        frames, self._frames = self._frames, []
+        written, self._written = self._written, None
+        if not frames:
+            result = asyncio.get_running_loop().create_future()
+            result.set_result(not self.writer.closed)
+            return result
+        result = self._write(frames)
+        if written is not None:
+            result.add_done_callback(functools.partial(_copy_result, written))
+        return result
+
+    def _write(self, frames):
+        return asyncio.get_running_loop().run_in_executor(
+            self._write_executor, self.writer.write_frames, frames)
+
+
+def _copy_result(target, source):
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def loop(
+        handler, input_file=sys.stdin.buffer, output_file=sys.stdout.buffer,
+        concurrency=CONCURRENCY, coalesce=True, chunked=False, stats=None):
+    """Read requests and write responses till end of input"""
+    asyncio.run(loop_async(
+        handler, input_file, output_file, concurrency, coalesce, chunked,
+        stats))
+
+
+async def loop_async(
+        handler, input_file=sys.stdin.buffer, output_file=sys.stdout.buffer,
+        concurrency=CONCURRENCY, coalesce=True, chunked=False, stats=None):
+    event_loop = asyncio.get_running_loop()
+    dispatcher = get_dispatcher(handler)
+    if stats is not None:
+        stats.register(dispatcher)
+    semaphore = asyncio.Semaphore(concurrency)
+    pending = set()
+    # Input is read in a dedicated thread to avoid dependency
+    # on platform-specific support of pipes in asyncio.
+    # The same pool runs plain (not coroutine) handler methods.
+    with ThreadPoolExecutor(max_workers=concurrency + 1) as executor, \
+            ThreadPoolExecutor(max_workers=1) as write_executor:
+        queue = ResponseQueue(
+            native_messaging.FrameWriter(output_file, chunked=chunked),
+            write_executor, coalesce, stats)
+        read = functools.partial(
+            _read_message, native_messaging.FrameReader(input_file), stats)
+        try:
+            while True:
+                # Do not read requests that can not be processed yet.
+                await semaphore.acquire()
+                message, sample = await event_loop.run_in_executor(
+                    executor, read)
+                if message is _EOF or queue.writer.closed:
+                    semaphore.release()
+                    break
+                task = event_loop.create_task(_process_and_send(
+                    dispatcher, message, sample, queue, executor, semaphore))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        finally:
+            if pending:
+                await asyncio.wait(pending)
+            await queue.flush()
+
+
+def _read_message(reader, stats):
+    frame = reader.read_frame()
+    if frame is None:
+        return _EOF, None
+    sample = stats.new_sample(len(frame)) if stats is not None else None
+    message = reader.decode(frame)
+    if sample is not None:
+        sample.decode = sample.lap()
+    return message, sample
+
+
+async def process(handler, message, executor=None, sample=None):
+    """Coroutine counterpart of ``jsonrpc.process``
+
+    Plain methods of ``handler`` are called using ``executor``,
+    default executor of the event loop if it is ``None``.
+    Requests from a batch are processed in parallel,
+    responses are returned in the same order.
+    """
+    dispatcher = get_dispatcher(handler)
+    if isinstance(message, list):
+        batch_error = check_batch(message)
+        if batch_error is not None:
+            return batch_error
+        return list(await asyncio.gather(*(
+            process_single(
+                dispatcher, item, executor,
+                sample.child() if sample is not None else None)
+            for item in message)))
+    return await process_single(dispatcher, message, executor, sample)
+
+
+async def process_single(
+        dispatcher, message: Dict[str, Any], executor=None,
+        sample=None) -> Dict[str, Any]:
+    response, call = prepare_call(dispatcher, message)
+    if call is None:
+        if sample is not None:
+            sample.dispatch = sample.lap()
+            sample.error = True
+        return response
+    request_id, log_id, method, entry, args, kwargs = call
+    if sample is not None:
+        sample.method = method
+        sample.dispatch = sample.lap()
+    try:
+        if entry.is_coroutine:
+            result = await entry.func(*args, **kwargs)
+        else:
+            result = await asyncio.get_running_loop().run_in_executor(
+                executor, functools.partial(entry.func, *args, **kwargs))
+            if inspect.isawaitable(result):
+                result = await result
+        response = make_result_response(request_id, result)
+    except Exception as ex:
+        response = make_exception_response(request_id, log_id, method, ex)
+    if sample is not None:
+        sample.handler = sample.lap()
+        sample.error = ERROR_KEY in response
+    return response
+
+
+async def _process_and_send(
+        dispatcher, message, sample, queue, executor, semaphore):
+    result = None
+    try:
+        result = await process(dispatcher, message, executor, sample)
+        # Requests are not read while responses are not written.
+        await queue.put(result, sample)
+    except Exception:
+        error = "exception while processing request"
+        logger.exception(error, exc_info=True)
+        result = make_error(
+            request_id=get_request_id(message),
+            code=INTERNAL_ERROR, message=error)
+        try:
+            if sample is not None and sample.encode is None:
+                sample.error = True
+                await queue.put(result, sample)
+            else:
+                await queue.put(result)
+        except Exception:
+            logger.exception("error response is not written")
+    finally:
+        semaphore.release()
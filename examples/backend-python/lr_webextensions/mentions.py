@@ -0,0 +1,1031 @@
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Links from Org mode files for ``linkremark.urlMentions`` requests
+
+The extension sends URL variants of the current page (canonical URL,
+``og:url``, etc.) and displays files, headings, and lines where these
+URLs are mentioned. ``UrlIndex`` is an inverted index from normalized
+URL to links in note files, so a query is a few ``dict`` lookups.
+Keys of URLs are computed by ``urlkey.UrlCanonicalizer``, so links
+to ``http://www.orgmode.org/`` are found for ``https://orgmode.org``.
+Only changed files are parsed again, see ``UrlIndex.refresh``.
+
+Add ``Linkremark`` instance as the ``linkremark`` attribute of a handler
+and add ``CAPABILITY`` and ``CAPABILITY_BATCH`` to ``capabilities``
+in response to ``hello``.
+
+>>> org_file = parse_org("notes.org", '''\\
+... * Org Mode :emacs:
+... See [[https://orgmode.org/][Org]] and https://orgmode.org/manual/.
+... ''')
+>>> index = UrlIndex()
+>>> index.add(org_file)
+>>> mentions = index.mentions(["http://www.OrgMode.org"])
+>>> mentions["total"], mentions["children"][0]["path"]
+(1, 'notes.org')
+>>> mentions["children"][0]["children"][0]["title"]
+'Org Mode'
+>>> mentions["children"][0]["children"][0]["children"]
+[{'_type': 'Link', 'lineNo': 2, 'url': 'https://orgmode.org/', 'descr': 'Org'}]
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import base64
+import bisect
+import hashlib
+import heapq
+from http import HTTPStatus
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import time
+
+from .inotify import DirectoryWatcher
+from .jsonrpc import JsonRpcError
+from .native_messaging import MESSAGE_SIZE_LIMIT
+from .urlkey import UrlCanonicalizer
+
+logger = logging.getLogger("lr_webextensions.mentions")
+
+#: Add it to ``capabilities`` in response to ``hello``
+CAPABILITY = "urlMentions"
+#: ``linkremark.urlMentionsBatch`` is supported
+CAPABILITY_BATCH = "urlMentionsBatch"
+#: ``linkremark.visit`` is supported
+CAPABILITY_VISIT = "visit"
+#: ``linkremark.urlPrefixMentions`` is supported
+CAPABILITY_PREFIX = "urlPrefixMentions"
+#: Links in a response, the rest are just counted in ``total``
+LIMIT = 200
+#: Maximal ``limit`` that may be requested
+MAX_LIMIT = 5000
+#: Orders of links, the first one is the default. "mtime" is recently
+#: modified files first, "depth" is links under top level headings first.
+ORDERS = ("path", "mtime", "depth")
+#: Bytes of links in a response, the rest is for JSON-RPC fields
+RESPONSE_BUDGET = MESSAGE_SIZE_LIMIT - 64*1024
+#: Sub-prefixes in response to ``linkremark.urlPrefixMentions``
+PREFIX_LIMIT = 100
+#: Files with these extensions are indexed when a directory is specified
+EXTENSIONS = (".org",)
+#: Changed files are parsed by a process pool if their size exceeds it
+PARALLEL_MIN_BYTES = 8*1024*1024
+
+_HEADING_RE = re.compile(r"^(\*+)[ \t]+(.*?)(?:[ \t]+:[\w@#%:]+:)?[ \t]*$")
+# Org escapes brackets and backslashes in link targets by backslash.
+_BRACKET_LINK_RE = re.compile(
+    r"\[\[((?:[^\[\]\\]|\\.)+)\](?:\[((?:[^\[\]]|\[[^\[\]]*\])+)\])?\]")
+_PLAIN_LINK_RE = re.compile(r"\b[a-zA-Z][a-zA-Z0-9+.-]*://[^\s<>\[\]\"']+")
+_UNESCAPE_RE = re.compile(r"\\([\[\]\\])")
+_TRAILING_PUNCTUATION = ".,;:!?'\""
+# Longer titles, URLs, and descriptions are truncated in responses.
+_FIELD_LIMIT = 16*1024
+# Greater than any character, end of range of strings with a prefix.
+_MAX_CHAR = "\U0010ffff"
+# Host in a URL key, port and path follow it.
+_HOST_RE = re.compile(r"[^:/?#]*")
+# Next component of a key after a host or a path prefix.
+_HOST_COMPONENT_RE = re.compile(r".[^./?#:]*")
+_PATH_COMPONENT_RE = re.compile(r".[^/?#]*")
+# Types of sort key items for every order.
+_SORT_KEY_TYPES = {
+    "path": (str, int),
+    "mtime": (int, str, int),
+    "depth": (int, str, int),
+}
+
+
+#: Key of URL with default options of ``UrlCanonicalizer``
+url_key = UrlCanonicalizer().key
+
+
+def prefix_key(key):
+    """Key with reversed labels of host
+
+    Keys of a site and its subdomains are adjacent when sorted.
+    The function is inverse to itself.
+
+    >>> prefix_key("//docs.python.org/3/library")
+    '//org.python.docs/3/library'
+    >>> prefix_key(prefix_key("ftp://example.org:2121/a"))
+    'ftp://example.org:2121/a'
+    """
+    start = key.find("//")
+    if start < 0:
+        return key
+    start += 2
+    end = _HOST_RE.match(key, start).end()
+    return key[:start] + ".".join(reversed(key[start:end].split("."))) + key[end:]
+
+
+def _prefix_url(prefix):
+    """Key with reversed host as URL to display"""
+    key = prefix_key(prefix)
+    return "https:" + key if key.startswith("//") else key
+
+
+def _is_host_only(prefix):
+    start = prefix.find("//")
+    return start >= 0 and not any(
+        char in prefix[start + 2:] for char in "/?#")
+
+
+def _next_component(rest, host_only):
+    """Part of ``rest`` up to the next separator of labels or segments"""
+    if rest[0] in "?#":
+        return rest
+    regex = _HOST_COMPONENT_RE if host_only else _PATH_COMPONENT_RE
+    return regex.match(rest).group()
+
+
+class OrgFile:
+    """Headings and links of a file
+
+    ``headings`` is a list of ``(line_no, title, level)``, ``links`` is a list
+    of ``(key, url, line_no, heading_index, descr)`` where ``heading_index``
+    is ``-1`` for links before the first heading. ``signature``
+    and ``digest`` of content are used to detect changes,
+    see ``file_signature``.
+    """
+    __slots__ = ("path", "headings", "links", "signature", "digest")
+
+    def __init__(self, path):
+        self.path = path
+        self.headings = []
+        self.links = []
+        self.signature = None
+        self.digest = None
+
+
+def file_signature(status):
+    """File is reparsed if modification time, size, or inode changes"""
+    return (status.st_mtime_ns, status.st_size, status.st_ino)
+
+
+def extract_links(line):
+    """Yield ``(url, descr)`` for bracket and plain links having "://"
+
+    >>> list(extract_links(r"[[https://a.org/\\[1\\]][A]] <https://b.org/x>, c"))
+    [('https://a.org/[1]', 'A'), ('https://b.org/x', None)]
+    """
+    end = 0
+    for match in _BRACKET_LINK_RE.finditer(line):
+        yield from _plain_links(line[end:match.start()])
+        end = match.end()
+        target = _UNESCAPE_RE.sub(r"\1", match.group(1))
+        if "://" in target:
+            yield target, match.group(2)
+    yield from _plain_links(line[end:])
+
+
+def _plain_links(text):
+    if "://" not in text:
+        return
+    for match in _PLAIN_LINK_RE.finditer(text):
+        url = match.group(0).rstrip(_TRAILING_PUNCTUATION)
+        if url.endswith(")") and url.count("(") < url.count(")"):
+            url = url[:-1]
+        yield url, None
+
+
+def parse_org(path, text, key=url_key):
+    org_file = OrgFile(path)
+    heading_index = -1
+    for line_no, line in enumerate(text.splitlines(), 1):
+        if line.startswith("*"):
+            match = _HEADING_RE.match(line)
+            if match:
+                org_file.headings.append(
+                    (line_no, match.group(2), len(match.group(1))))
+                heading_index = len(org_file.headings) - 1
+        if "://" not in line:
+            continue
+        for url, descr in extract_links(line):
+            org_file.links.append(
+                (key(url), url, line_no, heading_index, descr))
+    return org_file
+
+
+def read_file(path):
+    """Return ``signature``, ``digest``, and content of the file"""
+    with open(path, "rb") as f:
+        # Changes during reading are noticed next time.
+        signature = file_signature(os.fstat(f.fileno()))
+        data = f.read()
+    return signature, hashlib.blake2b(data, digest_size=16).digest(), data
+
+
+def index_file(path, digest=None, key=url_key):
+    """Parse the file unless its content has ``digest``
+
+    Return ``(signature, digest, size, headings, links)`` where
+    ``headings`` and ``links`` are tuples or ``None`` if content
+    is not changed. Return ``None`` if the file can not be read.
+    Tuples of strings and numbers are cheap to send from a worker
+    process in contrast to ``OrgFile`` objects.
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile("w", suffix=".org") as f:
+    ...     _ = f.write("* A\\nhttps://orgmode.org/")
+    ...     f.flush()
+    ...     result = index_file(f.name)
+    ...     index_file(f.name, result[1])[3:]
+    ...     result[3:]
+    (None, None)
+    (((1, 'A', 1),), (('//orgmode.org', 'https://orgmode.org/', 2, 0, None),))
+    """
+    try:
+        signature, new_digest, data = read_file(path)
+    except OSError as ex:
+        logger.warning("skipping %s: %s", path, ex)
+        return None
+    if new_digest == digest:
+        return signature, new_digest, len(data), None, None
+    org_file = parse_org(path, data.decode("utf-8", errors="replace"), key)
+    return (
+        signature, new_digest, len(data),
+        tuple(org_file.headings), tuple(org_file.links))
+
+
+# Key function of a worker process, see ``_init_worker``.
+_worker_key = None
+
+
+def _init_worker(canonicalizer):
+    global _worker_key
+    _worker_key = canonicalizer.key
+
+
+def _index_file_in_worker(task):
+    return index_file(*task, _worker_key)
+
+
+def expand_paths(paths):
+    """Files from ``paths``, directories are scanned recursively"""
+    result = []
+    for path in paths:
+        path = os.path.expanduser(path)
+        if not os.path.isdir(path):
+            result.append(path)
+            continue
+        for directory, subdirs, files in os.walk(path):
+            subdirs[:] = sorted(d for d in subdirs if not d.startswith("."))
+            result.extend(
+                os.path.join(directory, name) for name in sorted(files)
+                if _is_note_file(name))
+    return result
+
+
+def _is_note_file(name):
+    return name.endswith(EXTENSIONS) and not name.startswith(".")
+
+
+class BaseUrlIndex:
+    """Tracking of changes in note files for ``UrlIndex`` and similar stores
+
+    ``refresh`` reparses only files changed since the previous call.
+    Changes are obtained from inotify on Linux, otherwise ``(mtime,
+    size, inode)`` of every file is checked at most once per
+    ``poll_interval`` seconds. A file is not parsed if its content
+    is the same despite of changed ``mtime``. Links and queries
+    are mapped to keys by ``canonicalizer``.
+
+    Files are parsed by a pool of ``workers`` processes when changed
+    files are large, e.g. on the first scan. Results are applied
+    in the order of paths, so the index is the same as built
+    by a single process.
+
+    Derived classes store postings and implement ``replace``,
+    ``indexed_paths``, ``get_state``, ``set_signature``, and ``lookup_keys``.
+    """
+    #: Default seconds between checks of all files without inotify
+    POLL_INTERVAL = 2
+
+    def __init__(
+            self, paths=(), watch=True, poll_interval=POLL_INTERVAL,
+            canonicalizer=None, workers=None):
+        self.paths = [os.path.abspath(os.path.expanduser(p)) for p in paths]
+        self.canonicalizer = canonicalizer or UrlCanonicalizer()
+        self.poll_interval = poll_interval
+        self.workers = workers or os.cpu_count() or 1
+        self._watch = watch
+        self._watcher = None
+        self._last_scan = None
+        # Only one thread reads files.
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def watching(self):
+        """Changes are obtained from inotify"""
+        return self._watcher is not None
+
+    def add(self, org_file):
+        self.replace(org_file.path, org_file)
+
+    def refresh(self, full=False):
+        """Reparse changed files, return their number
+
+        ``full`` forces check of all files.
+        """
+        with self._refresh_lock:
+            changes = None
+            if self._last_scan is None:
+                self._start_watcher()
+            elif not full and self._watcher is not None:
+                changes = self._watcher.changes()
+            elif not full and (
+                    time.monotonic() - self._last_scan < self.poll_interval):
+                return 0
+            if changes is not None:
+                return self._update(sorted(
+                    path for path in changes if self._is_indexed(path)))
+            paths = expand_paths(self.paths)
+            count = 0
+            for path in sorted(set(self.indexed_paths()).difference(paths)):
+                self.replace(path, None)
+                count += 1
+            count += self._update(paths)
+            self._last_scan = time.monotonic()
+            return count
+
+    def _start_watcher(self):
+        if not self._watch:
+            return
+        trees = [path for path in self.paths if os.path.isdir(path)]
+        directories = {
+            os.path.dirname(path) for path in self.paths
+            if not os.path.isdir(path)}
+        # Created before the first scan to catch changes during it.
+        self._watcher = DirectoryWatcher.create(trees, directories)
+
+    def _is_indexed(self, path):
+        if path in self.paths or self.get_state(path) is not None:
+            return True
+        return _is_note_file(os.path.basename(path)) and any(
+            path.startswith(tree + os.sep) for tree in self.paths)
+
+    def _update(self, paths):
+        """Parse changed files from ``paths``, return their number"""
+        count = 0
+        tasks = []
+        size = 0
+        for path in paths:
+            state = self.get_state(path)
+            try:
+                status = os.stat(path)
+            except FileNotFoundError:
+                if state is not None:
+                    self.replace(path, None)
+                    count += 1
+                continue
+            except OSError as ex:
+                logger.warning("skipping %s: %s", path, ex)
+                continue
+            if state is None or state[0] != file_signature(status):
+                tasks.append((path, None if state is None else state[1]))
+                size += status.st_size
+        if not tasks:
+            return count
+        start = time.monotonic()
+        workers = self.workers if size >= PARALLEL_MIN_BYTES else 1
+        results = None
+        if workers > 1:
+            try:
+                results = self._index_parallel(tasks, workers)
+            except (BrokenProcessPool, OSError):
+                logger.warning("parsing by single process", exc_info=True)
+                workers = 1
+        if results is None:
+            key = self.canonicalizer.key
+            results = (index_file(path, digest, key) for path, digest in tasks)
+        parsed = 0
+        size = 0
+        for (path, _), result in zip(tasks, results):
+            if result is None:
+                continue
+            signature, digest, file_size, headings, links = result
+            if headings is None:
+                self.set_signature(path, signature)
+                continue
+            org_file = OrgFile(path)
+            org_file.headings = headings
+            org_file.links = links
+            org_file.signature = signature
+            org_file.digest = digest
+            self.replace(path, org_file)
+            parsed += 1
+            size += file_size
+        elapsed = max(time.monotonic() - start, 1e-6)
+        (logger.info if workers > 1 else logger.debug)(
+            "parsed %d files %.1f MB in %.2f s by %d processes: "
+            "%.0f files/s %.1f MB/s",
+            parsed, size/1e6, elapsed, workers,
+            parsed/elapsed, size/elapsed/1e6)
+        return count + parsed
+
+    def _index_parallel(self, tasks, workers):
+        # Threads of the process are not inherited by "spawn".
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+                workers, context, _init_worker, (self.canonicalizer,)) as pool:
+            # List is necessary to shut down the pool.
+            return list(pool.map(
+                _index_file_in_worker, tasks,
+                chunksize=max(1, len(tasks)//(workers*8))))
+
+    def indexed_paths(self):
+        raise NotImplementedError()
+
+    def get_state(self, path):
+        """``(signature, digest)`` of the indexed file or ``None``"""
+        raise NotImplementedError()
+
+    def set_signature(self, path, signature):
+        raise NotImplementedError()
+
+    def replace(self, path, org_file):
+        """Replace postings for ``path``, remove them if ``org_file`` is ``None``"""
+        raise NotImplementedError()
+
+    def lookup_keys(self, keys, limit=LIMIT, order=ORDERS[0], after=None):
+        """``{key: (count, rows)}`` for every of ``keys``
+
+        ``count`` is the number of links having the key. ``rows``
+        are at most ``limit`` links with the least sort keys greater
+        than ``after``, see ``sort_key`` and ``make_mentions``.
+        Every row is ``(sort_key, path, url, line_no, heading, descr)``.
+        """
+        raise NotImplementedError()
+
+    def prefix_counts(self, prefix):
+        """Iterable of ``(prefix_key, count)`` for keys starting with ``prefix``
+
+        See ``prefix_key``.
+        """
+        raise NotImplementedError()
+
+    def prefix_mentions(self, url, limit=PREFIX_LIMIT, budget=RESPONSE_BUDGET):
+        """Number of links under ``url`` grouped by sub-prefixes
+
+        A site includes its subdomains. ``children`` are at most
+        ``limit`` most popular sub-prefixes, next host labels or path
+        segments, ``exact`` is the number of links to ``url`` itself.
+        Long prefixes are truncated and ``children`` are cut to fit
+        into ``budget`` bytes of JSON, ``truncated`` is true then.
+
+        >>> index = UrlIndex()
+        >>> index.add(parse_org("a.org", '''\\
+        ... https://docs.python.org/3/library/os.html
+        ... https://docs.python.org/3/library/os.html#os.stat
+        ... https://docs.python.org/3/library/re.html
+        ... https://docs.python.org/3/library
+        ... https://docs.python.org/3/library-x
+        ... https://www.python.org/
+        ... '''))
+        >>> index.prefix_mentions("https://docs.python.org/3/library/")
+        {'prefix': 'https://docs.python.org/3/library', 'total': 4, 'exact': 1, \
+'children': [{'_type': 'Prefix', 'prefix': 'https://docs.python.org/3/library/os.html', \
+'total': 2}, {'_type': 'Prefix', 'prefix': 'https://docs.python.org/3/library/re.html', \
+'total': 1}], 'more': False, 'truncated': False}
+        >>> site = index.prefix_mentions("python.org")
+        >>> site["total"], site["exact"], site["children"][0]["prefix"]
+        (6, 1, 'https://docs.python.org')
+        >>> site = index.prefix_mentions("python.org", budget=120)
+        >>> len(site["children"]), site["more"], site["truncated"]
+        (0, True, True)
+        """
+        key = self.canonicalizer.key(url if "//" in url else "https://" + url)
+        prefix = prefix_key(key)
+        host_only = _is_host_only(prefix)
+        separators = "./?#:" if host_only else "/?#"
+        total = exact = 0
+        children = {}
+        for pkey, count in self.prefix_counts(prefix):
+            rest = pkey[len(prefix):]
+            if not rest:
+                exact += count
+            elif rest[0] in separators:
+                child = prefix + _next_component(rest, host_only)
+                children[child] = children.get(child, 0) + count
+            else:
+                continue
+            total += count
+        top = heapq.nsmallest(
+            limit, children.items(), key=lambda item: (-item[1], item[0]))
+        result = {
+            "prefix": _truncate(_prefix_url(prefix)),
+            "total": total,
+            "exact": exact,
+            "children": [],
+            "more": False,
+            "truncated": False,
+        }
+        size = _json_size(result)
+        for child, count in top:
+            item = {
+                "_type": "Prefix", "prefix": _truncate(_prefix_url(child)),
+                "total": count}
+            # Comma separator.
+            size += _json_size(item) + 1
+            if size > budget:
+                result["truncated"] = True
+                break
+            result["children"].append(item)
+        result["more"] = len(children) > len(result["children"])
+        return result
+
+    def mentions(
+            self, variants, limit=LIMIT, order=ORDERS[0], cursor=None,
+            budget=RESPONSE_BUDGET):
+        """Result of ``linkremark.urlMentions``
+
+        If there are more links, the result has ``cursor`` to obtain
+        the next page.
+        """
+        return self.mentions_batch([(variants, cursor)], limit, order, budget)[0]
+
+    def mentions_batch(
+            self, queries, limit=LIMIT, order=ORDERS[0],
+            budget=RESPONSE_BUDGET):
+        """``mentions`` for every ``(variants, cursor)`` item of ``queries``
+
+        Every key is looked up once. Queries with the same keys
+        share the result object. Results are truncated to fit into
+        ``budget`` bytes of JSON.
+
+        >>> index = UrlIndex()
+        >>> index.add(parse_org("a.org", "https://orgmode.org/"))
+        >>> index.add(parse_org("b.org", "* B\\nhttp://orgmode.org"))
+        >>> a, b, c = index.mentions_batch([
+        ...     (["https://orgmode.org/"], None), (["https://gnu.org/"], None),
+        ...     (["http://www.orgmode.org"], None)], limit=1)
+        >>> a["total"], a["filtered"], b["total"], a is c
+        (2, 1, 0, True)
+        >>> index.mentions(["https://orgmode.org/"], cursor=a["cursor"])["children"]
+        [{'_type': 'File', 'path': 'b.org', 'children': [{'_type': 'Heading', \
+'lineNo': 1, 'title': 'B', 'children': [{'_type': 'Link', 'lineNo': 2, \
+'url': 'http://orgmode.org'}]}]}]
+        """
+        key = self.canonicalizer.key
+        queries = [
+            (tuple(dict.fromkeys(key(variant) for variant in variants)),
+             decode_cursor(cursor, order) if cursor else None)
+            for variants, cursor in queries]
+        keys_after = {}
+        for keys, after in queries:
+            keys_after.setdefault(after, {}).update(dict.fromkeys(keys))
+        found = {}
+        for after, keys in keys_after.items():
+            # Extra row tells that there is the next page.
+            for key, value in self.lookup_keys(keys, limit + 1, order, after).items():
+                found[key, after] = value
+        # Shared results are repeated in JSON.
+        query_budget = budget // max(len(queries), 1)
+        results = {}
+        for query in queries:
+            if query in results:
+                continue
+            keys, after = query
+            total = sum(found[key, after][0] for key in keys)
+            # A link has the only key, so links are not repeated.
+            rows = list(itertools.islice(heapq.merge(
+                *(found[key, after][1] for key in keys), key=_first), limit + 1))
+            more = len(rows) > limit
+            count = _fit_rows(rows[:limit], total, query_budget)
+            more = more or count < len(rows)
+            del rows[count:]
+            result = results[query] = make_mentions(
+                (row[1:] for row in rows), total)
+            if more:
+                last = rows[-1][0] if rows else after or ()
+                result["cursor"] = encode_cursor(order, last)
+        return [results[query] for query in queries]
+
+
+class UrlIndex(BaseUrlIndex):
+    """Map of URL keys to ``{OrgFile: link_indices}`` postings in memory
+
+    Postings of a file are replaced under a lock, so a lookup sees
+    either old or new state of the file.
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> path = os.path.join(directory, "a.org")
+    >>> with open(path, "w") as f:
+    ...     _ = f.write("https://orgmode.org/")
+    >>> index = UrlIndex([directory], poll_interval=0)
+    >>> index.refresh(), index.mentions(["https://orgmode.org/"])["total"]
+    (1, 1)
+    >>> with open(path, "w") as f:
+    ...     _ = f.write("https://orgmode.org/ https://orgmode.org/manual/")
+    >>> index.refresh(), index.mentions(["https://orgmode.org/manual/"])["total"]
+    (1, 1)
+    >>> index.refresh()
+    0
+    """
+
+    def __init__(
+            self, paths=(), watch=True,
+            poll_interval=BaseUrlIndex.POLL_INTERVAL, canonicalizer=None,
+            workers=None):
+        super().__init__(paths, watch, poll_interval, canonicalizer, workers)
+        self.files = {}
+        self.postings = {}
+        # Sorted ``prefix_key`` of ``postings`` keys.
+        self.prefix_keys = []
+        # ``prefix_key: postings`` to count links under a prefix.
+        self._prefix_postings = {}
+        # Lookups and changes of postings.
+        self._lock = threading.Lock()
+
+    def indexed_paths(self):
+        return list(self.files)
+
+    def get_state(self, path):
+        org_file = self.files.get(path)
+        return None if org_file is None else (org_file.signature, org_file.digest)
+
+    def set_signature(self, path, signature):
+        self.files[path].signature = signature
+
+    def replace(self, path, org_file):
+        with self._lock:
+            old = self.files.pop(path, None)
+            if old is not None:
+                # Other files mentioning the same URLs are not touched.
+                for key in {link[0] for link in old.links}:
+                    postings = self.postings[key]
+                    del postings[old]
+                    if not postings:
+                        del self.postings[key]
+                        pkey = prefix_key(key)
+                        del self._prefix_postings[pkey]
+                        del self.prefix_keys[
+                            bisect.bisect_left(self.prefix_keys, pkey)]
+            if org_file is None:
+                return
+            self.files[path] = org_file
+            for key, link_indices in _group_links(org_file).items():
+                postings = self.postings.get(key)
+                if postings is None:
+                    postings = self.postings[key] = {}
+                    pkey = prefix_key(key)
+                    self._prefix_postings[pkey] = postings
+                    bisect.insort(self.prefix_keys, pkey)
+                postings[org_file] = link_indices
+
+    def prefix_counts(self, prefix):
+        with self._lock:
+            start = bisect.bisect_left(self.prefix_keys, prefix)
+            end = bisect.bisect_left(self.prefix_keys, prefix + _MAX_CHAR, start)
+            prefix_postings = self._prefix_postings
+            return [
+                (pkey, sum(map(len, prefix_postings[pkey].values())))
+                for pkey in self.prefix_keys[start:end]]
+
+    def lookup_keys(self, keys, limit=LIMIT, order=ORDERS[0], after=None):
+        with self._lock:
+            postings = {
+                key: list(self.postings.get(key, {}).items()) for key in keys}
+        # Files are not modified after parsing, so rows are built unlocked.
+        return {
+            key: (
+                sum(len(link_indices) for _, link_indices in items),
+                _top_rows(items, limit, order, after))
+            for key, items in postings.items()}
+
+
+def sort_key(order, path, mtime_ns, level, link_index):
+    """Links are sorted by this key, it is unique for a link in a file
+
+    ``level`` is depth of the heading of the link, ``0`` if there
+    is no heading.
+
+    >>> sort_key("mtime", "a.org", 1600000000000000000, 2, 5)
+    (-1600000000000000000, 'a.org', 5)
+    """
+    if order == "mtime":
+        return (-mtime_ns, path, link_index)
+    elif order == "depth":
+        return (level, path, link_index)
+    return (path, link_index)
+
+
+def encode_cursor(order, key):
+    """Cursor to obtain links after ``key``
+
+    >>> cursor = encode_cursor("path", ("a.org", 5))
+    >>> decode_cursor(cursor, "path")
+    ('a.org', 5)
+    """
+    data = json.dumps([order, *key], ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8", "surrogatepass")).decode()
+
+
+def decode_cursor(cursor, order):
+    """Sort key of the last link of the previous page
+
+    Raise ``ValueError`` if the cursor is malformed or the order differs.
+    """
+    try:
+        value = json.loads(base64.urlsafe_b64decode(cursor).decode(
+            "utf-8", "surrogatepass"))
+    except (TypeError, ValueError) as ex:
+        raise ValueError(f"invalid cursor: {ex}") from ex
+    types = _SORT_KEY_TYPES[order]
+    if not isinstance(value, list) or not value or value[0] != order:
+        raise ValueError("cursor is obtained for another order")
+    key = tuple(value[1:])
+    if key and (len(key) != len(types) or not all(
+            type(item) is item_type for item, item_type in zip(key, types))):
+        raise ValueError("invalid cursor")
+    # Empty key is the start.
+    return key or None
+
+
+def _first(row):
+    return row[0]
+
+
+def _top_rows(postings, limit, order, after):
+    """Rows with the least sort keys greater than ``after``
+
+    The full list of links is not built, ``heapq.nsmallest``
+    keeps ``limit`` items.
+    """
+    if order == "depth":
+        candidates = (
+            row for org_file, link_indices in postings
+            for row in _file_rows(org_file, link_indices, order, after))
+        return heapq.nsmallest(limit, candidates, key=_first)
+    # Sort keys of links in a file start with the same items,
+    # so only first files are necessary. Links of the file
+    # of ``after`` may be on the previous page.
+    file_order = _file_order(order)
+    if after is not None:
+        postings = (
+            item for item in postings if file_order(item[0]) >= after[:-1])
+    files = heapq.nsmallest(
+        limit + 1, postings, key=lambda item: file_order(item[0]))
+    return list(itertools.islice(itertools.chain.from_iterable(
+        _file_rows(org_file, link_indices, order, after)
+        for org_file, link_indices in files), limit))
+
+
+def _file_order(order):
+    if order == "mtime":
+        return lambda org_file: (-_mtime_ns(org_file), org_file.path)
+    return lambda org_file: (org_file.path,)
+
+
+def _mtime_ns(org_file):
+    return org_file.signature[0] if org_file.signature else 0
+
+
+def _file_rows(org_file, link_indices, order, after):
+    path = org_file.path
+    mtime_ns = _mtime_ns(org_file)
+    for link_index in link_indices:
+        _, url, line_no, heading_index, descr = org_file.links[link_index]
+        heading = org_file.headings[heading_index] if heading_index >= 0 else None
+        key = sort_key(
+            order, path, mtime_ns, heading[2] if heading else 0, link_index)
+        if after is not None and key <= after:
+            continue
+        yield key, path, url, line_no, heading and heading[:2], descr
+
+
+def _fit_rows(rows, total, budget):
+    """Number of first ``rows`` that fit into ``budget`` bytes of JSON"""
+    # Escaped characters take up to 6 bytes.
+    estimate = sum(
+        128 + 6*(len(path) + len(url) + len(descr or "")
+                 + (len(heading[1]) if heading else 0))
+        for _, path, url, _, heading, descr in rows)
+    if estimate <= budget:
+        return len(rows)
+
+    def size(count):
+        return _json_size(
+            make_mentions((row[1:] for row in rows[:count]), total))
+
+    low, high = 0, len(rows)
+    while low < high:
+        middle = (low + high + 1)//2
+        if size(middle) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _json_size(value):
+    """Bytes of compact JSON, the same as sent by ``native_messaging``"""
+    return len(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode(
+        "utf-8", "surrogatepass"))
+
+
+def make_mentions(rows, total):
+    """Tree of ``File``, ``Heading`` and ``Link`` items
+
+    ``rows`` are ``(path, url, line_no, heading, descr)`` where ``heading``
+    is ``(line_no, title)`` or ``None``.
+    """
+    file_items = {}
+    count = 0
+    for path, url, line_no, heading, descr in rows:
+        count += 1
+        file_item = file_items.get(path)
+        if file_item is None:
+            file_item = file_items[path] = {
+                "_type": "File", "path": path, "children": [],
+                "_headings": {}}
+        parent = file_item
+        if heading is not None:
+            parent = file_item["_headings"].get(heading[0])
+            if parent is None:
+                parent = file_item["_headings"][heading[0]] = {
+                    "_type": "Heading", "lineNo": heading[0],
+                    "title": _truncate(heading[1]), "children": []}
+                file_item["children"].append(parent)
+        link = {"_type": "Link", "lineNo": line_no, "url": _truncate(url)}
+        if descr:
+            link["descr"] = _truncate(descr)
+        parent["children"].append(link)
+    for file_item in file_items.values():
+        del file_item["_headings"]
+    return {
+        "total": total,
+        "filtered": count,
+        "children": list(file_items.values()),
+    }
+
+
+def _truncate(text):
+    return text if len(text) <= _FIELD_LIMIT else text[:_FIELD_LIMIT - 1] + "\u2026"
+
+
+def _group_links(org_file):
+    groups = {}
+    for link_index, link in enumerate(org_file.links):
+        groups.setdefault(link[0], []).append(link_index)
+    return {key: tuple(link_indices) for key, link_indices in groups.items()}
+
+
+class Linkremark:
+    """``linkremark.urlMentions`` and ``linkremark.visit`` methods
+
+    ``index`` is ``UrlIndex``, ``mentions_compact.CompactUrlIndex``,
+    or ``mentions_sqlite.SqliteUrlIndex``.
+    Files are read on the first request. Changed files are reparsed
+    before lookup. ``visit(path, line_no)`` opens a file, it is called
+    for indexed files only.
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> path = os.path.join(directory, "a.org")
+    >>> with open(path, "w") as f:
+    ...     _ = f.write("https://orgmode.org/")
+    >>> linkremark = Linkremark(
+    ...     UrlIndex([directory]), lambda path, line_no: line_no)
+    >>> linkremark.visit(file=path, lineNo=1)
+    1
+    >>> linkremark.visit(file="/etc/passwd")
+    Traceback (most recent call last):
+        ...
+    lr_webextensions.jsonrpc.JsonRpcError: ('visit: file is not indexed', \
+<HTTPStatus.FORBIDDEN: 403>, {'file': '/etc/passwd'})
+    """
+
+    def __init__(self, index, visit=None):
+        self._index = index
+        self._visit = visit
+
+    def urlMentions(self, variants=None, limit=LIMIT, order=None, cursor=None):
+        """Links to any of ``variants``
+
+        At most ``limit`` links sorted by ``order`` (see ``ORDERS``)
+        are returned. Pass ``cursor`` of the result to get the next page.
+        """
+        if not _is_variants(variants):
+            raise JsonRpcError(
+                "urlMentions: variants must be an Array of Strings",
+                HTTPStatus.BAD_REQUEST)
+        order = _check_options("urlMentions", limit, order)
+        if cursor is not None and not isinstance(cursor, str):
+            raise JsonRpcError(
+                "urlMentions: cursor must be a String", HTTPStatus.BAD_REQUEST)
+        self._index.refresh()
+        try:
+            return self._index.mentions(variants, limit, order, cursor)
+        except ValueError as ex:
+            raise JsonRpcError(
+                f"urlMentions: {ex}", HTTPStatus.BAD_REQUEST) from ex
+
+    def urlMentionsBatch(self, queries=None, limit=LIMIT, order=None):
+        """Mentions for ``[{id, variants, cursor?}]`` as ``{id: result}``
+
+        ``id`` is a String or a Number.
+        """
+        if not isinstance(queries, list) or not all(
+                isinstance(query, dict)
+                and isinstance(query.get("id"), (str, int))
+                and not isinstance(query["id"], bool)
+                and _is_variants(query.get("variants"))
+                and isinstance(query.get("cursor", ""), str)
+                for query in queries):
+            raise JsonRpcError(
+                "urlMentionsBatch: queries must be an Array of "
+                "{id: String, variants: Array of Strings, cursor?: String}",
+                HTTPStatus.BAD_REQUEST)
+        order = _check_options("urlMentionsBatch", limit, order)
+        self._index.refresh()
+        try:
+            results = self._index.mentions_batch(
+                [(query["variants"], query.get("cursor")) for query in queries],
+                limit, order)
+        except ValueError as ex:
+            raise JsonRpcError(
+                f"urlMentionsBatch: {ex}", HTTPStatus.BAD_REQUEST) from ex
+        return {
+            str(query["id"]): result
+            for query, result in zip(queries, results)}
+
+    def visit(self, file=None, lineNo=None):
+        """Open ``file`` at ``lineNo``, the file must be indexed"""
+        if self._visit is None:
+            raise JsonRpcError(
+                "visit: not supported", HTTPStatus.NOT_IMPLEMENTED)
+        if not isinstance(file, str) or not file:
+            raise JsonRpcError(
+                "visit: file must be a String", HTTPStatus.BAD_REQUEST)
+        if lineNo is not None and (
+                not isinstance(lineNo, int) or isinstance(lineNo, bool)
+                or lineNo < 1):
+            raise JsonRpcError(
+                "visit: lineNo must be a positive Integer",
+                HTTPStatus.BAD_REQUEST)
+        path = os.path.abspath(file)
+        self._index.refresh()
+        # Paths from requests are not trusted, only links from notes are.
+        if self._index.get_state(path) is None:
+            raise JsonRpcError(
+                "visit: file is not indexed", HTTPStatus.FORBIDDEN,
+                {"file": file})
+        return self._visit(path, lineNo or 1)
+
+    def urlPrefixMentions(self, prefix=None, limit=PREFIX_LIMIT):
+        """Number of links to pages under ``prefix`` URL
+
+        ``prefix`` may be a host name, subdomains are included.
+        """
+        if not isinstance(prefix, str) or not prefix.strip():
+            raise JsonRpcError(
+                "urlPrefixMentions: prefix must be a non-empty String",
+                HTTPStatus.BAD_REQUEST)
+        if (
+                not isinstance(limit, int) or isinstance(limit, bool)
+                or not 0 < limit <= MAX_LIMIT):
+            raise JsonRpcError(
+                f"urlPrefixMentions: limit must be an Integer from 1 to {MAX_LIMIT}",
+                HTTPStatus.BAD_REQUEST)
+        self._index.refresh()
+        return self._index.prefix_mentions(prefix.strip(), limit)
+
+
+def _is_variants(variants):
+    return isinstance(variants, list) and all(
+        isinstance(variant, str) for variant in variants)
+
+
+def _check_options(method, limit, order):
+    if (
+            not isinstance(limit, int) or isinstance(limit, bool)
+            or not 0 < limit <= MAX_LIMIT):
+        raise JsonRpcError(
+            f"{method}: limit must be an Integer from 1 to {MAX_LIMIT}",
+            HTTPStatus.BAD_REQUEST)
+    if order is None:
+        return ORDERS[0]
+    if order not in ORDERS:
+        raise JsonRpcError(
+            f"{method}: order must be one of {', '.join(ORDERS)}",
+            HTTPStatus.BAD_REQUEST)
+    return order
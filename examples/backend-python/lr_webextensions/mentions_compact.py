@@ -0,0 +1,356 @@
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Compact in-memory store for URL mentions
+
+``mentions.UrlIndex`` keeps a tuple, two strings, and ``dict`` entries
+for every link, several hundred bytes. ``CompactUrlIndex`` is intended
+for long-running processes having a lot of notes:
+
+- a URL key is stored once as ``prefix_key``, so range of keys
+  is a site, in the ``dict`` mapping it to key ID,
+- postings of a key are runs of ``file_id, count, link_index...``
+  in a flat ``array('I')``,
+- line numbers, headings, and key IDs of links are arrays
+  in ``CompactFile``,
+- a URL is not stored if it is ``https:`` or ``http:`` followed
+  by the key and an optional slash,
+- headings are arrays of ``HeadingTable``.
+
+Postings of a changed file are not removed at once, the old file ID
+is marked as dead. Postings are rebuilt when dead links outnumber
+live ones.
+
+>>> from .mentions import parse_org
+>>> index = CompactUrlIndex()
+>>> index.add(parse_org("notes.org", "* Org\\n[[https://orgmode.org/][Org]]"))
+>>> index.mentions(["http://www.orgmode.org"])["children"][0]["children"]
+[{'_type': 'Heading', 'lineNo': 1, 'title': 'Org', 'children': \
+[{'_type': 'Link', 'lineNo': 2, 'url': 'https://orgmode.org/', 'descr': 'Org'}]}]
+"""
+
+from array import array
+import sys
+import threading
+
+from .mentions import LIMIT, ORDERS, BaseUrlIndex, _group_links, _top_rows, prefix_key
+
+# ``CompactFile.url_kinds``: URL is not stored if it is derived from key.
+_URL_STORED = 0
+_URL_PREFIXES = (None, ("https:", ""), ("https:", "/"), ("http:", ""), ("http:", "/"))
+
+
+class HeadingTable:
+    """Headings of a file, items are ``(line_no, title, level)``"""
+    __slots__ = ("lines", "levels", "titles")
+
+    def __init__(self, headings):
+        self.lines = array("I", (heading[0] for heading in headings))
+        self.levels = array("B", (min(heading[2], 255) for heading in headings))
+        self.titles = [heading[1] for heading in headings]
+
+    def __len__(self):
+        return len(self.titles)
+
+    def __getitem__(self, index):
+        return self.lines[index], self.titles[index], self.levels[index]
+
+
+class CompactFile:
+    """Links of a file, ``OrgFile`` counterpart for ``CompactUrlIndex``
+
+    ``links`` and ``headings`` are read-only sequences of the same
+    items as in ``OrgFile``.
+    """
+    __slots__ = (
+        "path", "signature", "digest", "headings", "key_ids", "lines",
+        "heading_indices", "url_kinds", "urls", "descrs", "_prefix_keys")
+
+    def __init__(self, org_file, key_ids, prefix_keys):
+        self.path = org_file.path
+        self.signature = org_file.signature
+        self.digest = org_file.digest
+        self.headings = HeadingTable(org_file.headings)
+        self.key_ids = key_ids
+        self._prefix_keys = prefix_keys
+        links = org_file.links
+        self.lines = array("I", (link[2] for link in links))
+        self.heading_indices = array("i", (link[3] for link in links))
+        self.url_kinds = array("B", bytes(len(links)))
+        # Sparse, most URLs are derived from keys.
+        self.urls = None
+        for link_index, (key, url, _, _, _) in enumerate(links):
+            kind = _url_kind(key, url)
+            self.url_kinds[link_index] = kind
+            if kind == _URL_STORED:
+                if self.urls is None:
+                    self.urls = {}
+                self.urls[link_index] = url
+        self.descrs = None
+        if any(link[4] for link in links):
+            # The same descriptions are used for links to popular pages.
+            self.descrs = [
+                sys.intern(link[4]) if link[4] else None for link in links]
+
+    @property
+    def links(self):
+        return _LinkView(self)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def link(self, link_index):
+        key = prefix_key(self._prefix_keys[self.key_ids[link_index]])
+        kind = self.url_kinds[link_index]
+        if kind == _URL_STORED:
+            url = self.urls[link_index]
+        else:
+            scheme, suffix = _URL_PREFIXES[kind]
+            url = scheme + key + suffix
+        return (
+            key, url, self.lines[link_index], self.heading_indices[link_index],
+            self.descrs[link_index] if self.descrs is not None else None)
+
+
+class _LinkView:
+    __slots__ = ("_file",)
+
+    def __init__(self, compact_file):
+        self._file = compact_file
+
+    def __len__(self):
+        return len(self._file)
+
+    def __getitem__(self, link_index):
+        return self._file.link(link_index)
+
+
+def _url_kind(key, url):
+    for kind in range(1, len(_URL_PREFIXES)):
+        scheme, suffix = _URL_PREFIXES[kind]
+        if (
+                len(url) == len(scheme) + len(key) + len(suffix)
+                and url.startswith(scheme) and url.endswith(suffix)
+                and url.startswith(key, len(scheme))):
+            return kind
+    return _URL_STORED
+
+
+class CompactUrlIndex(BaseUrlIndex):
+    """URL mentions in arrays, see the module description
+
+    >>> from .mentions import parse_org
+    >>> index = CompactUrlIndex()
+    >>> index.add(parse_org("a.org", "https://orgmode.org/ https://gnu.org"))
+    >>> index.add(parse_org("a.org", "https://orgmode.org/"))
+    >>> index.add(parse_org("b.org", "https://orgmode.org/manual"))
+    >>> index.mentions(["https://orgmode.org"])["total"], index.link_count
+    (1, 2)
+    >>> index.prefix_mentions("orgmode.org")["total"]
+    2
+    """
+
+    #: Postings are rebuilt when dead links outnumber live ones
+    #: and there are at least so many dead links
+    COMPACT_MIN_DEAD = 10000
+
+    def __init__(
+            self, paths=(), watch=True,
+            poll_interval=BaseUrlIndex.POLL_INTERVAL, canonicalizer=None,
+            workers=None):
+        super().__init__(paths, watch, poll_interval, canonicalizer, workers)
+        # ``CompactFile`` or ``None`` for replaced files.
+        self._files = []
+        self._file_ids = {}
+        # ``prefix_key: key_id``
+        self._key_ids = {}
+        # ``prefix_key`` by key ID, ``None`` for removed keys.
+        self._prefix_keys = []
+        self._postings = []
+        self._counts = array("I")
+        self._free_key_ids = []
+        # Key IDs sorted by ``prefix_key`` for ``prefix_counts``.
+        self._prefix_order = array("I")
+        self.link_count = 0
+        self._dead_count = 0
+        # Lookups and changes of postings.
+        self._lock = threading.Lock()
+
+    def indexed_paths(self):
+        return list(self._file_ids)
+
+    def get_state(self, path):
+        file_id = self._file_ids.get(path)
+        if file_id is None:
+            return None
+        compact_file = self._files[file_id]
+        return compact_file.signature, compact_file.digest
+
+    def set_signature(self, path, signature):
+        self._files[self._file_ids[path]].signature = signature
+
+    def replace(self, path, org_file):
+        with self._lock:
+            file_id = self._file_ids.pop(path, None)
+            if file_id is not None:
+                self._remove(file_id)
+            if org_file is None:
+                return
+            file_id = len(self._files)
+            key_ids = array("I", bytes(4*len(org_file.links)))
+            for key, link_indices in _group_links(org_file).items():
+                key_id = self._key_id(prefix_key(key))
+                self._postings[key_id].extend(
+                    (file_id, len(link_indices), *link_indices))
+                self._counts[key_id] += len(link_indices)
+                for link_index in link_indices:
+                    key_ids[link_index] = key_id
+            self._files.append(CompactFile(org_file, key_ids, self._prefix_keys))
+            self._file_ids[path] = file_id
+            self.link_count += len(key_ids)
+            if (
+                    self._dead_count >= self.COMPACT_MIN_DEAD
+                    and self._dead_count > self.link_count):
+                self._compact()
+
+    def _key_id(self, pkey):
+        key_id = self._key_ids.get(pkey)
+        if key_id is not None:
+            return key_id
+        if self._free_key_ids:
+            key_id = self._free_key_ids.pop()
+            self._prefix_keys[key_id] = pkey
+            self._postings[key_id] = array("I")
+        else:
+            key_id = len(self._prefix_keys)
+            self._prefix_keys.append(pkey)
+            self._postings.append(array("I"))
+            self._counts.append(0)
+        self._key_ids[pkey] = key_id
+        self._prefix_order.insert(self._prefix_position(pkey), key_id)
+        return key_id
+
+    def _remove(self, file_id):
+        compact_file = self._files[file_id]
+        self._files[file_id] = None
+        self.link_count -= len(compact_file)
+        self._dead_count += len(compact_file)
+        for key_id in compact_file.key_ids:
+            self._counts[key_id] -= 1
+            if self._counts[key_id] == 0:
+                self._remove_key(key_id)
+
+    def _remove_key(self, key_id):
+        pkey = self._prefix_keys[key_id]
+        del self._prefix_order[self._prefix_position(pkey)]
+        del self._key_ids[pkey]
+        self._dead_count -= sum(
+            end - start for _, start, end in _runs(self._postings[key_id]))
+        self._prefix_keys[key_id] = None
+        self._postings[key_id] = None
+        self._free_key_ids.append(key_id)
+
+    def _prefix_position(self, pkey):
+        """Index of the first key ID not less than ``pkey`` in ``_prefix_order``"""
+        prefix_keys, order = self._prefix_keys, self._prefix_order
+        low, high = 0, len(order)
+        while low < high:
+            middle = (low + high)//2
+            if prefix_keys[order[middle]] < pkey:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _compact(self):
+        """Rebuild postings without dead files"""
+        files = [f for f in self._files if f is not None]
+        self._files = files
+        self._file_ids = {f.path: file_id for file_id, f in enumerate(files)}
+        self._postings = [
+            None if pkey is None else array("I") for pkey in self._prefix_keys]
+        for file_id, compact_file in enumerate(files):
+            groups = {}
+            for link_index, key_id in enumerate(compact_file.key_ids):
+                groups.setdefault(key_id, []).append(link_index)
+            for key_id, link_indices in groups.items():
+                self._postings[key_id].extend(
+                    (file_id, len(link_indices), *link_indices))
+        self._dead_count = 0
+
+    def prefix_counts(self, prefix):
+        with self._lock:
+            result = []
+            for position in range(
+                    self._prefix_position(prefix), len(self._prefix_order)):
+                key_id = self._prefix_order[position]
+                pkey = self._prefix_keys[key_id]
+                if not pkey.startswith(prefix):
+                    break
+                result.append((pkey, self._counts[key_id]))
+            return result
+
+    def lookup_keys(self, keys, limit=LIMIT, order=ORDERS[0], after=None):
+        """Rows of links are consistent with a concurrent refresh
+
+        >>> from .mentions import parse_org
+        >>> index = CompactUrlIndex()
+        >>> files = [
+        ...     parse_org("a.org", f"https://{site}.org/\\n"*100)
+        ...     for site in ("gnu", "orgmode")]
+        >>> keys = [org_file.links[0][0] for org_file in files]
+        >>> def refresh():
+        ...     for i in range(1000):
+        ...         index.add(files[i % 2])
+        >>> switch_interval = sys.getswitchinterval()
+        >>> sys.setswitchinterval(1e-5)
+        >>> thread = threading.Thread(target=refresh)
+        >>> thread.start()
+        >>> wrong_urls = set()
+        >>> while thread.is_alive():
+        ...     for key, (count, rows) in index.lookup_keys(keys, 100).items():
+        ...         wrong_urls.update(row[2] for row in rows if key[2:] not in row[2])
+        >>> thread.join()
+        >>> sys.setswitchinterval(switch_interval)
+        >>> wrong_urls
+        set()
+        """
+        result = {}
+        # Rows are built under the lock since URLs of links are derived
+        # from ``_prefix_keys``, IDs of removed keys are reused.
+        with self._lock:
+            files = self._files
+            for key in keys:
+                key_id = self._key_ids.get(prefix_key(key))
+                if key_id is None:
+                    result[key] = (0, [])
+                    continue
+                postings = self._postings[key_id]
+                result[key] = self._counts[key_id], _top_rows(
+                    (
+                        (files[file_id], postings[start:end])
+                        for file_id, start, end in _runs(postings)
+                        if files[file_id] is not None),
+                    limit, order, after)
+        return result
+
+
+def _runs(postings):
+    """``(file_id, start, end)`` of link indices in ``postings[start:end]``"""
+    position = 0
+    while position < len(postings):
+        start = position + 2
+        end = start + postings[position + 1]
+        yield postings[position], start, end
+        position = end
@@ -0,0 +1,293 @@
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""URL mentions index stored in SQLite database
+
+In contrast to ``mentions.UrlIndex``, postings are not loaded
+into memory. A process started for a single request checks
+``(mtime, size, inode)`` of note files against values saved
+in the database, parses only changed files, and answers the query
+using the index on URL keys. Unchanged files are not read at all.
+
+>>> import tempfile
+>>> directory = tempfile.mkdtemp()
+>>> with open(os.path.join(directory, "a.org"), "w") as f:
+...     _ = f.write("* Org\\n[[https://orgmode.org/][Org Mode]]\\n")
+>>> db_path = os.path.join(directory, "cache", "mentions.sqlite")
+>>> index = SqliteUrlIndex([directory], db_path)
+>>> index.refresh()
+1
+>>> index.close()
+>>> index = SqliteUrlIndex([directory], db_path)
+>>> index.refresh()
+0
+>>> index.mentions(["https://orgmode.org/"])["children"][0]["children"]
+[{'_type': 'Heading', 'lineNo': 1, 'title': 'Org', 'children': \
+[{'_type': 'Link', 'lineNo': 2, 'url': 'https://orgmode.org/', 'descr': 'Org Mode'}]}]
+"""
+
+import logging
+import os
+import threading
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from .mentions import _MAX_CHAR, LIMIT, ORDERS, BaseUrlIndex, prefix_key
+
+logger = logging.getLogger("lr_webextensions.mentions_sqlite")
+
+# Expressions for ``mentions.sort_key`` items.
+_SORT_COLUMNS = {
+    "path": ("f.path", "l.link_index"),
+    "mtime": ("-f.mtime_ns", "f.path", "l.link_index"),
+    "depth": ("COALESCE(h.level, 0)", "f.path", "l.link_index"),
+}
+
+#: Increment it when format of tables changes
+SCHEMA_VERSION = 5
+
+_SCHEMA = """
+CREATE TABLE files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    digest BLOB NOT NULL
+);
+CREATE TABLE headings (
+    file_id INTEGER NOT NULL,
+    heading_index INTEGER NOT NULL,
+    line_no INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    level INTEGER NOT NULL,
+    PRIMARY KEY (file_id, heading_index)
+) WITHOUT ROWID;
+-- key is mentions.prefix_key() of URL key, so range of keys is a site
+CREATE TABLE links (
+    file_id INTEGER NOT NULL,
+    link_index INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    url TEXT NOT NULL,
+    line_no INTEGER NOT NULL,
+    heading_index INTEGER NOT NULL,
+    descr TEXT,
+    PRIMARY KEY (file_id, link_index)
+) WITHOUT ROWID;
+CREATE INDEX links_key ON links (key);
+-- "canonicalizer" is signature of options used to compute keys
+CREATE TABLE settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def default_path(name):
+    """``$XDG_CACHE_HOME/linkremark/NAME-mentions.sqlite``"""
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_dir, "linkremark", f"{name}-mentions.sqlite")
+
+
+class SqliteUrlIndex(BaseUrlIndex):
+    """Postings in SQLite database at ``db_path``
+
+    The database is opened on the first call. Every file is replaced
+    in its own transaction, so a lookup sees either old or new state
+    of the file, and a crash does not lose progress of indexing.
+    Links are removed if keys were computed with other options
+    of ``canonicalizer``.
+    """
+
+    def __init__(
+            self, paths, db_path, watch=True,
+            poll_interval=BaseUrlIndex.POLL_INTERVAL, canonicalizer=None,
+            workers=None):
+        super().__init__(paths, watch, poll_interval, canonicalizer, workers)
+        self.db_path = db_path
+        self._db = None
+        # ``path: (file_id, signature, digest)``
+        self._files = None
+        # Connection is shared by threads.
+        self._lock = threading.RLock()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+                self._files = None
+
+    def _open(self):
+        if self._db is not None:
+            return self._db
+        os.makedirs(os.path.dirname(self.db_path), mode=0o700, exist_ok=True)
+        try:
+            db = self._connect()
+        except sqlite3.DatabaseError:
+            logger.warning(
+                "recreating broken %s", self.db_path, exc_info=True)
+            # Stale WAL must not be applied to the new database.
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.unlink(self.db_path + suffix)
+                except FileNotFoundError:
+                    pass
+            db = self._connect()
+        self._files = {
+            path: (file_id, (mtime_ns, size, inode), digest)
+            for file_id, path, mtime_ns, size, inode, digest in db.execute(
+                "SELECT id, path, mtime_ns, size, inode, digest FROM files")}
+        self._db = db
+        return db
+
+    def _connect(self):
+        db = sqlite3.connect(
+            self.db_path, timeout=10, isolation_level=None,
+            check_same_thread=False)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                with db:
+                    for table in ("links", "headings", "files", "settings"):
+                        db.execute(f"DROP TABLE IF EXISTS {table}")
+                    db.executescript(_SCHEMA)
+                    db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            self._check_canonicalizer(db)
+        except BaseException:
+            db.close()
+            raise
+        return db
+
+    def _check_canonicalizer(self, db):
+        signature = self.canonicalizer.signature
+        row = db.execute(
+            "SELECT value FROM settings WHERE name = 'canonicalizer'").fetchone()
+        if row is not None and row[0] == signature:
+            return
+        db.execute("BEGIN")
+        for table in ("links", "headings", "files"):
+            db.execute(f"DELETE FROM {table}")
+        db.execute(
+            "INSERT OR REPLACE INTO settings VALUES ('canonicalizer', ?)",
+            (signature,))
+        db.execute("COMMIT")
+
+    def indexed_paths(self):
+        with self._lock:
+            self._open()
+            return list(self._files)
+
+    def get_state(self, path):
+        with self._lock:
+            self._open()
+            entry = self._files.get(path)
+            return None if entry is None else entry[1:]
+
+    def set_signature(self, path, signature):
+        with self._lock:
+            db = self._open()
+            file_id, _, digest = self._files[path]
+            with db:
+                db.execute(
+                    "UPDATE files SET mtime_ns = ?, size = ?, inode = ?"
+                    " WHERE id = ?", (*signature, file_id))
+            self._files[path] = (file_id, signature, digest)
+
+    def replace(self, path, org_file):
+        with self._lock:
+            db = self._open()
+            db.execute("BEGIN")
+            try:
+                # Another process may add the file, so cached ID is not used.
+                for table in ("links", "headings"):
+                    db.execute(
+                        f"DELETE FROM {table} WHERE file_id IN"
+                        " (SELECT id FROM files WHERE path = ?)", (path,))
+                db.execute("DELETE FROM files WHERE path = ?", (path,))
+                if org_file is not None:
+                    file_id = db.execute(
+                        "INSERT INTO files (path, mtime_ns, size, inode, digest)"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        (path, *org_file.signature, org_file.digest)).lastrowid
+                    db.executemany(
+                        "INSERT INTO headings VALUES (?, ?, ?, ?, ?)",
+                        ((file_id, heading_index, *heading)
+                         for heading_index, heading
+                         in enumerate(org_file.headings)))
+                    db.executemany(
+                        "INSERT INTO links VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        ((file_id, link_index, prefix_key(key), url,
+                          line_no, heading_index, descr)
+                         for link_index, (key, url, line_no, heading_index, descr)
+                         in enumerate(org_file.links)))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                # Cached state may be inconsistent with the database.
+                self.close()
+                raise
+            self._files.pop(path, None)
+            if org_file is not None:
+                self._files[path] = (file_id, org_file.signature, org_file.digest)
+
+    def prefix_counts(self, prefix):
+        with self._lock:
+            return self._open().execute(
+                "SELECT key, COUNT(*) FROM links WHERE key >= ? AND key < ?"
+                " GROUP BY key", (prefix, prefix + _MAX_CHAR)).fetchall()
+
+    def lookup_keys(self, keys, limit=LIMIT, order=ORDERS[0], after=None):
+        columns = _SORT_COLUMNS[order]
+        sort = ", ".join(columns)
+        condition = "l.key = ?"
+        if after is not None:
+            # Row values are compared lexicographically.
+            condition += f" AND ({sort}) > ({', '.join('?'*len(after))})"
+        query = (
+            f"SELECT {sort}, f.path, l.url, l.line_no,"
+            " h.line_no, h.title, l.descr"
+            " FROM links AS l JOIN files AS f ON f.id = l.file_id"
+            " LEFT JOIN headings AS h ON h.file_id = l.file_id"
+            " AND h.heading_index = l.heading_index"
+            f" WHERE {condition} ORDER BY {sort} LIMIT ?")
+        width = len(columns)
+        result = {}
+        with self._lock:
+            db = self._open()
+            # Consistent result if another process updates the database.
+            db.execute("BEGIN")
+            try:
+                for key in keys:
+                    count = db.execute(
+                        "SELECT COUNT(*) FROM links WHERE key = ?",
+                        (prefix_key(key),)).fetchone()[0]
+                    rows = db.execute(
+                        query, (prefix_key(key), *(after or ()), limit)
+                    ).fetchall() if count else ()
+                    result[key] = count, [
+                        (tuple(row[:width]), path, url, line_no,
+                         (heading_line, title) if heading_line is not None
+                         else None, descr)
+                        for row in rows
+                        for path, url, line_no, heading_line, title, descr
+                        in (row[width:],)]
+            finally:
+                db.execute("COMMIT")
+        return result
@@ -20,37 +20,475 @@ See
 
 ``input_file`` is usually ``sys.stdin.buffer``,
 ``outfile`` is ``sys.stdout.buffer``.
+
+JSON is handled by ``default_codec``. It is ``OrjsonCodec``
+if the ``orjson`` package is installed, otherwise ``JsonCodec``
+based on the ``json`` module from the standard library.
 """
 
+import io
+import itertools
 import json
+import logging
+import math
+import os
 import struct
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 MESSAGE_SIZE_LIMIT = 1024*1024
+#: Size of response JSON text fragment in a chunk message, bytes.
+#: Escaping of quotes and backslashes may double it.
+CHUNK_SIZE = 256*1024
 
+logger = logging.getLogger("lr_webextensions.native_messaging")
 
-#: Read messages from a file-like object and decode them
-def message_source(input_file):
-    while True:
-        raw_length = input_file.read(4)
-        if len(raw_length) == 0:
-            return
-        message_length = struct.unpack('@I', raw_length)[0]
-        if message_length > MESSAGE_SIZE_LIMIT:
+
+class JsonCodec:
+    r"""Encode and decode messages using ``json`` module
+
+    Non-ASCII characters are written as UTF-8 without escaping.
+    Separators are compact to get the same bytes as from ``OrjsonCodec``,
+    so there are no spaces after ``,`` and ``:`` unlike ``json.dumps``
+    defaults used earlier. ``NaN`` and infinity are not valid JSON,
+    browsers can not parse them, so ``ValueError`` is raised.
+
+    >>> codec = JsonCodec()
+    >>> codec.encode({"title": "Emoji 😀", "n": [1, None]})
+    b'{"title":"Emoji \xf0\x9f\x98\x80","n":[1,null]}'
+    >>> b"".join(encode_message({"id": 1, "result": [0.5, "a b"]}, codec))
+    b'\x1d\x00\x00\x00{"id":1,"result":[0.5,"a b"]}'
+    >>> codec.encode([float("nan")])
+    Traceback (most recent call last):
+        ...
+    ValueError: Out of range float values are not JSON compliant
+    >>> codec.decode(memoryview(b'"\\ud83d\\ude00 \xf0\x9f\x98\x80"'))
+    '😀 😀'
+
+    Lone surrogates may be decoded from escape sequences,
+    but they can not be encoded to UTF-8.
+
+    >>> codec.decode(b'"\\ud800"') == "\ud800"
+    True
+    >>> codec.encode("\ud800")
+    Traceback (most recent call last):
+        ...
+    UnicodeEncodeError: 'utf-8' codec can't encode character '\ud800' in position 1: surrogates not allowed
+    """
+    name = "json"
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(
+            ensure_ascii=False, separators=(',', ':'), allow_nan=False)
+
+    def encode(self, message):
+        return self._encoder.encode(message).encode('utf-8')
+
+    def decode(self, data):
+        """``data`` is ``bytes``, ``bytearray``, or ``memoryview``"""
+        return json.loads(str(data, 'utf-8'))
+
+
+class OrjsonCodec(JsonCodec):
+    r"""Faster codec, ``orjson`` package is required
+
+    Decoded values are the same as from ``JsonCodec``. Lone surrogates,
+    integers exceeding 64 bit, and other values that ``orjson`` rejects
+    are passed to ``JsonCodec``, so the result or the exception
+    is the same as well. ``orjson`` silently writes ``NaN`` and infinity
+    as ``null``, so messages are checked for such floats to raise
+    ``ValueError``. Bytes are the same unless the message has floats:
+    their text may differ, e.g. ``1e16`` instead of ``1e+16``.
+
+    >>> codec = OrjsonCodec() if orjson is not None else JsonCodec()
+    >>> message = {"title": "Emoji 😀", "n": [1, None, 2**70], 3: True}
+    >>> codec.encode(message) == JsonCodec().encode(message)
+    True
+    >>> codec.decode(memoryview(b'"\\ud83d\\ude00 \xf0\x9f\x98\x80"'))
+    '😀 😀'
+    >>> codec.decode(b'"\\ud800"') == "\ud800"
+    True
+    >>> codec.encode("\ud800")
+    Traceback (most recent call last):
+        ...
+    UnicodeEncodeError: 'utf-8' codec can't encode character '\ud800' in position 1: surrogates not allowed
+    >>> codec.encode({"n": [None, float("inf")]})
+    Traceback (most recent call last):
+        ...
+    ValueError: Out of range float values are not JSON compliant
+    >>> codec.decode(codec.encode([1e16, 0.1])) == [1e16, 0.1]
+    True
+    """
+    name = "orjson"
+
+    def encode(self, message):
+        try:
+            encoded = orjson.dumps(message)
+        except TypeError:
+            return super().encode(message)
+        if _has_non_finite((message,)):
+            # ``JsonCodec`` raises ``ValueError``.
+            return super().encode(message)
+        return encoded
+
+    def decode(self, data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return super().decode(data)
+
+
+def _has_non_finite(items):
+    """Whether ``items`` contain ``NaN`` or infinity at any depth
+
+    >>> _has_non_finite([{"a": [1, "b", None]}, 0.5])
+    False
+    >>> _has_non_finite([{"a": (1, float("-inf"))}])
+    True
+    """
+    for value in items:
+        kind = type(value)
+        # Most values are leaves, they are checked first.
+        if kind is str or kind is int or value is None or kind is bool:
+            continue
+        if kind is dict:
+            if _has_non_finite(value.values()):
+                return True
+        elif kind is list or kind is tuple:
+            if _has_non_finite(value):
+                return True
+        elif kind is float and not math.isfinite(value):
+            return True
+    return False
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec, OrjsonCodec)}
+
+#: Codec used when no one is passed explicitly
+default_codec = OrjsonCodec() if orjson is not None else JsonCodec()
+
+
+HEADER_SIZE = 4
+_INITIAL_BUFFER_SIZE = 64*1024
+
+
+class FrameReader:
+    """Read length-prefixed frames into a reusable buffer
+
+    Buffer grows up to the size of the largest message and never shrinks,
+    so steady state reading does not allocate memory for message bytes.
+    Short reads from pipes are retried till the frame is complete.
+
+    >>> import io
+    >>> reader = FrameReader(io.BytesIO(b"".join(
+    ...     encode_message({"a": 1}) + encode_message([2]))))
+    >>> bytes(reader.read_frame())
+    b'{"a":1}'
+    >>> list(reader)
+    [[2]]
+    >>> reader.read_frame() is None
+    True
+    """
+
+    def __init__(self, input_file, size_limit=MESSAGE_SIZE_LIMIT, codec=None):
+        self._input_file = input_file
+        self._codec = codec or default_codec
+        self._size_limit = size_limit
+        self._buffer = bytearray(_INITIAL_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+
+    def __iter__(self):
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            yield self._codec.decode(frame)
+
+    def decode(self, frame):
+        """Decode frame obtained from ``read_frame``"""
+        return self._codec.decode(frame)
+
+    def read_frame(self):
+        """Return ``memoryview`` of next message or ``None`` on end of file
+
+        The view is valid till next call.
+        """
+        if not self._read_exactly(HEADER_SIZE, allow_eof=True):
+            return None
+        message_length = struct.unpack_from('@I', self._buffer)[0]
+        if message_length > self._size_limit:
             raise ValueError("Message size limit exceeded", message_length)
-        message = input_file.read(message_length).decode('utf-8')
-        yield json.loads(message)
+        if message_length > len(self._buffer):
+            self._grow(message_length)
+        self._read_exactly(message_length)
+        return self._view[:message_length]
+
+    def _read_exactly(self, size, allow_eof=False):
+        view = self._view
+        received = 0
+        while received < size:
+            count = self._input_file.readinto(view[received:size])
+            if not count:
+                if received == 0 and allow_eof:
+                    return False
+                raise EOFError("Truncated message", size, received)
+            received += count
+        return True
+
+    def _grow(self, size):
+        size = min(max(size, 2*len(self._buffer)), self._size_limit)
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+
+
+#: Read messages from a file-like object and decode them
+def message_source(input_file, codec=None):
+    return iter(FrameReader(input_file, codec=codec))
 
 
 #: Encode a message for transmission, given its content
-def encode_message(message):
-    encoded = json.dumps(message, ensure_ascii=False).encode('utf-8')
+def encode_message(message, codec=None):
+    encoded = (codec or default_codec).encode(message)
     raw_length = struct.pack('@I', len(encoded))
     return raw_length, encoded
 
 
+def iter_encode(message, codec=None, depth=2):
+    """Encode ``message`` piece by piece
+
+    Objects up to ``depth`` levels are split into fields, arrays
+    reached through them are always split into items that do not
+    count as a level, so ``result.children`` of a response
+    is encoded item by item. Deeper values are encoded at once,
+    memory required for encoding is limited by the largest of them.
+    Concatenated pieces are the same as ``codec.encode(message)``.
+
+    >>> message = {"id": 1, "result": {"total": 2, "children": [{"a": "б"}, 3]}}
+    >>> b"".join(iter_encode(message)) == default_codec.encode(message)
+    True
+    >>> [piece.decode() for piece in iter_encode(message)][-7:]
+    ['[', '{"a":"б"}', ',', '3', ']', '}', '}']
+    """
+    codec = codec or default_codec
+    if isinstance(message, list):
+        yield b'['
+        for index, item in enumerate(message):
+            if index:
+                yield b','
+            yield from iter_encode(item, codec, depth)
+        yield b']'
+    elif (
+            depth > 0 and isinstance(message, dict)
+            and all(isinstance(key, str) for key in message)):
+        yield b'{'
+        for index, (key, value) in enumerate(message.items()):
+            if index:
+                yield b','
+            yield codec.encode(key)
+            yield b':'
+            yield from iter_encode(value, codec, depth - 1)
+        yield b'}'
+    else:
+        yield codec.encode(message)
+
+
+def iter_chunks(request_id, pieces, chunk_size=CHUNK_SIZE):
+    """Split JSON text of a response into chunk messages
+
+    Each message has ``chunk`` field with ``index`` and ``last``
+    and ``text`` field with a fragment of the response JSON text.
+    The receiver concatenates ``text`` of messages having the same ``id``
+    and parses the result when ``last`` is true.
+
+    >>> for chunk in iter_chunks(7, [b'{"result":"', "абв".encode(), b'"}'], 14):
+    ...     print(chunk)
+    {'jsonrpc': '2.0', 'id': 7, 'chunk': {'index': 0, 'last': False}, \
+'text': '{"result":"а'}
+    {'jsonrpc': '2.0', 'id': 7, 'chunk': {'index': 1, 'last': True}, \
+'text': 'бв"}'}
+    """
+    pending = bytearray()
+    index = 0
+
+    def make_chunk(text, last):
+        return {
+            'jsonrpc': '2.0', 'id': request_id,
+            'chunk': {'index': index, 'last': last}, 'text': text,
+        }
+
+    for piece in pieces:
+        pending += piece
+        while len(pending) > chunk_size:
+            end = chunk_size
+            # Do not split UTF-8 sequence of a character.
+            while end > 0 and (pending[end] & 0xC0) == 0x80:
+                end -= 1
+            yield make_chunk(pending[:end].decode('utf-8'), False)
+            del pending[:end]
+            index += 1
+    yield make_chunk(pending.decode('utf-8'), True)
+
+
+class FrameWriter:
+    r"""Write length-prefixed messages with a single system call
+
+    If ``output_file`` has a file descriptor, header and body are passed
+    to ``os.writev``, otherwise they are joined and written at once.
+    ``write_many`` sends several messages in one call.
+
+    Browsers reject messages larger than ``MESSAGE_SIZE_LIMIT``.
+    ``ValueError`` is raised for such messages unless ``chunked``
+    is true. In the latter case large responses are sent as a sequence
+    of messages created by ``iter_chunks``. Backend should announce
+    it by adding ``jsonrpc.CAPABILITY_CHUNKED`` to ``capabilities``
+    in response to ``hello``.
+
+    When the browser closes the port, ``BrokenPipeError`` is not raised,
+    ``closed`` becomes ``True`` instead and further messages are discarded.
+    The same is true for ``ConnectionResetError`` and other
+    ``ConnectionError`` exceptions from a Unix socket of the daemon.
+    The descriptor is redirected to ``/dev/null`` to avoid errors
+    during interpreter shutdown.
+
+    >>> output = io.BytesIO()
+    >>> writer = FrameWriter(output)
+    >>> writer.write_many([{"id": 1}, {"id": 2}])
+    True
+    >>> output.getvalue()
+    b'\x08\x00\x00\x00{"id":1}\x08\x00\x00\x00{"id":2}'
+    >>> class ResetOutput(io.RawIOBase):
+    ...     def write(self, data):
+    ...         raise ConnectionResetError("Connection reset by peer")
+    >>> writer = FrameWriter(ResetOutput())
+    >>> writer.write({"id": 3}), writer.closed
+    (False, True)
+    """
+
+    def __init__(
+            self, output_file, codec=None, chunked=False,
+            size_limit=MESSAGE_SIZE_LIMIT, chunk_size=CHUNK_SIZE):
+        self._output_file = output_file
+        self._codec = codec or default_codec
+        self._chunked = chunked
+        self._size_limit = size_limit
+        self._chunk_size = chunk_size
+        self.closed = False
+        try:
+            self._fd = output_file.fileno() if hasattr(os, "writev") else None
+        except (AttributeError, io.UnsupportedOperation):
+            self._fd = None
+
+    def write(self, message):
+        """Return ``False`` if the port is closed"""
+        return self.write_many((message,))
+
+    def write_many(self, messages):
+        if self.closed:
+            return False
+        buffers = []
+        for message in messages:
+            encoded = self.encode(message)
+            if isinstance(encoded, list):
+                buffers.extend(encoded)
+                continue
+            if buffers:
+                self.write_frames(buffers)
+                buffers = []
+            self.write_frames(encoded)
+        if buffers:
+            self.write_frames(buffers)
+        return not self.closed
+
+    def encode(self, message):
+        """Encode message to be passed to ``write_frames`` later
+
+        Return a ``list`` of buffers or an iterator for chunked response
+        that is encoded while it is written.
+        """
+        if not self._chunked or not isinstance(message, dict):
+            buffers = encode_message(message, self._codec)
+            if len(buffers[1]) > self._size_limit:
+                raise ValueError(
+                    "Message size limit exceeded", len(buffers[1]))
+            return list(buffers)
+
+        pieces = iter_encode(message, self._codec)
+        # Copied since small pieces from ``orjson`` may have spare capacity.
+        head = bytearray()
+        for piece in pieces:
+            head += piece
+            if len(head) > self._size_limit:
+                return self._iter_chunk_frames(
+                    message.get('id'), itertools.chain((head,), pieces))
+        return [struct.pack('@I', len(head)), head]
+
+    def _iter_chunk_frames(self, request_id, pieces):
+        for chunk in iter_chunks(request_id, pieces, self._chunk_size):
+            yield from encode_message(chunk, self._codec)
+
+    def write_frames(self, buffers):
+        """Write header and body buffers obtained from ``encode``"""
+        if self.closed:
+            return False
+        if not isinstance(buffers, list):
+            # Chunked response, keep in memory just one chunk.
+            frame = []
+            for buf in buffers:
+                frame.append(buf)
+                if len(frame) == 2:
+                    if not self.write_frames(frame):
+                        break
+                    frame = []
+            return not self.closed
+        try:
+            if self._fd is None:
+                self._output_file.write(b"".join(buffers))
+                self._output_file.flush()
+            else:
+                # Data written through the file object, if any, goes first.
+                self._output_file.flush()
+                _writev_all(self._fd, buffers)
+        except ConnectionError:
+            self._on_closed()
+        return not self.closed
+
+    def _on_closed(self):
+        logger.debug("output closed by peer")
+        self.closed = True
+        if self._fd is None:
+            return
+        try:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            try:
+                os.dup2(devnull, self._fd)
+            finally:
+                os.close(devnull)
+        except OSError:
+            logger.debug("redirect of closed output failed", exc_info=True)
+
+
+# ``IOV_MAX`` is 1024 on Linux, POSIX guarantees at least 16.
+_IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 16
+if _IOV_MAX <= 0:
+    _IOV_MAX = 16
+
+
+def _writev_all(fd, buffers):
+    buffers = [memoryview(buf) for buf in buffers]
+    start = 0
+    while start < len(buffers):
+        written = os.writev(fd, buffers[start:start + _IOV_MAX])
+        # Skip completely written buffers and the head of a partial one.
+        while start < len(buffers) and written >= len(buffers[start]):
+            written -= len(buffers[start])
+            start += 1
+        if written:
+            buffers[start] = buffers[start][written:]
+
+
 #: Serialize message, encode it, and write it to a file-like object
 def send_message(output_file, message):
-    raw_length, encoded = encode_message(message)
-    output_file.write(raw_length)
-    output_file.write(encoded)
-    output_file.flush()
+    FrameWriter(output_file).write(message)
@@ -0,0 +1,180 @@
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Append captured entries to an Org file without Emacs
+
+``OrgFileAppender.append`` is called by concurrent request handlers.
+Entries passed while another batch is being written are collected
+into the next batch, so a batch is a single ``write`` call
+and at most one ``fsync``. The file is opened for every batch
+since Emacs replaces it on save.
+
+Emacs does not know about appended text if the file is modified
+in a buffer. When it is saved, appended entries are lost or Emacs
+asks whether the file should be overwritten. Such buffer
+is detected by the ``.#NAME`` lock file created by Emacs,
+appending is refused while it exists.
+
+>>> import tempfile
+>>> path = os.path.join(tempfile.mkdtemp(), "inbox.org")
+>>> appender = OrgFileAppender(path)
+>>> appender.append(["* Org Mode\\n", "* GNU"])
+2
+>>> with open(path) as f:
+...     print(f.read(), end="")
+* Org Mode
+* GNU
+>>> emacs_lock = os.path.join(os.path.dirname(path), ".#inbox.org")
+>>> os.symlink("user@host.1:1", emacs_lock)
+>>> appender.append(["* Lost\\n"])  # doctest: +ELLIPSIS
+Traceback (most recent call last):
+    ...
+lr_webextensions.orgfile.ConcurrentEditError: ... is modified in Emacs (user@host.1:1)
+"""
+
+import fcntl
+import logging
+import os
+import threading
+
+logger = logging.getLogger("lr_webextensions.orgfile")
+
+
+class ConcurrentEditError(Exception):
+    """The file has unsaved changes in Emacs
+
+    ``owner`` is the target of the Emacs lock file, ``changed``
+    is true if the file is changed on disk since the last batch.
+    """
+
+    def __init__(self, message, owner=None, changed=False):
+        super().__init__(message)
+        self.owner = owner
+        self.changed = changed
+
+
+class _Batch:
+    __slots__ = ("entries", "written", "error")
+
+    def __init__(self):
+        self.entries = []
+        self.written = False
+        self.error = None
+
+
+def emacs_lock_owner(path):
+    """``user@host.pid`` from Emacs lock file or ``None``
+
+    Emacs creates a symbolic link ``.#NAME`` when the buffer
+    visiting ``NAME`` is modified, unless ``create-lockfiles`` is ``nil``.
+    """
+    directory, name = os.path.split(path)
+    try:
+        return os.readlink(os.path.join(directory, ".#" + name))
+    except OSError:
+        return None
+
+
+def format_entries(entries):
+    """Join entries, every one ends with a newline
+
+    >>> format_entries(["* A", "* B\\n"])
+    '* A\\n* B\\n'
+    """
+    return "".join(
+        entry if entry.endswith("\n") else entry + "\n" for entry in entries)
+
+
+class OrgFileAppender:
+    """Add entries to the end of ``path``
+
+    ``fcntl.flock`` serializes writes with other processes using
+    this class for the same file. ``fsync`` makes appended entries
+    durable before ``append`` returns, it is called once per batch.
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.batch_count = 0
+        # ``(inode, size, mtime_ns)`` after the last batch
+        self._state = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._batch = None
+
+    def append(self, entries):
+        """Write Org text of ``entries``, return their number
+
+        ``ConcurrentEditError`` is raised if the file is modified
+        in Emacs, ``OSError`` if it can not be written.
+        """
+        with self._lock:
+            if self._batch is None:
+                self._batch = _Batch()
+            batch = self._batch
+            batch.entries.extend(entries)
+        with self._write_lock:
+            if not batch.written:
+                # Entries added by other threads are written as well.
+                with self._lock:
+                    if self._batch is batch:
+                        self._batch = None
+                try:
+                    self._write(batch.entries)
+                except Exception as ex:
+                    batch.error = ex
+                batch.written = True
+        if batch.error is not None:
+            raise batch.error
+        return len(entries)
+
+    def _write(self, entries):
+        data = format_entries(entries).encode("UTF-8")
+        fd = os.open(
+            self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC,
+            0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            st = os.fstat(fd)
+            changed = self._state is not None and self._state != _file_state(st)
+            if changed:
+                # Saved from Emacs or appended by another process.
+                logger.warning("%s is changed since the last batch", self.path)
+            # Checked under lock, other writers might start Emacs edit.
+            owner = emacs_lock_owner(self.path)
+            if owner is not None:
+                raise ConcurrentEditError(
+                    f"{self.path} is modified in Emacs ({owner})", owner, changed)
+            if st.st_size > 0 and os.pread(fd, 1, st.st_size - 1) != b"\n":
+                data = b"\n" + data
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            if self.fsync:
+                os.fsync(fd)
+            st_after = os.fstat(fd)
+            if st_after.st_size != st.st_size + len(data):
+                # Somebody does not use ``flock``.
+                logger.warning(
+                    "%s is modified during append of %d entries",
+                    self.path, len(entries))
+            self._state = _file_state(st_after)
+            self.batch_count += 1
+        finally:
+            os.close(fd)
+
+
+def _file_state(st):
+    return st.st_ino, st.st_size, st.st_mtime_ns
@@ -0,0 +1,177 @@
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Thin stdio shim for a long-lived native messaging backend
+
+The browser starts a new native messaging host for every connection.
+To avoid interpreter startup, imports and loading of caches for each
+capture, the process started by the browser may be just a shim
+that relays bytes between its stdin and stdout and a Unix socket.
+Requests are handled by a daemon listening on the socket,
+see ``daemon.serve``. The shim starts the daemon on demand.
+
+Only light modules are imported here to keep startup of the shim fast.
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+#: Seconds without connections before the daemon exits
+IDLE_TIMEOUT = 600
+#: Environment variable to override ``IDLE_TIMEOUT``, ``0`` disables daemon
+IDLE_TIMEOUT_ENV = "LR_DAEMON_IDLE_TIMEOUT"
+#: Seconds to wait till a just started daemon accepts connections
+START_TIMEOUT = 5
+_BUFFER_SIZE = 64*1024
+
+#: Unix sockets and file locks are available
+SUPPORTED = hasattr(socket, "AF_UNIX") and os.name == "posix"
+
+
+def idle_timeout(environ=os.environ):
+    """Value of ``LR_DAEMON_IDLE_TIMEOUT``, ``0`` means no daemon
+
+    >>> idle_timeout({}), idle_timeout({IDLE_TIMEOUT_ENV: "0"})
+    (600, 0.0)
+    >>> idle_timeout({IDLE_TIMEOUT_ENV: "1.5"})
+    1.5
+    """
+    value = environ.get(IDLE_TIMEOUT_ENV)
+    if not value:
+        return IDLE_TIMEOUT
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return IDLE_TIMEOUT
+
+
+def app_name(path=None):
+    """Name of native messaging host: script file name without ``.py``
+
+    >>> app_name("/opt/linkremark/lr_emacsclient.py"), app_name("lr_host")
+    ('lr_emacsclient', 'lr_host')
+    """
+    name = os.path.basename(sys.argv[0] if path is None else path)
+    base, ext = os.path.splitext(name)
+    return base if ext.lower() == ".py" else name
+
+
+def socket_path(name):
+    """Path to the socket in a directory accessible by the current user only
+
+    ``$XDG_RUNTIME_DIR/linkremark/NAME.sock`` or a similar file
+    in a temporary directory.
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        directory = os.path.join(runtime_dir, "linkremark")
+    else:
+        directory = os.path.join(
+            os.environ.get("TMPDIR") or "/tmp", f"linkremark-{os.getuid()}")
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    status = os.stat(directory)
+    if status.st_uid != os.getuid() or status.st_mode & 0o077:
+        raise PermissionError(
+            f"{directory} must be accessible by the owner only")
+    return os.path.join(directory, name + ".sock")
+
+
+def _log_path(path):
+    return os.path.splitext(path)[0] + ".log"
+
+
+def start(command, path):
+    """Start daemon ``command`` detached from the browser"""
+    with open(os.devnull, "r+b") as devnull, \
+            open(_log_path(path), "ab") as log:
+        return subprocess.Popen(
+            command, stdin=devnull, stdout=devnull, stderr=log,
+            start_new_session=True, close_fds=True)
+
+
+def connect(path, command=None, timeout=START_TIMEOUT):
+    """Connect to the daemon, start it using ``command`` if necessary
+
+    If ``command`` is ``None``, just wait for the socket.
+    The command is started again if it exits before the socket
+    is available, e.g. it has noticed another daemon shutting down.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    child = None
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return sock
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            if time.monotonic() > deadline:
+                raise
+        if command is not None and (child is None or child.poll() is not None):
+            child = start(command, path)
+        time.sleep(delay)
+        delay = min(2*delay, 0.1)
+
+
+def relay(sock, input_file=None, output_file=None):
+    """Copy bytes from ``input_file`` to ``sock`` and back till EOF
+
+    Frames are passed as is, they are not decoded.
+    """
+    input_file = input_file or sys.stdin.buffer
+    output_file = output_file or sys.stdout.buffer
+
+    def forward():
+        try:
+            while True:
+                data = input_file.read1(_BUFFER_SIZE)
+                if not data:
+                    break
+                sock.sendall(data)
+        except OSError:
+            pass
+        finally:
+            # Daemon finishes pending requests and closes connection.
+            try:
+                sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    threading.Thread(target=forward, daemon=True).start()
+    try:
+        while True:
+            data = sock.recv(_BUFFER_SIZE)
+            if not data:
+                break
+            output_file.write(data)
+            output_file.flush()
+    except OSError:
+        pass
+
+
+def shim(path, command, input_file=None, output_file=None):
+    """Relay messages to the daemon, return exit code"""
+    try:
+        sock = connect(path, command)
+    except OSError as ex:
+        print(f"{command[0]}: connection to daemon failed: {ex}", file=sys.stderr)
+        return 1
+    with sock:
+        relay(sock, input_file, output_file)
+    return 0
@@ -0,0 +1,240 @@
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Per-method request statistics for JSON-RPC loops
+
+Pass ``Stats`` instance as ``stats`` argument of ``jsonrpc.loop``
+or ``jsonrpc_asyncio.loop``. For every method it collects count
+of calls and errors, latency of request processing stages
+
+- ``decode``: parsing of JSON,
+- ``dispatch``: request validation and method lookup,
+- ``handler``: the method call (for plain methods in the asyncio loop
+  it includes waiting for a free thread),
+- ``encode``: serialization of the response,
+
+and sizes of requests and responses. Values are counted in power of two
+buckets, so recording is a few integer operations. Latencies are
+in microseconds, sizes are in bytes.
+
+Current values are available through ``linkremark.stats`` method
+and may be appended as a JSON line to a file on exit and on ``SIGUSR1``,
+see ``Stats.install``.
+
+>>> stats = Stats()
+>>> sample = stats.new_sample(100)
+>>> sample.method = "hello"
+>>> sample.handler = 1500  # nanoseconds
+>>> stats.add(sample)
+>>> snapshot = stats.snapshot()["methods"]["hello"]
+>>> snapshot["calls"], snapshot["handler"]["max"], snapshot["requestSize"]["p50"]
+(1, 1, 100)
+"""
+
+import atexit
+import json
+import logging
+import signal
+import threading
+import time
+
+logger = logging.getLogger("lr_webextensions.stats")
+
+METHOD = "linkremark.stats"
+#: Name for requests having no valid method
+INVALID = "<invalid>"
+#: Name for batch requests as the whole, calls are counted separately
+BATCH = "<batch>"
+
+_STAGES = ("decode", "dispatch", "handler", "encode")
+
+
+class Histogram:
+    """Distribution of non-negative integers in power of two buckets
+
+    >>> histogram = Histogram()
+    >>> for value in (1, 2, 3, 100):
+    ...     histogram.add(value)
+    >>> histogram.to_dict()
+    {'count': 4, 'mean': 26.5, 'max': 100, 'p50': 3, 'p90': 100, 'p99': 100}
+    """
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0]*65
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        value = int(value)
+        self.buckets[min(value.bit_length(), 64)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket containing the value"""
+        threshold = fraction*self.count
+        accumulated = 0
+        for index, count in enumerate(self.buckets):
+            accumulated += count
+            if count and accumulated >= threshold:
+                return min((1 << index) - 1, self.max)
+        return self.max
+
+    def to_dict(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': round(self.total/self.count, 1),
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+        }
+
+
+class MethodStats:
+    __slots__ = ('calls', 'errors', 'requestSize', 'responseSize') + _STAGES
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        for attr in self.__slots__[2:]:
+            setattr(self, attr, Histogram())
+
+    def to_dict(self):
+        result = {'calls': self.calls, 'errors': self.errors}
+        for attr in self.__slots__[2:]:
+            histogram = getattr(self, attr)
+            if histogram.count:
+                result[attr] = histogram.to_dict()
+        return result
+
+
+class Sample:
+    """Measurements for a single request filled by a loop
+
+    Stage durations are in nanoseconds, ``None`` if not measured.
+    ``lap`` returns time since the previous call.
+    """
+    __slots__ = (
+        'method', 'error', 'request_size', 'response_size', 'children',
+        '_mark') + _STAGES
+
+    def __init__(self, request_size=None):
+        self.method = INVALID
+        self.error = False
+        self.request_size = request_size
+        self.response_size = None
+        self.children = None
+        for stage in _STAGES:
+            setattr(self, stage, None)
+        self._mark = time.perf_counter_ns()
+
+    def lap(self):
+        now = time.perf_counter_ns()
+        elapsed = now - self._mark
+        self._mark = now
+        return elapsed
+
+    def child(self):
+        """Sample for a call from a batch"""
+        sample = Sample()
+        if self.children is None:
+            self.children = []
+        self.children.append(sample)
+        return sample
+
+
+class Stats:
+    """Per-method statistics
+
+    ``add`` is called by a loop, ``snapshot`` by an executor thread
+    or a signal handler, so both hold the lock. It is reentrant
+    since the ``SIGUSR1`` handler may interrupt ``add``
+    in the same thread.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.methods = {}
+        self._path = None
+        self._lock = threading.RLock()
+
+    def new_sample(self, request_size=None):
+        return Sample(request_size)
+
+    def add(self, sample):
+        with self._lock:
+            self._add(sample)
+
+    def _add(self, sample):
+        if sample.children is not None:
+            sample.method = BATCH
+            for child in sample.children:
+                self._add(child)
+        method_stats = self.methods.get(sample.method)
+        if method_stats is None:
+            method_stats = self.methods[sample.method] = MethodStats()
+        method_stats.calls += 1
+        if sample.error:
+            method_stats.errors += 1
+        for stage in _STAGES:
+            value = getattr(sample, stage)
+            if value is not None:
+                getattr(method_stats, stage).add(value // 1000)
+        if sample.request_size is not None:
+            method_stats.requestSize.add(sample.request_size)
+        if sample.response_size is not None:
+            method_stats.responseSize.add(sample.response_size)
+
+    def snapshot(self):
+        """Result of ``linkremark.stats`` method"""
+        now = time.time()
+        with self._lock:
+            methods = {
+                name: value.to_dict() for name, value in self.methods.items()}
+        return {
+            'time': now,
+            'uptime': round(now - self.started, 3),
+            'methods': methods,
+        }
+
+    def register(self, dispatcher):
+        dispatcher.add_method(METHOD, self.snapshot)
+
+    def dump(self, path=None):
+        """Append snapshot to the JSONL file"""
+        path = path or self._path
+        if not path:
+            return
+        try:
+            with open(path, "a", encoding="utf-8") as output:
+                output.write(json.dumps(self.snapshot(), ensure_ascii=False))
+                output.write("\n")
+        except OSError:
+            logger.error("failed to write stats to %s", path, exc_info=True)
+
+    def install(self, path):
+        """Dump to ``path`` on exit and on ``SIGUSR1``"""
+        self._path = path
+        if not path:
+            return
+        atexit.register(self.dump)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump())
@@ -0,0 +1,146 @@
+# Copyright (C) 2020-2021 Max Nikulin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Match keys for URLs of the same page written differently
+
+A page may be available as ``http://www.example.org/a/?b=1&a=2`` and
+as ``https://example.org/a?a=2&b=1&utm_source=feed#section``.
+``UrlCanonicalizer.key`` maps all such variants to the same string,
+so lookup of a page is a ``dict`` access instead of comparison
+with every link. The key is not a valid URL, it is never displayed.
+
+>>> key = UrlCanonicalizer().key
+>>> key("http://www.Example.org:80/a/?b=1&a=2")
+'//example.org/a?a=2&b=1'
+>>> key("https://example.org/a?a=2&b=1&utm_source=feed#section")
+'//example.org/a?a=2&b=1'
+"""
+
+import re
+from urllib.parse import quote, unquote, urlsplit
+
+#: Query parameters that do not change content of the page.
+#: Trailing ``*`` matches any suffix.
+DENYLIST = (
+    "utm_*", "fbclid", "gclid", "dclid", "msclkid", "yclid",
+    "mc_cid", "mc_eid", "igshid",
+)
+
+_DEFAULT_PORTS = {"http": 80, "https": 443, "ftp": 21}
+# Scheme is not a part of key, HTTP and HTTPS variants are the same page.
+_WEB_SCHEMES = ("http", "https")
+_ESCAPE_RE = re.compile(r"%([0-9A-Fa-f]{2})")
+_UNRESERVED = frozenset(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~")
+# Characters that are not escaped in path and query besides unreserved ones.
+_PATH_SAFE = "/:@!$&'()*+,;=%"
+_QUERY_SAFE = "/:@!$'()*+,;=?%"
+
+
+def _normalize_escapes(text, safe):
+    """Escape characters not allowed in URLs, decode escaped unreserved ones
+
+    >>> _normalize_escapes("/%7euser/%e2%82%ac x/€", _PATH_SAFE)
+    '/~user/%E2%82%AC%20x/%E2%82%AC'
+    """
+    if text.isascii() and "%" not in text and " " not in text:
+        return text
+
+    def replace(match):
+        char = chr(int(match.group(1), 16))
+        return char if char in _UNRESERVED else "%" + match.group(1).upper()
+
+    return _ESCAPE_RE.sub(replace, quote(text, safe=safe))
+
+
+class UrlCanonicalizer:
+    """Compute lookup keys for URLs
+
+    - scheme is dropped for HTTP and HTTPS, ``www.`` is removed from host,
+      host is case-insensitive, default ports are omitted,
+    - trailing slash of path is removed,
+    - fragment is dropped unless it is a route of a single page
+      application (``#!`` or ``#/``),
+    - percent-encoding is normalized,
+    - query parameters are sorted, ``denylist`` ones are removed.
+
+    URLs without host are just stripped.
+
+    >>> key = UrlCanonicalizer(denylist=["ref", "utm_*"]).key
+    >>> key("https://example.org/app#/item/1?ref=x")
+    '//example.org/app#/item/1?ref=x'
+    >>> key("https://example.org/?ref=x&utm_medium=rss&id=1")
+    '//example.org?id=1'
+    >>> key(" FTP://User@Example.org:21/Dir/ ")
+    'ftp://User@example.org/Dir'
+    """
+
+    #: Increment it when keys change, so saved indexes are rebuilt
+    VERSION = 1
+
+    def __init__(self, denylist=DENYLIST):
+        self.denylist = tuple(denylist)
+        names = [name.lower() for name in self.denylist]
+        self._names = frozenset(name for name in names if not name.endswith("*"))
+        self._prefixes = tuple(name[:-1] for name in names if name.endswith("*"))
+
+    @property
+    def signature(self):
+        """Keys are the same if signatures are equal"""
+        return "{}:{}".format(self.VERSION, ",".join(sorted(set(self.denylist))))
+
+    def key(self, url):
+        url = url.strip()
+        try:
+            parts = urlsplit(url)
+        except ValueError:
+            return url
+        if not parts.netloc:
+            return url
+        scheme = parts.scheme.lower()
+        userinfo, at, host = parts.netloc.rpartition("@")
+        host, colon, port = host.lower().rpartition(":")
+        if not colon or "]" in port:
+            # No port or IPv6 address without port.
+            host, port = host + colon + port, ""
+        host = host.rstrip(".")
+        if host.startswith("www."):
+            host = host[4:]
+        if port.isdigit() and int(port) == _DEFAULT_PORTS.get(scheme):
+            port = ""
+        result = [
+            "" if scheme in _WEB_SCHEMES else scheme + ":",
+            "//", userinfo, at, host, ":" if port else "", port,
+            _normalize_escapes(parts.path, _PATH_SAFE).rstrip("/")]
+        query = self._query(parts.query)
+        if query:
+            result += ("?", query)
+        if parts.fragment.startswith(("!", "/")):
+            result += ("#", parts.fragment)
+        return "".join(result)
+
+    def _query(self, query):
+        if not query:
+            return query
+        params = []
+        for param in query.split("&"):
+            if not param:
+                continue
+            param = _normalize_escapes(param, _QUERY_SAFE)
+            name = unquote(param.partition("=")[0]).lower()
+            if name in self._names or name.startswith(self._prefixes):
+                continue
+            params.append(param)
+        params.sort()
+        return "&".join(params)